@@ -350,6 +350,17 @@ function App() {
         const data = JSON.parse(event.data);
         console.debug('Notifications WS message', data);
 
+        // server heartbeat: sockets that never answer are closed as dead
+        if (data.event === 'ping') {
+          socket.send(JSON.stringify({ action: 'pong' }));
+          return;
+        }
+
+        // notifications are kept on the server (and replayed on reconnect) until acked
+        if (data.delivery_id != null) {
+          socket.send(JSON.stringify({ action: 'ack', delivery_id: data.delivery_id }));
+        }
+
         // someone added you to a group
         if (data.event === 'group_added' || data.type === 'group.added') {
           setGroups((prev) => {
@@ -474,6 +485,10 @@ function App() {
     socket.onmessage = (event) => {
       try {
         const data = JSON.parse(event.data);
+        if (data.event === 'ping') {
+          socket.send(JSON.stringify({ action: 'pong' }));
+          return;
+        }
         if (data.type === 'chat.message' || data.text) {
           const incomingSenderId = data.sender_id != null ? Number(data.sender_id) : null;
           const myId = currentUserRef.current?.id != null ? Number(currentUserRef.current.id) : null;
@@ -0,0 +1,211 @@
+"""Admission control for WebSocket handshakes.
+
+After a deploy or a network blip every client reconnects at once, and each
+handshake costs a token lookup in the database plus the consumer's
+connect() (group_add, accept). Unbounded, that surge stalls the worker:
+every handshake waits behind all the others, clients give up and retry on
+their own schedule, and the worker keeps authenticating sockets nobody is
+listening on any more.
+
+AdmissionMiddleware sits in front of JWTAuthMiddleware and lets at most
+WS_CONNECT_CONCURRENCY handshakes run at once; a handshake ends when the
+app accepts or closes the socket. Further connects wait in a FIFO queue of
+at most WS_CONNECT_QUEUE, each for up to WS_CONNECT_QUEUE_TIMEOUT_MS.
+Connects that find the queue full, or whose deadline passes, are accepted
+and closed straight away with OVERLOADED_CLOSE_CODE and a reason of
+"retry_after_ms=<n>", without touching the database.
+
+The retry hint spreads the herd over the time the worker needs to take it
+in: the backlog (waiting plus recently refused connects) divided by the
+admission rate, measured from how long handshakes take, with full jitter
+so the retries do not come back in step. It is clamped to
+WS_RETRY_MIN_MS..WS_RETRY_MAX_MS.
+
+stats() reports admitted/refused counts, queue wait percentiles and peaks.
+manage.py sim_reconnect_storm replays a mass reconnect with and without it.
+"""
+
+import asyncio
+import random
+from collections import deque
+from typing import Dict, Optional
+
+from django.conf import settings
+
+
+OVERLOADED_CLOSE_CODE = 4503
+
+
+class AdmissionGate:
+    """Loop-bound counter of handshakes in flight plus the queue in front of it."""
+
+    def __init__(self, concurrency: int, queue_size: int, queue_timeout_ms: int, retry_min_ms: int, retry_max_ms: int):
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout_ms / 1000
+        self.retry_min_ms = retry_min_ms
+        self.retry_max_ms = retry_max_ms
+        self._loop = None
+        self.in_flight = 0
+        self._waiting: deque = deque()  # futures, set when a slot is handed over
+
+        self._handshake_s = 0.05  # moving average of handshake time, seeds the admission rate
+        self._refused_recent = 0.0  # refusals, halved every second
+        self._refused_at = 0.0
+        self._waits = deque(maxlen=1000)
+        self.admitted = 0
+        self.refused = 0
+        self.peak_in_flight = 0
+        self.peak_waiting = 0
+
+    def _bind(self) -> None:
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # futures are loop-bound; a new loop (tests, a restarted server) starts empty
+            self._loop = loop
+            self.in_flight = 0
+            self._waiting = deque()
+
+    async def acquire(self) -> bool:
+        """Take a handshake slot, waiting in line if needed; False to refuse the connect."""
+        self._bind()
+        while self._waiting and self._waiting[0].done():
+            self._waiting.popleft()  # gave up on their deadline
+        if self.in_flight < self.concurrency and not self._waiting:
+            self._admit(0.0)
+            return True
+        if len(self._waiting) >= self.queue_size:
+            self._refuse()
+            return False
+
+        began = self._loop.time()
+        waiter = self._loop.create_future()
+        self._waiting.append(waiter)
+        self.peak_waiting = max(self.peak_waiting, len(self._waiting))
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if waiter.done():
+                # handed a slot just as the deadline passed: use it
+                self._admit(self._loop.time() - began, counted=True)
+                return True
+            waiter.cancel()  # skipped by release()
+            self._refuse()
+            return False
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release(0.0, handed=True)  # pass the slot on
+            else:
+                waiter.cancel()
+            raise
+        self._admit(self._loop.time() - began, counted=True)
+        return True
+
+    def _admit(self, waited: float, counted: bool = False) -> None:
+        if not counted:
+            self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        self.admitted += 1
+        self._waits.append(waited * 1000)
+
+    def release(self, handshake_s: float, handed: bool = False) -> None:
+        """End of a handshake: the slot goes to the first live waiter, if any."""
+        if not handed:
+            self._handshake_s += (handshake_s - self._handshake_s) * 0.05
+        while self._waiting:
+            waiter = self._waiting.popleft()
+            if not waiter.done():
+                waiter.set_result(None)  # in_flight stays: the slot changes hands
+                return
+        self.in_flight -= 1
+
+    def _refuse(self) -> None:
+        now = self._loop.time()
+        if now - self._refused_at >= 1.0:
+            self._refused_recent /= 2 ** min(32, int(now - self._refused_at))
+            self._refused_at = now
+        self._refused_recent += 1
+        self.refused += 1
+
+    def retry_after_ms(self) -> int:
+        """Full-jitter delay over the time it takes to admit everyone now waiting or refused."""
+        rate = self.concurrency / max(self._handshake_s, 1e-4)  # handshakes per second
+        backlog = len(self._waiting) + self._refused_recent
+        # at least twice the minimum wide, so even a small backlog is not retried in step
+        window = min(self.retry_max_ms, max(2 * self.retry_min_ms, backlog / rate * 1000))
+        return int(random.uniform(self.retry_min_ms, window))
+
+    def stats(self) -> Dict:
+        waits = sorted(self._waits)
+
+        def pick(q):
+            return round(waits[min(len(waits) - 1, int(len(waits) * q))], 1) if waits else None
+
+        return {
+            "in_flight": self.in_flight,
+            "waiting": len(self._waiting),
+            "admitted": self.admitted,
+            "refused": self.refused,
+            "peak_in_flight": self.peak_in_flight,
+            "peak_waiting": self.peak_waiting,
+            "wait_ms_p50": pick(0.5),
+            "wait_ms_p99": pick(0.99),
+            "handshake_ms_avg": round(self._handshake_s * 1000, 1),
+        }
+
+
+class AdmissionMiddleware:
+    """ASGI middleware: admission control for "websocket" scopes, anything else passes through."""
+
+    def __init__(self, app, gate: Optional[AdmissionGate] = None):
+        self.app = app
+        self.gate = gate or default_gate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "websocket":
+            return await self.app(scope, receive, send)
+
+        gate = self.gate
+        if not await gate.acquire():
+            return await self._refuse(receive, send, gate.retry_after_ms())
+
+        clock = asyncio.get_running_loop().time  # the gate's clock too
+        began = clock()
+        held = True
+
+        async def handshake_send(message):
+            nonlocal held
+            if held and message["type"] in ("websocket.accept", "websocket.close", "websocket.http.response.start"):
+                held = False
+                gate.release(clock() - began)
+            await send(message)
+
+        try:
+            return await self.app(scope, receive, handshake_send)
+        finally:
+            if held:
+                # the app ended (or failed) without answering the handshake
+                gate.release(clock() - began)
+
+    @staticmethod
+    async def _refuse(receive, send, retry_after_ms: int) -> None:
+        message = await receive()
+        if message["type"] != "websocket.connect":
+            return  # the client left while it was queued
+        # closing before accept would be a bare 403 with no code; accept so
+        # the client sees the close code and the hint
+        await send({"type": "websocket.accept"})
+        await send({"type": "websocket.close", "code": OVERLOADED_CLOSE_CODE, "reason": f"retry_after_ms={retry_after_ms}"})
+
+
+default_gate = AdmissionGate(
+    settings.WS_CONNECT_CONCURRENCY,
+    settings.WS_CONNECT_QUEUE,
+    settings.WS_CONNECT_QUEUE_TIMEOUT_MS,
+    settings.WS_RETRY_MIN_MS,
+    settings.WS_RETRY_MAX_MS,
+)
+
+
+def stats() -> Dict:
+    return default_gate.stats()
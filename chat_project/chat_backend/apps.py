@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class ChatBackendConfig(AppConfig):
     name = 'chat_backend'
+
+    def ready(self):
+        # connect the ETag version receivers
+        from . import versions  # noqa: F401
@@ -0,0 +1,75 @@
+"""Conditional GET support for the polled read endpoints.
+
+@etag_from(keys_for) tags a view's 200 responses with a strong ETag built
+from the version counters in versions.py and answers a matching
+If-None-Match with 304 before the view runs, so the response is neither
+rebuilt nor queried for.
+"""
+
+import hashlib
+import logging
+import threading
+from collections import defaultdict
+from functools import wraps
+
+from django.conf import settings
+from rest_framework.response import Response
+
+from .versions import get_versions
+
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+# view name -> [requests, 304s]
+_counts = defaultdict(lambda: [0, 0])
+
+
+def _record(name: str, not_modified: bool) -> None:
+    with _lock:
+        counts = _counts[name]
+        counts[0] += 1
+        counts[1] += not_modified
+        total, hits = counts
+    if total % settings.ETAG_STATS_LOG_EVERY == 0:
+        logger.info("%s: %d/%d requests answered 304 (%.1f%%)", name, hits, total, 100 * hits / total)
+
+
+def stats():
+    with _lock:
+        return {name: {"requests": t, "not_modified": h} for name, (t, h) in _counts.items()}
+
+
+def make_etag(keys, versions) -> str:
+    raw = "|".join(f"{k}={v}" for k, v in zip(keys, versions))
+    return '"' + hashlib.blake2s(raw.encode(), digest_size=12).hexdigest() + '"'
+
+
+def etag_from(keys_for):
+    """keys_for(request, *args, **kwargs) -> version keys, or None to skip (e.g. not allowed)."""
+
+    def decorator(view):
+        @wraps(view)
+        def wrap(request, *args, **kwargs):
+            keys = keys_for(request, *args, **kwargs)
+            if keys is None:
+                return view(request, *args, **kwargs)
+
+            # read versions before building the body: a change racing with us
+            # then produces a newer version, never a stale 304
+            etag = make_etag(keys, get_versions(keys))
+
+            candidates = [t.strip() for t in request.headers.get("If-None-Match", "").split(",")]
+            if etag in candidates or "*" in candidates:
+                _record(view.__name__, True)
+                return Response(status=304, headers={"ETag": etag})
+
+            response = view(request, *args, **kwargs)
+            if response.status_code == 200:
+                response["ETag"] = etag
+            _record(view.__name__, False)
+            return response
+
+        return wrap
+
+    return decorator
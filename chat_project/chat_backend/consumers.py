@@ -1,19 +1,72 @@
-import json
+import re
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
 
 from .models import DirectChat, GroupChat, MyUser
 from . import services
+from .dedupe import DuplicateMessage
+from . import fanout
+from .outbox import dispatcher as outbox_dispatcher
+from .framing import FramedSendMixin
+from .heartbeat import HeartbeatMixin
+from .inbox import InboxMixin
 
 
-class ChatConsumer(AsyncWebsocketConsumer):
+ROOM_RE = re.compile(r"^(direct|group)_(\d+)$")
+
+
+def parse_room(room):
+    """'group_3' -> ("group", 3); None for anything that is not a chat room name."""
+    match = ROOM_RE.match(room) if isinstance(room, str) else None
+    if not match:
+        return None
+    return match.group(1), int(match.group(2))
+
+
+# ---------------- DB ----------------
+
+@database_sync_to_async
+def create_room_message(sender_id, chat_type, chat_id, text, reply_to=None, client_msg_id=None):
+    sender = MyUser.objects.get(id=sender_id)
+
+    if chat_type == "direct":
+        chat = DirectChat.objects.get(id=chat_id)
+        return services.send_direct_message_service(sender, chat, text, None, reply_to, client_msg_id)
+    else:
+        group = GroupChat.objects.get(id=chat_id)
+        return services.send_group_message_service(sender, group, text, None, reply_to, client_msg_id)
+
+
+def message_ack(room, client_msg_id, message_id, created_at, duplicate):
+    """Reply to a send that carried a client_msg_id; a resend gets the original id back."""
+    return {
+        "event": "message_ack",
+        "room": room,
+        "client_msg_id": client_msg_id,
+        "id": message_id,
+        "created_at": created_at.isoformat(),
+        "duplicate": duplicate,
+    }
+
+
+@database_sync_to_async
+def can_access_room(user_id, chat_type, chat_id):
+    return services.can_access_room_service(user_id, chat_type, chat_id)
+
+
+class ChatConsumer(HeartbeatMixin, FramedSendMixin, AsyncWebsocketConsumer):
+    # per-connection state; the class-level defaults keep disconnect() safe
+    # and cost nothing for the sockets that never set them
+    user = None
+    room_name = None
+    chat_type = None
+    chat_id = None
+
     async def connect(self):
-        # always predefine attributes so disconnect() is safe
         print(self.scope["user"])
-        self.room_name = None
-        self.chat_type = None
-        self.direct_chat_id = None
-        self.group_id = None
+        self.setup_framing()
 
         # User is set by JWTAuthMiddleware; require authentication
         self.user = self.scope.get("user")
@@ -23,31 +76,36 @@ class ChatConsumer(AsyncWebsocketConsumer):
 
         url_kwargs = self.scope["url_route"]["kwargs"]
 
-        self.direct_chat_id = url_kwargs.get("direct_chat_id")
-        self.group_id = url_kwargs.get("group_id")
-
-        if self.direct_chat_id:
+        if url_kwargs.get("direct_chat_id"):
             self.chat_type = "direct"
-            self.room_name = f"direct_{self.direct_chat_id}"
+            self.chat_id = int(url_kwargs["direct_chat_id"])
 
-        elif self.group_id:
+        elif url_kwargs.get("group_id"):
             self.chat_type = "group"
-            self.room_name = f"group_{self.group_id}"
+            self.chat_id = int(url_kwargs["group_id"])
 
         else:
             await self.close()
             return
 
+        self.room_name = f"{self.chat_type}_{self.chat_id}"
         await self.channel_layer.group_add(self.room_name, self.channel_name)
-        await self.accept()
+        await self.accept(self.frame_subprotocol)
+        await self.start_heartbeat()
+        await fanout.ensure_running()
 
-    async def disconnect(self, close_code):
+    def heartbeat_groups(self):
         # Only discard if we successfully joined a room
-        if getattr(self, "room_name", None):
-            await self.channel_layer.group_discard(self.room_name, self.channel_name)
+        return [self.room_name] if self.room_name else []
+
+    async def disconnect(self, close_code):
+        self.stop_framing()
+        await self.leave_groups()
 
-    async def receive(self, text_data):
-        data = json.loads(text_data)
+    async def receive(self, text_data=None, bytes_data=None):
+        data = await self.receive_frame(text_data, bytes_data)
+        if await self.heartbeat_frame(data) or data is None:
+            return
 
         # sender is always the authenticated WebSocket user
         if not self.user:
@@ -55,46 +113,48 @@ class ChatConsumer(AsyncWebsocketConsumer):
             return
 
         text = data.get("text", "")
+        client_msg_id = data.get("client_msg_id")
         try:
-            message = await self.create_message(self.user.id, text)
+            message = await create_room_message(
+                self.user.id, self.chat_type, self.chat_id, text, data.get("reply_to"), client_msg_id
+            )
         except PermissionError:
             # User is not allowed to post in this chat; close gracefully
             await self.close()
             return
+        except ObjectDoesNotExist:
+            # the chat was deleted while the socket was open
+            await self.send_event({"event": "error", "room": self.room_name, "error": "not_found"})
+            await self.close()
+            return
+        except ValueError as exc:
+            # e.g. replying to a message of another chat
+            await self.send_event({"event": "error", "room": self.room_name, "error": str(exc)})
+            return
+        except DuplicateMessage as dup:
+            # a resend: nothing was written or broadcast
+            await self.send_event(message_ack(self.room_name, client_msg_id, dup.message_id, dup.created_at, True))
+            return
 
-        await self.channel_layer.group_send(
-            self.room_name,
-            {
-                "type": "chat.message",
-                "id": message.id,
-                "sender_id": self.user.id,
-                "sender": self.user.username,
-                "text": message.text,
-                "created_at": message.created_at.isoformat(),
-            }
-        )
+        # the room broadcast is queued by the send service
+        if client_msg_id:
+            await self.send_event(message_ack(self.room_name, client_msg_id, message.id, message.created_at, False))
 
     async def chat_message(self, event):
-        await self.send(text_data=json.dumps(event))
+        await self.send_event(event)
 
-    # ---------------- DB ----------------
+    async def chat_change(self, event):
+        await self.send_event(event)
 
-    @database_sync_to_async
-    def create_message(self, sender_id, text):
-        sender = MyUser.objects.get(id=sender_id)
 
-        if self.chat_type == "direct":
-            chat = DirectChat.objects.get(id=self.direct_chat_id)
-            return services.send_direct_message_service(sender, chat, text, None)
-        else:
-            group = GroupChat.objects.get(id=self.group_id)
-            return services.send_group_message_service(sender, group, text, None)
+class NotificationConsumer(InboxMixin, HeartbeatMixin, FramedSendMixin, AsyncWebsocketConsumer):
+    user = None
+    room_name = None
 
-
-class NotificationConsumer(AsyncWebsocketConsumer):
     async def connect(self):
         # each connected user joins their personal notification group
         self.user = self.scope.get("user")
+        self.setup_framing()
         print(f"NotificationConsumer.connect user={getattr(self.user, 'id', None)}")
         if not self.user:
             await self.close()
@@ -102,22 +162,37 @@ class NotificationConsumer(AsyncWebsocketConsumer):
 
         self.room_name = f"user_{self.user.id}"
         await self.channel_layer.group_add(self.room_name, self.channel_name)
-        await self.accept()
+        await self.accept(self.frame_subprotocol)
+        await self.start_heartbeat()
+        # notifications queued while nobody was connected go out now
+        await outbox_dispatcher.ensure_running()
+        await fanout.ensure_running()
 
         # acknowledge connection for easier debugging
         try:
-            await self.send(text_data=json.dumps({"event": "notifications_connected", "user_id": self.user.id}))
+            await self.send_event({"event": "notifications_connected", "user_id": self.user.id})
         except Exception:
             pass
+        # then whatever arrived while the user was away (inbox.py)
+        await self.replay_pending()
+
+    def heartbeat_groups(self):
+        return [self.room_name] if self.room_name else []
 
     async def disconnect(self, close_code):
-        if getattr(self, "room_name", None):
-            await self.channel_layer.group_discard(self.room_name, self.channel_name)
+        self.stop_framing()
+        await self.leave_groups()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        # nothing to act on from the client besides the heartbeat and acks
+        data = await self.receive_frame(text_data, bytes_data)
+        if not await self.heartbeat_frame(data) and data is not None:
+            self.inbox_frame(data)
 
     async def group_added(self, event):
         # push notification about being added to a group
         print(f"NotificationConsumer.group_added -> user={getattr(self.user,'id',None)} event={event}")
-        await self.send(text_data=json.dumps(event))
+        await self.deliver(event)
 
     async def message_received(self, event):
         """Push a lightweight notification when this user receives a direct message.
@@ -125,5 +200,143 @@ class NotificationConsumer(AsyncWebsocketConsumer):
         Called via channel_layer.group_send with type='message.received'.
         """
         print(f"NotificationConsumer.message_received -> user={getattr(self.user,'id',None)} event={event.get('event')}")
-        await self.send(text_data=json.dumps(event))
+        await self.deliver(event)
+
+
+
+class MultiplexConsumer(InboxMixin, HeartbeatMixin, FramedSendMixin, AsyncWebsocketConsumer):
+    """One socket per client for all of its rooms plus its notifications.
+
+    The user's notification group is joined on connect. Rooms are managed
+    with in-band commands:
+
+        {"action": "subscribe", "room": "group_3"}
+        {"action": "unsubscribe", "room": "group_3"}
+        {"action": "send", "room": "direct_5", "text": "hi"}
+        {"action": "send", "room": "direct_5", "text": "re", "reply_to": 42}
+        {"action": "send", "room": "direct_5", "text": "hi", "client_msg_id": "c-17"}
+
+    Sends with a client_msg_id are answered with a message_ack event, and a
+    resend of the same id is acked with the original message instead of
+    being posted again.
+
+    Room events carry a "room" field; notifications arrive exactly as they
+    do on /ws/notifications/, including the replay of pending ones on
+    connect, and are acked with {"action": "ack", "delivery_id": N}. Like every socket, it answers the heartbeat
+    ({"action": "pong"} to a ping event) or is reaped (see heartbeat.py).
+    """
+
+    user = None
+    notification_group = None
+    rooms = frozenset()  # replaced by a set on the first subscribe
+
+    async def connect(self):
+        self.setup_framing()
 
+        self.user = self.scope.get("user")
+        if not self.user:
+            await self.close()
+            return
+
+        self.notification_group = f"user_{self.user.id}"
+        await self.channel_layer.group_add(self.notification_group, self.channel_name)
+        await self.accept(self.frame_subprotocol)
+        await self.start_heartbeat()
+        await outbox_dispatcher.ensure_running()
+        await fanout.ensure_running()
+        await self.replay_pending()
+
+    def heartbeat_groups(self):
+        groups = list(self.rooms)
+        if self.notification_group:
+            groups.append(self.notification_group)
+        return groups
+
+    async def disconnect(self, close_code):
+        self.stop_framing()
+        await self.leave_groups()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        data = await self.receive_frame(text_data, bytes_data)
+        if await self.heartbeat_frame(data) or data is None or self.inbox_frame(data):
+            return
+        action = data.get("action")
+        room = data.get("room")
+
+        parsed = parse_room(room)
+        if parsed is None:
+            await self.send_error(room, "invalid_room")
+            return
+
+        if action == "subscribe":
+            await self.subscribe(room, *parsed)
+        elif action == "unsubscribe":
+            await self.unsubscribe(room)
+        elif action == "send":
+            await self.send_to_room(room, parsed, data.get("text", ""), data.get("reply_to"), data.get("client_msg_id"))
+        else:
+            await self.send_error(room, "invalid_action")
+
+    async def subscribe(self, room, chat_type, chat_id):
+        if room not in self.rooms:
+            if len(self.rooms) >= settings.WS_MULTIPLEX_MAX_ROOMS:
+                await self.send_error(room, "too_many_rooms")
+                return
+            if not await can_access_room(self.user.id, chat_type, chat_id):
+                await self.send_error(room, "not_allowed")
+                return
+            await self.channel_layer.group_add(room, self.channel_name)
+            if not self.rooms:
+                self.rooms = set()
+            self.rooms.add(room)
+        await self.send_event({"event": "subscribed", "room": room})
+
+    async def unsubscribe(self, room):
+        if room in self.rooms:
+            self.rooms.discard(room)
+            await self.channel_layer.group_discard(room, self.channel_name)
+        await self.send_event({"event": "unsubscribed", "room": room})
+
+    async def send_to_room(self, room, parsed, text, reply_to=None, client_msg_id=None):
+        # access was checked on subscribe
+        if room not in self.rooms:
+            await self.send_error(room, "not_subscribed")
+            return
+
+        try:
+            message = await create_room_message(self.user.id, *parsed, text, reply_to, client_msg_id)
+        except PermissionError:
+            await self.send_error(room, "not_allowed")
+            return
+        except ObjectDoesNotExist:
+            # deleted since the subscribe: the other rooms on this socket carry on
+            self.rooms.discard(room)
+            await self.channel_layer.group_discard(room, self.channel_name)
+            await self.send_error(room, "not_found")
+            return
+        except ValueError as exc:
+            await self.send_error(room, str(exc))
+            return
+        except DuplicateMessage as dup:
+            await self.send_event(message_ack(room, client_msg_id, dup.message_id, dup.created_at, True))
+            return
+
+        if client_msg_id:
+            await self.send_event(message_ack(room, client_msg_id, message.id, message.created_at, False))
+
+    async def send_error(self, room, error):
+        await self.send_event({"event": "error", "room": room, "error": error})
+
+    # ---------------- channel layer handlers ----------------
+
+    async def chat_message(self, event):
+        await self.send_event(event)
+
+    async def chat_change(self, event):
+        await self.send_event(event)
+
+    async def group_added(self, event):
+        await self.deliver(event)
+
+    async def message_received(self, event):
+        await self.deliver(event)
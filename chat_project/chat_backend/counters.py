@@ -0,0 +1,109 @@
+"""Repair of the denormalized chat counters.
+
+GroupChat.member_count / message_count / last_message_id / last_message_at
+and the message fields on DirectChat are kept up to date by the write paths
+in repositories.py (in the same transaction as the row they count) and by
+retention.py. Writes that bypass those paths - bulk_create, cascading user
+deletes, manual SQL - let them drift; reconcile() recomputes them.
+
+message_count covers archived messages too (tiering.py): archiving moves a
+message, only retention removes it.
+
+Chats are reconciled in id ranges of RECONCILE_BATCH_SIZE: one grouped
+aggregate per table per range, and only the rows that differ are written.
+"""
+
+from typing import Dict, List, Tuple
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max
+
+from . import tiering
+from .models import DirectChat, GroupChat, GroupMember, Message
+
+
+FIELDS = {
+    "group": ["member_count", "message_count", "last_message_id", "last_message_at"],
+    "direct": ["message_count", "last_message_id", "last_message_at"],
+}
+
+
+def _message_stats(chat_type: str, chat_ids: List[int]) -> Dict[int, Dict]:
+    column = f"{chat_type}_chat_id"
+    rows = (
+        Message.objects.filter(**{f"{column}__in": chat_ids})
+        .values(column)
+        .annotate(message_count=Count("id"), last_message_id=Max("id"))
+    )
+    stats = {r[column]: {"message_count": r["message_count"], "last_message_id": r["last_message_id"]} for r in rows}
+
+    last_at = dict(
+        Message.objects.filter(id__in=[s["last_message_id"] for s in stats.values()]).values_list("id", "created_at")
+    )
+    for s in stats.values():
+        s["last_message_at"] = last_at[s["last_message_id"]]
+    return stats
+
+
+def _expected(chat_type: str, chat_ids: List[int], archived: Dict[int, tuple]) -> Dict[int, Dict]:
+    stats = _message_stats(chat_type, chat_ids)
+    expected = {}
+    for chat_id in chat_ids:
+        values = stats.get(chat_id, {"message_count": 0, "last_message_id": None, "last_message_at": None})
+        summary = archived.get(chat_id)
+        if summary:
+            count, last_id, last_at = summary
+            values["message_count"] += count
+            # archived ids are always below the live ones
+            if values["last_message_id"] is None:
+                values["last_message_id"], values["last_message_at"] = last_id, last_at
+        expected[chat_id] = values
+
+    if chat_type == "group":
+        members = dict(
+            GroupMember.objects.filter(group_chat_id__in=chat_ids)
+            .values("group_chat_id")
+            .annotate(n=Count("id"))
+            .values_list("group_chat_id", "n")
+        )
+        for chat_id, values in expected.items():
+            values["member_count"] = members.get(chat_id, 0)
+    return expected
+
+
+def reconcile_chats(chat_type: str, batch_size: int = 0) -> Tuple[int, int]:
+    """Recompute the counters of every chat of one type. Returns (checked, repaired)."""
+    batch_size = batch_size or settings.RECONCILE_BATCH_SIZE
+    model = DirectChat if chat_type == "direct" else GroupChat
+    fields = FIELDS[chat_type]
+    archived_ids = {i for t, i in tiering.list_archived_chats() if t == chat_type}
+
+    checked = repaired = 0
+    last_id = 0
+    while True:
+        chats = list(model.objects.filter(id__gt=last_id).order_by("id").only("id", *fields)[:batch_size])
+        if not chats:
+            return checked, repaired
+        last_id = chats[-1].id
+        chat_ids = [c.id for c in chats]
+        archived = {i: tiering.archive_summary(chat_type, i) for i in chat_ids if i in archived_ids}
+
+        with transaction.atomic():
+            expected = _expected(chat_type, chat_ids, archived)
+            drifted = []
+            for chat in chats:
+                values = expected[chat.id]
+                if any(getattr(chat, f) != values[f] for f in fields):
+                    for f in fields:
+                        setattr(chat, f, values[f])
+                    drifted.append(chat)
+            if drifted:
+                model.objects.bulk_update(drifted, fields)
+
+        checked += len(chats)
+        repaired += len(drifted)
+
+
+def reconcile(batch_size: int = 0) -> Dict[str, Tuple[int, int]]:
+    return {chat_type: reconcile_chats(chat_type, batch_size) for chat_type in FIELDS}
@@ -0,0 +1,68 @@
+"""Idempotent sends keyed by a client-chosen message id.
+
+Clients that may resend (flaky mobile links) attach a client_msg_id,
+unique per sender. Before anything is written, the send services call
+check(), which raises DuplicateMessage carrying the original message's id
+and timestamp when the key was used before. It looks in:
+
+  1. a per-process LRU of the last SEND_DEDUPE_WINDOW keys, so a retry
+     storm is answered without touching the database, then
+  2. the (sender, client_msg_id) unique index, for keys that aged out or
+     were sent through another process.
+
+Two copies racing past both checks collide on the unique index; the loser
+turns the IntegrityError into DuplicateMessage with check() again.
+"""
+
+from django.conf import settings
+
+from .cache import BoundedLRU
+from .models import Message
+
+
+_recent = BoundedLRU(settings.SEND_DEDUPE_WINDOW)
+
+
+class DuplicateMessage(Exception):
+    """The client_msg_id was already used; carries what the first send returned."""
+
+    def __init__(self, message_id: int, created_at):
+        super().__init__(message_id)
+        self.message_id = message_id
+        self.created_at = created_at
+
+
+def clean_key(client_msg_id):
+    """None for no key; ValueError("invalid_client_msg_id") for an unusable one."""
+    if client_msg_id is None or client_msg_id == "":
+        return None
+    if not isinstance(client_msg_id, (str, int)) or len(str(client_msg_id)) > 64:
+        raise ValueError("invalid_client_msg_id")
+    return str(client_msg_id)
+
+
+def check(sender_id: int, client_msg_id) -> None:
+    if client_msg_id is None:
+        return
+    key = (sender_id, client_msg_id)
+    hit = _recent.get(key)
+    if hit is None:
+        original = (
+            Message.objects.filter(sender_id=sender_id, client_msg_id=client_msg_id)
+            .values_list("id", "created_at")
+            .first()
+        )
+        if original is None:
+            return
+        _recent.set(key, original)
+        hit = original
+    raise DuplicateMessage(*hit)
+
+
+def remember(message: Message) -> None:
+    if message.client_msg_id is not None:
+        _recent.set((message.sender_id, message.client_msg_id), (message.id, message.created_at))
+
+
+def stats():
+    return {"keys": len(_recent), "hits": _recent.hits, "misses": _recent.misses}
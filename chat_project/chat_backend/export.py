@@ -0,0 +1,112 @@
+"""Streaming NDJSON export of chat history.
+
+Output, one JSON object per line:
+
+    {"type": "export", "scope": "group", "id": 3, "generated_at": ...}
+    {"type": "message", "chat_type": "group", "chat_id": 3, "id": ..., ...}   oldest first per chat
+    {"type": "attachment", "message_id": ..., "path": "chat_media/..."}       manifest, second pass
+    {"type": "end", "messages": N, "attachments": M}
+
+Messages come from the archive segments first, then from the Message table
+through iterator(chunk_size=EXPORT_CHUNK_SIZE), which uses a server-side
+cursor on PostgreSQL. Nothing is accumulated, so memory stays flat however
+long the history is. Attachments are listed as storage paths, not inlined.
+"""
+
+import json
+import zlib
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import repositories as repo
+from . import tiering
+
+
+def _message_line(chat_type: str, chat_id: int, row: Dict) -> Dict:
+    created_at = row["created_at"]
+    edited_at = row.get("edited_at")
+    return {
+        "type": "message",
+        "chat_type": chat_type,
+        "chat_id": chat_id,
+        "id": row["id"],
+        "sender_id": row["sender_id"],
+        "sender": row.get("sender") or row.get("sender__username"),
+        "text": row["text"],
+        "file": str(row["file"]) if row["file"] else None,
+        "created_at": created_at.isoformat(),
+        "edited_at": edited_at.isoformat() if edited_at else None,
+        # archived rows carry "deleted", table rows "deleted_at"
+        "deleted": row.get("deleted", False) or row.get("deleted_at") is not None,
+        "reply_to": row.get("reply_to") or row.get("reply_to_id"),
+        "reactions": row.get("reactions") or row.get("reaction_counts") or {},
+    }
+
+
+def _iter_chat(chat_type: str, chat_id: int, sender_id: Optional[int], files_only: bool) -> Iterator[Dict]:
+    mark = tiering.watermark(chat_type, chat_id)
+    for row in tiering.iter_archived(chat_type, chat_id):
+        if sender_id is not None and row["sender_id"] != sender_id:
+            continue
+        if files_only and not row["file"]:
+            continue
+        yield _message_line(chat_type, chat_id, row)
+    for row in repo.iter_messages_for_export(chat_type, chat_id, after_id=mark, sender_id=sender_id, files_only=files_only):
+        yield _message_line(chat_type, chat_id, row)
+
+
+def iter_records(chats: List[Tuple[str, int]], scope: str, scope_id: int, sender_id: Optional[int] = None) -> Iterator[Dict]:
+    yield {"type": "export", "scope": scope, "id": scope_id, "generated_at": timezone.now().isoformat()}
+
+    messages = 0
+    for chat_type, chat_id in chats:
+        for line in _iter_chat(chat_type, chat_id, sender_id, files_only=False):
+            messages += 1
+            yield line
+
+    attachments = 0
+    for chat_type, chat_id in chats:
+        for line in _iter_chat(chat_type, chat_id, sender_id, files_only=True):
+            attachments += 1
+            yield {
+                "type": "attachment",
+                "chat_type": chat_type,
+                "chat_id": chat_id,
+                "message_id": line["id"],
+                "path": line["file"],
+            }
+
+    yield {"type": "end", "messages": messages, "attachments": attachments}
+
+
+def group_records(group_id: int) -> Iterator[Dict]:
+    return iter_records([("group", group_id)], "group", group_id)
+
+
+def user_records(user_id: int) -> Iterator[Dict]:
+    """Everything the user sent, across their direct chats and groups."""
+    return iter_records(repo.list_chats_for_user_export(user_id), "user", user_id, sender_id=user_id)
+
+
+def ndjson_chunks(records: Iterator[Dict], compress: bool = False) -> Iterator[bytes]:
+    """Serialise records into ~64KB chunks, optionally as a gzip stream."""
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buf: List[bytes] = []
+    size = 0
+    for record in records:
+        line = json.dumps(record, separators=(",", ":"), ensure_ascii=False).encode() + b"\n"
+        buf.append(line)
+        size += len(line)
+        if size >= settings.EXPORT_BUFFER_BYTES:
+            chunk = b"".join(buf)
+            buf, size = [], 0
+            chunk = gz.compress(chunk) if gz else chunk
+            if chunk:
+                yield chunk
+    tail = b"".join(buf)
+    if gz:
+        yield gz.compress(tail) + gz.flush()
+    elif tail:
+        yield tail
@@ -0,0 +1,372 @@
+"""Background fan-out for group messages.
+
+Publishing a group message only enqueues a job; the request thread never
+waits on the channel layer. Fan-out workers (asyncio tasks on the server's
+event loop, where the channel layer lives; ensure_running() binds them to it
+from the first socket's connect) then:
+
+  1. send the message once to the room group (group_<id>), reaching every
+     socket subscribed to the room;
+  2. load the member ids and split them into chunks of FANOUT_CHUNK_SIZE,
+     each queued as its own job so one huge group does not hold a worker
+     for its whole member list and small groups are not stuck behind it;
+  3. deliver each chunk to the members' user_<id> notification groups,
+     yielding to the loop between chunks (group_send_bulk() in one call
+     when the layer has it, see layers.py).
+
+Payloads are encoded once per subprotocol when the message is published and
+travel as "encoded.event" messages, so consumers send the shared frame
+as-is instead of re-serialising it per recipient.
+
+Jobs reach that loop with call_soon_threadsafe. A process where no socket
+ever connected (manage.py shell, a management command, WSGI) has no such
+loop, so the job is delivered right away on the publishing thread instead:
+a worker started on a temporary loop would die with it.
+
+stats() reports queue depth and fan-out lag (time from publish to the last
+chunk of a message being handed to the channel layer).
+
+Reaction changes are not sent one by one: ReactionCoalescer collects them
+per room for REACTION_COALESCE_MS and sends the newest counts of every
+touched message as one event, so a burst of taps on a popular message
+costs the room a single broadcast.
+"""
+
+import asyncio
+import contextvars
+import logging
+import time
+from collections import deque
+from typing import Dict, List, NamedTuple, Optional
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+
+from .framing import encode_frames
+
+
+logger = logging.getLogger(__name__)
+
+
+def room_message_event(message, sender, room: str) -> Dict:
+    return {
+        "type": "chat.message",
+        "room": room,
+        "id": message.id,
+        "sender_id": sender.id,
+        "sender": sender.username,
+        "text": message.text,
+        "created_at": message.created_at.isoformat(),
+        "seq": message.change_seq,
+        "reply_to": message.reply_to_id,
+        "thread_root": message.thread_root_id,
+    }
+
+
+def message_change_event(message, room: str) -> Dict:
+    return {
+        "type": "chat.change",
+        "event": "message_changed",
+        "room": room,
+        "id": message.id,
+        "seq": message.change_seq,
+        "text": message.text,
+        "edited_at": message.edited_at.isoformat() if message.edited_at else None,
+        "deleted": message.deleted_at is not None,
+    }
+
+
+def reactions_event(room: str, counts: Dict[int, tuple]) -> Dict:
+    return {
+        "type": "chat.reactions",
+        "event": "reactions_changed",
+        "room": room,
+        "reactions": [
+            {"id": message_id, "seq": seq, "counts": reaction_counts}
+            for message_id, (seq, reaction_counts) in sorted(counts.items())
+        ],
+    }
+
+
+def group_notification_event(message, sender, group) -> Dict:
+    return {
+        "type": "message.received",
+        "event": "message_received",
+        "chat_type": "group",
+        "chat_id": group.id,
+        "message_id": message.id,
+        "sender_id": sender.id,
+        "sender": sender.username,
+        "text": message.text,
+        "created_at": message.created_at.isoformat(),
+    }
+
+
+def encoded_event(payload: Dict) -> Dict:
+    return {"type": "encoded.event", "payload": payload, "frames": encode_frames(payload)}
+
+
+class PlanJob(NamedTuple):
+    published_at: float
+    message_id: int
+    group_id: int
+    sender_id: int
+    room: str
+    room_event: Dict
+    notify_event: Dict
+
+
+class ChunkJob(NamedTuple):
+    published_at: float
+    message_id: int
+    user_ids: List[int]
+    notify_event: Dict
+
+
+class FanoutEngine:
+    """Queue + worker tasks living on the ASGI server's event loop."""
+
+    def __init__(self, workers: int, chunk_size: int):
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.jobs: Optional[asyncio.Queue] = None
+        self._loop = None
+        self._tasks: List[asyncio.Task] = []
+
+        self._lags = deque(maxlen=1000)
+        self._remaining: Dict[int, int] = {}  # message id -> chunks not yet delivered
+        self.published = 0
+        self.deliveries = 0
+
+    # ---------------- producer side ----------------
+
+    def publish_group_message(self, group, message, sender) -> None:
+        """Called from sync code; hands the job to the event loop without waiting for delivery."""
+        room = f"group_{group.id}"
+        job = PlanJob(
+            published_at=time.monotonic(),
+            message_id=message.id,
+            group_id=group.id,
+            sender_id=sender.id,
+            room=room,
+            room_event=encoded_event(room_message_event(message, sender, room)),
+            notify_event=encoded_event(group_notification_event(message, sender, group)),
+        )
+        self.published += 1
+        loop, jobs = self._loop, self.jobs
+        if loop is not None and loop.is_running():
+            try:
+                loop.call_soon_threadsafe(jobs.put_nowait, job)
+                return
+            except RuntimeError:
+                pass  # the loop closed between the check and the call
+        async_to_sync(self.deliver_now)(job)
+
+    async def ensure_running(self) -> None:
+        """Start the workers on the running loop, the server's; call from a consumer."""
+        loop = asyncio.get_running_loop()
+        if loop is self._loop:
+            return
+        # channel layers and queues are loop-bound. Workers get a fresh
+        # context so they do not inherit the caller's executor.
+        self._loop = loop
+        self.jobs = asyncio.Queue()
+        self._tasks = [loop.create_task(self._run(), context=contextvars.Context()) for _ in range(self.workers)]
+
+    async def deliver_now(self, job: PlanJob) -> None:
+        """The whole fan-out of one message, for processes without a server loop."""
+        for chunk in await self._plan(job):
+            try:
+                await self._deliver_chunk(chunk)
+            except Exception:
+                logger.exception("fan-out job failed")
+
+    # ---------------- workers ----------------
+
+    async def _run(self) -> None:
+        jobs = self.jobs
+        while True:
+            job = await jobs.get()
+            try:
+                if isinstance(job, PlanJob):
+                    for chunk in await self._plan(job):
+                        jobs.put_nowait(chunk)
+                else:
+                    await self._deliver_chunk(job)
+            except Exception:
+                logger.exception("fan-out job failed")
+            finally:
+                jobs.task_done()
+
+    async def _plan(self, job: PlanJob) -> List[ChunkJob]:
+        """Send to the room; returns the member chunks still to deliver."""
+        from . import repositories as repo
+
+        layer = get_channel_layer()
+        if layer is None:
+            return []
+        await layer.group_send(job.room, job.room_event)
+
+        member_ids = await database_sync_to_async(repo.list_group_member_ids)(
+            job.group_id, exclude_user_id=job.sender_id
+        )
+        chunks = [member_ids[i:i + self.chunk_size] for i in range(0, len(member_ids), self.chunk_size)]
+        if not chunks:
+            self._record_lag(job.published_at)
+            return []
+
+        self._remaining[job.message_id] = len(chunks)
+        return [ChunkJob(job.published_at, job.message_id, chunk, job.notify_event) for chunk in chunks]
+
+    async def _deliver_chunk(self, job: ChunkJob) -> None:
+        layer = get_channel_layer()
+        groups = [f"user_{uid}" for uid in job.user_ids]
+        try:
+            if hasattr(layer, "group_send_bulk"):
+                # chat_backend.layers: one pass for the whole chunk
+                await layer.group_send_bulk(groups, job.notify_event)
+            else:
+                for group in groups:
+                    # the same event object for every member: frames are not re-encoded
+                    await layer.group_send(group, job.notify_event)
+            self.deliveries += len(job.user_ids)
+        finally:
+            # a failed chunk is logged by the worker; the message is still done with it
+            self._remaining[job.message_id] -= 1
+            if self._remaining[job.message_id] == 0:
+                del self._remaining[job.message_id]
+                self._record_lag(job.published_at)
+        # let sockets run between chunks of a big group
+        await asyncio.sleep(0)
+
+    def _record_lag(self, published_at) -> None:
+        lag_ms = (time.monotonic() - published_at) * 1000
+        self._lags.append(lag_ms)
+        if lag_ms > settings.FANOUT_LAG_WARN_MS:
+            logger.warning("group fan-out lag %.0f ms (queue depth %d)", lag_ms, self.jobs.qsize() if self.jobs else 0)
+
+    def stats(self) -> Dict:
+        lags = sorted(self._lags)
+
+        def pick(q):
+            return round(lags[min(len(lags) - 1, int(len(lags) * q))], 1) if lags else None
+
+        return {
+            "published": self.published,
+            "deliveries": self.deliveries,
+            "queue_depth": self.jobs.qsize() if self.jobs else 0,
+            "lag_ms_p50": pick(0.5),
+            "lag_ms_p99": pick(0.99),
+            "lag_ms_max": round(lags[-1], 1) if lags else None,
+        }
+
+
+class ReactionCoalescer:
+    """Per-room window that merges reaction updates into one broadcast."""
+
+    def __init__(self, window_ms: int):
+        self.window_ms = window_ms
+        self._loop = None
+        self._pending: Dict[str, Dict[int, tuple]] = {}  # room -> message id -> (seq, counts)
+        self.updates = 0
+        self.broadcasts = 0
+
+    def bind(self, loop) -> None:
+        if loop is not self._loop:
+            # windows opened on another loop will never flush
+            self._loop = loop
+            self._pending = {}
+
+    def publish(self, room: str, message_id: int, seq: int, counts: Dict) -> None:
+        """Called from sync code; the window lives on the server loop (see FanoutEngine.publish_group_message)."""
+        loop = self._loop
+        if loop is not None and loop.is_running():
+            try:
+                loop.call_soon_threadsafe(self.add, room, message_id, seq, counts)
+                return
+            except RuntimeError:
+                pass  # the loop closed between the check and the call
+        # no server loop: no window to join, broadcast this update by itself
+        self.updates += 1
+        layer = get_channel_layer()
+        if layer is not None:
+            self.broadcasts += 1
+            async_to_sync(layer.group_send)(room, encoded_event(reactions_event(room, {message_id: (seq, counts)})))
+
+    def add(self, room: str, message_id: int, seq: int, counts: Dict) -> None:
+        """Runs on the bound loop."""
+        self.updates += 1
+        pending = self._pending.get(room)
+        if pending is None:
+            pending = self._pending[room] = {}
+            self._loop.create_task(self._flush(room), context=contextvars.Context())
+        # commits can reach us out of order: the higher seq is the newer state
+        if message_id not in pending or pending[message_id][0] < seq:
+            pending[message_id] = (seq, counts)
+
+    async def _flush(self, room: str) -> None:
+        await asyncio.sleep(self.window_ms / 1000)
+        pending = self._pending.pop(room, None)
+        layer = get_channel_layer()
+        if pending and layer is not None:
+            self.broadcasts += 1
+            await layer.group_send(room, encoded_event(reactions_event(room, pending)))
+
+
+engine = FanoutEngine(settings.FANOUT_WORKERS, settings.FANOUT_CHUNK_SIZE)
+reactions = ReactionCoalescer(settings.REACTION_COALESCE_MS)
+
+
+async def ensure_running() -> None:
+    """Bind fan-out and reaction windows to the server's loop; every socket calls this on connect."""
+    await engine.ensure_running()
+    reactions.bind(asyncio.get_running_loop())
+
+
+def publish_group_message(group, message, sender) -> None:
+    """Queue room + member fan-out for a new group message once it is committed."""
+    transaction.on_commit(lambda: engine.publish_group_message(group, message, sender))
+
+
+def publish_direct_message(chat, message, sender) -> None:
+    """Send a new direct message to the room's subscribers once it is committed."""
+    room = f"direct_{chat.id}"
+    event = room_message_event(message, sender, room)
+
+    def send():
+        layer = get_channel_layer()
+        if layer is not None:
+            async_to_sync(layer.group_send)(room, event)
+
+    transaction.on_commit(send)
+
+
+def publish_message_change(chat_type: str, chat_id: int, message) -> None:
+    """Broadcast an edit or delete to the room once it is committed.
+
+    Only room subscribers get it: members who are not looking at the room
+    catch up through the changes endpoint when they open it.
+    """
+    room = f"{chat_type}_{chat_id}"
+    event = encoded_event(message_change_event(message, room))
+
+    def send():
+        layer = get_channel_layer()
+        if layer is not None:
+            async_to_sync(layer.group_send)(room, event)
+
+    transaction.on_commit(send)
+
+
+def publish_reactions(chat_type: str, chat_id: int, message) -> None:
+    """Queue the message's new reaction counts for the room's next coalesced broadcast."""
+    room = f"{chat_type}_{chat_id}"
+    seq, counts = message.change_seq, dict(message.reaction_counts)
+    transaction.on_commit(lambda: reactions.publish(room, message.id, seq, counts))
+
+
+def stats() -> Dict:
+    return engine.stats()
@@ -0,0 +1,233 @@
+"""Frame encoding shared by the WebSocket consumers.
+
+Encoding is chosen by WebSocket subprotocol negotiation:
+
+    chat.json.v1      JSON text frames (default, also used when none is offered)
+    chat.msgpack.v1   MessagePack binary frames in both directions, with the
+                      common field names and event types replaced by small
+                      integer tags (FIELD_TAGS / VALUE_TAGS)
+
+Clients can also opt in to batching with ?batch=1 on the socket URL: events
+queued within WS_BATCH_WINDOW_MS of the first one are then sent together as
+one array frame, which saves per-frame overhead and gives permessage-deflate
+more to work with in busy rooms.
+
+A window of 0 flushes on the next loop iteration. Channels dispatches one
+channel-layer message per few iterations, so in practice a small window
+(a few ms) is what lets a burst end up in one frame.
+"""
+
+import asyncio
+import json
+import logging
+from typing import Any, Dict, List, Optional
+from urllib.parse import parse_qs
+
+import msgpack
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+JSON_SUBPROTOCOL = "chat.json.v1"
+MSGPACK_SUBPROTOCOL = "chat.msgpack.v1"
+
+# Tags are part of the wire protocol: only ever append, never renumber.
+FIELD_TAGS = {
+    "type": 0,
+    "event": 1,
+    "id": 2,
+    "sender_id": 3,
+    "sender": 4,
+    "text": 5,
+    "created_at": 6,
+    "chat_type": 7,
+    "chat_id": 8,
+    "message_id": 9,
+    "group_id": 10,
+    "group_name": 11,
+    "added_by_id": 12,
+    "added_by_username": 13,
+    "user_id": 14,
+    "room": 15,
+    "action": 16,
+    "error": 17,
+    "seq": 18,
+    "edited_at": 19,
+    "deleted": 20,
+    "reply_to": 21,
+    "thread_root": 22,
+    "reply_count": 23,
+    "reactions": 24,
+    "client_msg_id": 25,
+    "duplicate": 26,
+    "delivery_id": 27,
+}
+VALUE_TAGS = {
+    "type": {"chat.message": 1, "message.received": 2, "group.added": 3, "chat.change": 4, "chat.reactions": 5},
+    "event": {
+        "message_received": 1,
+        "group_added": 2,
+        "notifications_connected": 3,
+        "subscribed": 4,
+        "unsubscribed": 5,
+        "error": 6,
+        "message_changed": 7,
+        "reactions_changed": 8,
+        "message_ack": 9,
+        "ping": 10,
+        "pong": 11,
+    },
+    "action": {"subscribe": 1, "unsubscribe": 2, "send": 3, "ping": 4, "pong": 5, "ack": 6},
+    "chat_type": {"direct": 1, "group": 2},
+}
+
+_FIELD_NAMES = {tag: name for name, tag in FIELD_TAGS.items()}
+_VALUE_NAMES = {field: {tag: v for v, tag in tags.items()} for field, tags in VALUE_TAGS.items()}
+
+
+def tag_event(event: Dict) -> Dict:
+    out = {}
+    for key, value in event.items():
+        values = VALUE_TAGS.get(key)
+        if values is not None:
+            value = values.get(value, value)
+        out[FIELD_TAGS.get(key, key)] = value
+    return out
+
+
+def untag_event(event: Dict) -> Dict:
+    out = {}
+    for key, value in event.items():
+        name = _FIELD_NAMES.get(key, key)
+        values = _VALUE_NAMES.get(name)
+        if values is not None:
+            value = values.get(value, value)
+        out[name] = value
+    return out
+
+
+class JsonCodec:
+    subprotocol = JSON_SUBPROTOCOL
+    binary = False
+
+    @staticmethod
+    def encode(payload: Any) -> str:
+        return json.dumps(payload)
+
+    @staticmethod
+    def decode(frame: str) -> Any:
+        return json.loads(frame)
+
+
+class MsgpackCodec:
+    subprotocol = MSGPACK_SUBPROTOCOL
+    binary = True
+
+    @staticmethod
+    def encode(payload: Any) -> bytes:
+        if isinstance(payload, list):
+            return msgpack.packb([tag_event(e) for e in payload])
+        return msgpack.packb(tag_event(payload))
+
+    @staticmethod
+    def decode(frame: bytes) -> Any:
+        data = msgpack.unpackb(frame, strict_map_key=False)
+        return untag_event(data) if isinstance(data, dict) else data
+
+
+CODECS = {c.subprotocol: c for c in (JsonCodec, MsgpackCodec)}
+
+
+def encode_frames(payload: Dict) -> Dict:
+    """Encode a payload once per subprotocol, for events shared by many sockets."""
+    return {sub: codec.encode(payload) for sub, codec in CODECS.items()}
+
+
+class FramedSendMixin:
+    """Mixin for AsyncWebsocketConsumer.
+
+    Call setup_framing() at the start of connect(), accept with
+    accept(self.frame_subprotocol), send with send_event() and parse incoming
+    frames with receive_frame(). Call stop_framing() in disconnect().
+    """
+
+    batch_events = False
+    _flush_task: Optional[asyncio.Task] = None
+    codec = JsonCodec
+    frame_subprotocol: Optional[str] = None
+
+    def setup_framing(self):
+        query_string = self.scope.get("query_string", b"")
+        if b"batch=" in query_string:
+            query = parse_qs(query_string.decode())
+            if query.get("batch", ["0"])[0] in ("1", "true"):
+                self.batch_events = True
+                self._pending: List[Dict] = []
+
+        # first offered subprotocol we speak wins; no offer means plain JSON
+        for offered in self.scope.get("subprotocols", []):
+            if offered in CODECS:
+                self.codec = CODECS[offered]
+                self.frame_subprotocol = offered
+                break
+
+    def decode_frame(self, text_data=None, bytes_data=None) -> Optional[Dict]:
+        """The frame as an event; None for anything that is not a map (garbage, truncated, a bare value)."""
+        try:
+            data = self.codec.decode(bytes_data if bytes_data is not None else text_data)
+        except (ValueError, TypeError, msgpack.UnpackException):
+            return None
+        return data if isinstance(data, dict) else None
+
+    async def receive_frame(self, text_data=None, bytes_data=None) -> Optional[Dict]:
+        """decode_frame(), answering a frame that is not an event with an error instead of failing."""
+        data = self.decode_frame(text_data, bytes_data)
+        if data is None:
+            await self.send_event({"event": "error", "error": "invalid_frame"})
+        return data
+
+    async def _send_payload(self, payload):
+        frame = self.codec.encode(payload)
+        if self.codec.binary:
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    async def send_event(self, event: Dict):
+        if not self.batch_events:
+            await self._send_payload(event)
+            return
+
+        self._pending.append(event)
+        if len(self._pending) == 1:
+            # first event of a batch: start the window; the task is kept so
+            # it is not collected mid-window and can be cancelled on disconnect
+            self._flush_task = asyncio.get_running_loop().create_task(self._flush_pending())
+
+    def stop_framing(self):
+        """Drop a batch still waiting for its window: the socket is gone."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+
+    async def encoded_event(self, event: Dict):
+        """Channel-layer handler for events carrying pre-encoded frames (see fanout.py)."""
+        frame = event["frames"].get(self.codec.subprotocol)
+        if frame is None or self.batch_events:
+            await self.send_event(event["payload"])
+        elif self.codec.binary:
+            await self.send(bytes_data=frame)
+        else:
+            await self.send(text_data=frame)
+
+    async def _flush_pending(self):
+        await asyncio.sleep(settings.WS_BATCH_WINDOW_MS / 1000)
+        events, self._pending = self._pending, []
+        self._flush_task = None
+        if events:
+            try:
+                await self._send_payload(events)
+            except Exception:
+                # nobody awaits this task; report here rather than at collection
+                logger.warning("sending a batch of %d events failed", len(events), exc_info=True)
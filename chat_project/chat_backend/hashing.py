@@ -0,0 +1,138 @@
+"""Password hashing off the request thread.
+
+PBKDF2 holds the GIL for the whole derivation, so running it inline in a
+view stalls every other request and socket handled by the same worker.
+Hashing and verification are sent to a small process pool instead. The
+pool is bounded: when more than PASSWORD_HASH_MAX_PENDING jobs are in
+flight, new jobs are refused with PoolSaturated so the view can answer 429
+instead of queueing without limit. A job keeps its slot until the worker is
+done with it, even if the request stopped waiting.
+
+If a worker dies (e.g. OOM-killed) the pool is broken for good: it is
+dropped, the request gets PoolSaturated, and the next one starts a new pool.
+"""
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Tuple
+
+from django.conf import settings
+
+
+class PoolSaturated(Exception):
+    """Raised when the hashing pool has no free admission slots."""
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+_slots: Optional[threading.BoundedSemaphore] = None
+
+
+def _init_worker(settings_module: str) -> None:
+    # workers are spawned, so Django has to be configured again in the child
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", settings_module)
+    import django
+
+    django.setup()
+
+
+def _make_password(raw_password: str) -> str:
+    from django.contrib.auth.hashers import make_password
+
+    return make_password(raw_password)
+
+
+def _check_password(raw_password: str, encoded: str) -> Tuple[bool, Optional[str]]:
+    """Verify in the worker; also rehash there if the stored hash is outdated."""
+    from django.contrib.auth.hashers import check_password, make_password
+
+    rehashed = []
+    ok = check_password(
+        raw_password,
+        encoded,
+        setter=lambda raw: rehashed.append(make_password(raw)),
+    )
+    return ok, (rehashed[0] if rehashed else None)
+
+
+def _get_pool() -> Optional[ProcessPoolExecutor]:
+    global _pool, _slots
+
+    workers = getattr(settings, "PASSWORD_HASH_WORKERS", 0)
+    if workers <= 0:
+        return None
+
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _slots = threading.BoundedSemaphore(
+                    getattr(settings, "PASSWORD_HASH_MAX_PENDING", workers * 4)
+                )
+                _pool = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(os.environ.get("DJANGO_SETTINGS_MODULE", "chat_project.settings"),),
+                )
+    return _pool
+
+
+def _run(fn, *args):
+    pool = _get_pool()
+    if pool is None:
+        # pool disabled (PASSWORD_HASH_WORKERS = 0): hash inline
+        return fn(*args)
+
+    slots = _slots  # a replacement pool comes with its own
+    if not slots.acquire(blocking=False):
+        raise PoolSaturated()
+
+    try:
+        future = pool.submit(fn, *args)
+    except BrokenProcessPool:
+        slots.release()
+        _discard_pool(pool)
+        raise PoolSaturated()
+    # released when the worker is done, not when we stop waiting: a timed-out
+    # job still occupies the pool
+    future.add_done_callback(lambda _: slots.release())
+
+    try:
+        return future.result(timeout=getattr(settings, "PASSWORD_HASH_TIMEOUT", 10))
+    except FutureTimeout:
+        raise PoolSaturated()
+    except BrokenProcessPool:
+        _discard_pool(pool)
+        raise PoolSaturated()
+
+
+def _discard_pool(pool: ProcessPoolExecutor) -> None:
+    """Forget a broken pool so the next job builds a new one."""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def hash_password(raw_password: str) -> str:
+    return _run(_make_password, raw_password)
+
+
+def verify_password(raw_password: str, encoded: str) -> Tuple[bool, Optional[str]]:
+    """Return (ok, new_encoded). new_encoded is set when the hash should be upgraded."""
+    if not raw_password or not encoded:
+        return False, None
+    return _run(_check_password, raw_password, encoded)
+
+
+def shutdown() -> None:
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=True)
+            _pool = None
@@ -0,0 +1,189 @@
+"""Application-level heartbeat and idle reaper for the WebSocket consumers.
+
+A connection whose peer vanished without a FIN (phone out of coverage, NAT
+entry expired) never produces websocket.disconnect on its own, so its
+consumer, its channel and its group memberships would stay until the
+process restarts. Every socket consumer therefore registers with the
+process-wide Reaper once accepted, and:
+
+  - any frame the client sends marks the connection as seen;
+  - every WS_PING_INTERVAL_S the reaper sends {"event": "ping"} to sockets
+    that have been quiet for that long; clients answer {"action": "pong"}
+    (and may send {"action": "ping"} themselves, answered with a pong);
+  - sockets quiet for WS_IDLE_TIMEOUT_S are reaped: their groups are
+    discarded WS_REAP_BATCH_SIZE sockets at a time (group_discard_bulk()
+    when the channel layer has it, see layers.py) and the socket is closed
+    with IDLE_CLOSE_CODE, after which the server tears the connection down
+    and the consumer exits.
+
+The reaper is one task on the server's event loop, started by the first
+socket; there are no per-connection timers. stats() is the live/reaped
+gauge, also logged after every sweep that reaped something.
+"""
+
+import asyncio
+import contextvars
+import logging
+import time
+from typing import Dict, Iterable, List, Optional
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+IDLE_CLOSE_CODE = 4408
+PING_EVENT = {"event": "ping"}
+PONG_EVENT = {"event": "pong"}
+
+
+class HeartbeatMixin:
+    """Mixin for the socket consumers, next to FramedSendMixin.
+
+    Call start_heartbeat() after accept(), pass every decoded frame to
+    heartbeat_frame() first, list the joined groups in heartbeat_groups()
+    and leave them with leave_groups() in disconnect().
+    """
+
+    last_seen = 0.0
+    groups_left = False
+
+    def heartbeat_groups(self) -> Iterable[str]:
+        return ()
+
+    async def start_heartbeat(self) -> None:
+        self.last_seen = time.monotonic()
+        await reaper.register(self)
+
+    async def heartbeat_frame(self, data) -> bool:
+        """Note the activity; True when the frame was a ping/pong and needs nothing else."""
+        self.last_seen = time.monotonic()
+        action = data.get("action") if isinstance(data, dict) else None
+        if action == "pong":
+            return True
+        if action == "ping":
+            await self.send_event(PONG_EVENT)
+            return True
+        return False
+
+    async def leave_groups(self) -> None:
+        reaper.unregister(self)
+        if self.groups_left:
+            return  # reaped: discarded in the reaper's batch
+        self.groups_left = True
+        for group in self.heartbeat_groups():
+            await self.channel_layer.group_discard(group, self.channel_name)
+
+
+class Reaper:
+    """Registry of accepted sockets plus the sweep task that pings and reaps them."""
+
+    def __init__(self, ping_interval: float, idle_timeout: float, batch_size: int):
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.batch_size = batch_size
+        self.connections: Dict[str, HeartbeatMixin] = {}  # channel name -> consumer
+        self._peak = 0
+        self._loop = None
+        self._task: Optional[asyncio.Task] = None
+
+        self.registered = 0
+        self.reaped = 0
+        self.pings = 0
+
+    async def register(self, consumer) -> None:
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop or self._task.done():
+            # loop-bound, like the fan-out workers; fresh context for the task
+            self._loop = loop
+            self._task = loop.create_task(self._run(), context=contextvars.Context())
+        self.connections[consumer.channel_name] = consumer
+        self._peak = max(self._peak, len(self.connections))
+        self.registered += 1
+
+    def unregister(self, consumer) -> None:
+        channel_name = getattr(consumer, "channel_name", None)
+        if self.connections.get(channel_name) is consumer:
+            del self.connections[channel_name]
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            try:
+                await self.sweep()
+            except Exception:
+                logger.exception("socket sweep failed")
+
+    async def sweep(self) -> int:
+        """Ping quiet sockets and reap the dead ones. Returns the number reaped."""
+        now = time.monotonic()
+        quiet: List[HeartbeatMixin] = []
+        dead: List[HeartbeatMixin] = []
+        for consumer in self.connections.values():
+            idle = now - consumer.last_seen
+            if idle >= self.idle_timeout:
+                dead.append(consumer)
+            elif idle >= self.ping_interval:
+                quiet.append(consumer)
+
+        for i, consumer in enumerate(quiet):
+            try:
+                await consumer.send_event(PING_EVENT)
+                self.pings += 1
+            except Exception:
+                consumer.last_seen = 0.0  # cannot even queue a frame: reap it next sweep
+            if i % self.batch_size == self.batch_size - 1:
+                await asyncio.sleep(0)
+
+        for i in range(0, len(dead), self.batch_size):
+            await self._reap(dead[i:i + self.batch_size])
+            await asyncio.sleep(0)
+
+        if dead:
+            self._compact()
+            logger.info("reaped %d idle sockets (%s)", len(dead), self.stats())
+        return len(dead)
+
+    async def _reap(self, batch: List[HeartbeatMixin]) -> None:
+        pairs = []
+        for consumer in batch:
+            self.unregister(consumer)
+            if not consumer.groups_left:
+                consumer.groups_left = True
+                pairs += [(group, consumer.channel_name) for group in consumer.heartbeat_groups()]
+
+        layer = get_channel_layer()
+        if hasattr(layer, "group_discard_bulk"):
+            await layer.group_discard_bulk(pairs)
+        else:
+            for group, channel_name in pairs:
+                await layer.group_discard(group, channel_name)
+
+        for consumer in batch:
+            try:
+                await consumer.close(code=IDLE_CLOSE_CODE)
+            except Exception:
+                pass  # already gone; the groups are what mattered
+        self.reaped += len(batch)
+
+    def _compact(self) -> None:
+        # dicts never give back their table; rebuild once most of it is empty
+        if len(self.connections) < self._peak // 4:
+            self.connections = dict(self.connections)
+            self._peak = len(self.connections)
+
+    def stats(self) -> Dict:
+        return {
+            "live": len(self.connections),
+            "registered": self.registered,
+            "reaped": self.reaped,
+            "pings": self.pings,
+        }
+
+
+reaper = Reaper(settings.WS_PING_INTERVAL_S, settings.WS_IDLE_TIMEOUT_S, settings.WS_REAP_BATCH_SIZE)
+
+
+def stats() -> Dict:
+    return reaper.stats()
@@ -0,0 +1,154 @@
+"""Offline delivery: per-user notifications kept until a client acks them.
+
+The outbox (outbox.py) only reaches sockets that are connected when it
+sends, so a notification for a user who is offline used to be gone for good.
+Now outbox.notify() also writes a PendingDelivery row for the user, in the
+same transaction, and the event goes out with that row's id as
+"delivery_id". The table is capped at INBOX_MAX_PENDING rows per user (the
+oldest are dropped on insert), and rows older than INBOX_MAX_AGE_DAYS are
+neither replayed nor kept (prune_messages purges them).
+
+On connect, the notification sockets (InboxMixin) replay what is pending in
+one range read along the (user, id) index, oldest first, through
+send_event(), so ?batch=1 sockets get them coalesced. The socket remembers
+the highest delivery_id it has sent and skips live events at or below it,
+so an event that is both pending and still in the outbox is not sent twice
+on the same socket.
+
+Clients ack cumulatively, {"action": "ack", "delivery_id": N}: everything
+up to N that this socket sent. Acks do not touch the table right away. The
+process keeps the in-memory head of each user's queue (the highest acked
+id) in AckHead, which deletes the acked prefixes in one transaction every
+INBOX_ACK_FLUSH_MS; a reconnect meanwhile reads from after the head.
+
+Delivery is at least once: acks not yet flushed when the process stops, or
+taken by another process, are replayed on the next connect, and clients
+should ignore a delivery_id they have already handled.
+"""
+
+import asyncio
+import contextvars
+import logging
+from datetime import timedelta
+from typing import Dict, Optional
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+from . import repositories as repo
+
+
+logger = logging.getLogger(__name__)
+
+
+class AckHead:
+    """Highest acked delivery id per user, deleted from the table in batches by one task on the loop."""
+
+    def __init__(self, flush_ms: int):
+        self.flush_ms = flush_ms
+        self.acked: Dict[int, int] = {}
+        self._loop = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+        self.replayed = 0
+        self.acks = 0
+        self.deleted = 0
+
+    def cursor(self, user_id: int) -> int:
+        """Deliveries up to this id are acked, whether or not the table knows yet."""
+        return self.acked.get(user_id, 0)
+
+    def ack(self, user_id: int, delivery_id: int) -> None:
+        if delivery_id <= self.acked.get(user_id, 0):
+            return
+        self.acked[user_id] = delivery_id
+        self.acks += 1
+        self._ensure_running()
+        self._wakeup.set()
+
+    def _ensure_running(self) -> None:
+        loop = asyncio.get_running_loop()
+        if loop is self._loop and not self._task.done():
+            return
+        self._loop = loop
+        self._wakeup = asyncio.Event()
+        self._task = loop.create_task(self._run(), context=contextvars.Context())
+
+    async def _run(self) -> None:
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self.flush_ms / 1000)  # let the acks of the window pile up
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("flushing delivery acks failed")
+
+    async def flush(self) -> int:
+        if not self.acked:
+            return 0
+        batch = dict(self.acked)
+        deleted = await database_sync_to_async(repo.ack_pending_deliveries)(batch)
+        # keep the cursors that moved on while the delete ran
+        for user_id, delivery_id in batch.items():
+            if self.acked.get(user_id) == delivery_id:
+                del self.acked[user_id]
+        self.deleted += deleted
+        return deleted
+
+    def stats(self) -> Dict:
+        return {
+            "replayed": self.replayed,
+            "acks": self.acks,
+            "deleted": self.deleted,
+            "users_unflushed": len(self.acked),
+        }
+
+
+head = AckHead(settings.INBOX_ACK_FLUSH_MS)
+
+
+class InboxMixin:
+    """Mixin for the consumers that join user_<id>, next to FramedSendMixin.
+
+    Call replay_pending() once connected, route notification events through
+    deliver(), and actions through inbox_frame().
+    """
+
+    inbox_sent = 0  # highest delivery_id sent on this socket
+
+    async def replay_pending(self) -> None:
+        since = timezone.now() - timedelta(days=settings.INBOX_MAX_AGE_DAYS)
+        rows = await database_sync_to_async(repo.list_pending_deliveries)(
+            self.user.id, head.cursor(self.user.id), since, settings.INBOX_MAX_PENDING
+        )
+        for delivery_id, payload in rows:
+            await self.send_event({**payload, "delivery_id": delivery_id})
+        if rows:
+            self.inbox_sent = rows[-1][0]
+            head.replayed += len(rows)
+
+    async def deliver(self, event) -> None:
+        """Send a notification unless this socket already replayed it."""
+        delivery_id = event.get("delivery_id")
+        if delivery_id is not None:
+            if delivery_id <= self.inbox_sent:
+                return
+            self.inbox_sent = delivery_id
+        await self.send_event(event)
+
+    def inbox_frame(self, data) -> bool:
+        """Take an ack; True when the frame was one."""
+        if data.get("action") != "ack":
+            return False
+        delivery_id = data.get("delivery_id")
+        if isinstance(delivery_id, int) and not isinstance(delivery_id, bool) and self.user:
+            # nothing past what this socket was sent: other sockets may not have it yet
+            head.ack(self.user.id, min(delivery_id, self.inbox_sent))
+        return True
+
+
+def stats() -> Dict:
+    return {**head.stats(), "pending": repo.count_pending_deliveries()}
@@ -10,6 +10,31 @@ JWT_SECRET = "keys"  # must match login() and login_required decorator
 JWT_ALGORITHM = "HS256"
 
 
+class SocketUser:
+    """Who a socket belongs to: the two fields the consumers use, not a MyUser row.
+
+    A connection can live for days; an ORM instance (model state, password
+    hash, profile fields) would be held the whole time for an id and a name.
+    """
+
+    __slots__ = ("id", "username")
+
+    def __init__(self, id: int, username: str):
+        self.id = id
+        self.username = username
+
+    def __str__(self):
+        return self.username
+
+    def __repr__(self):
+        return f"SocketUser({self.id}, {self.username!r})"
+
+
+def token_from_scope(scope):
+    query_params = parse_qs(scope.get("query_string", b"").decode())
+    return query_params.get("token", [None])[0]
+
+
 @database_sync_to_async
 def get_user_from_token(token: str):
     if not token:
@@ -20,7 +45,8 @@ def get_user_from_token(token: str):
         user_id = payload.get("id")
         if not user_id:
             return None
-        return MyUser.objects.get(id=user_id)
+        row = MyUser.objects.filter(id=user_id).values_list("id", "username").first()
+        return SocketUser(*row) if row else None
     except Exception:
         # invalid token, expired, or user not found
         return None
@@ -31,20 +57,16 @@ class JWTAuthMiddleware:
 
     ASGI-style middleware: awaits the inner app with (scope, receive, send).
     Expects token in the WebSocket query string as ?token=<jwt>.
-    Sets scope["user"] to a MyUser instance or None.
+    Sets scope["user"] to a SocketUser or None.
     """
 
     def __init__(self, app):
         self.app = app
 
     async def __call__(self, scope, receive, send):
-        scope = dict(scope)
-
-        query_string = scope.get("query_string", b"").decode()
-        query_params = parse_qs(query_string)
-        token = query_params.get("token", [None])[0]
-
-        user = await get_user_from_token(token)
-        scope["user"] = user
+        # the server builds a scope per connection, so it is filled in place;
+        # this frame lives as long as the socket, so it keeps no copy of the
+        # scope and no locals from parsing the token
+        scope["user"] = await get_user_from_token(token_from_scope(scope))
 
         return await self.app(scope, receive, send)
@@ -0,0 +1,266 @@
+"""In-process channel layer for single-worker deployments.
+
+A drop-in for channels.layers.InMemoryChannelLayer (same options, same
+"groups" and "flush" extensions, same expiry rules) that stays cheap when a
+room has thousands of sockets:
+
+  - groups are dicts of channel -> join time, and every channel keeps the
+    groups it is in (a bare name for the usual single group), so
+    add/discard are O(1) and dropping a channel whose message expired
+    touches only its own groups instead of all;
+  - group_send delivers to every member inline (no task per member) and
+    puts the same message object in every queue; it is copied once per
+    send, not once per recipient, so receivers must treat it as read-only;
+  - a receiver that is already waiting gets the message handed straight to
+    its future, skipping the queue;
+  - each channel holds at most its capacity (ChannelFull beyond that, and
+    group_send skips full channels like the stock layer);
+  - message expiry uses timers in wheel slots of at most a second (one
+    timer per channel with queued messages), so a call only visits slots
+    that are due instead of scanning every channel, and receive() checks
+    the head of its own queue; group memberships past group_expiry are
+    dropped when a send reaches them, during the member loop it does anyway;
+  - an idle channel (one waiting receive, nothing queued) holds no deque.
+
+group_send_bulk() sends one message to many groups in a single pass; the
+group fan-out (fanout.py) uses it when the layer has it. group_discard_bulk()
+is its counterpart for the idle reaper (heartbeat.py).
+
+manage.py check_channel_layer runs the layer conformance checks and
+bench_channel_layer compares fan-out against the stock layer.
+"""
+
+import asyncio
+import heapq
+import random
+import string
+import time
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Set, Union
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+
+class _Channel:
+    __slots__ = ("queue", "waiters", "capacity")
+
+    def __init__(self, capacity: int):
+        # an idle socket's channel is one waiting receive(): no deque (~760 bytes
+        # even when empty) until a message actually has to wait in the queue
+        self.queue: Optional[deque] = None  # (expires_at, message)
+        self.waiters: List = []  # futures of blocked receive() calls, rarely more than one
+        self.capacity = capacity
+
+
+class InProcessChannelLayer(BaseChannelLayer):
+    extensions = ["groups", "flush"]
+
+    def __init__(self, expiry=60, group_expiry=86400, capacity=100, channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        # glob -> capacity; the stock layer leaves these uncompiled and get_capacity() then fails
+        self.channel_capacity = self.compile_capacities(channel_capacity or {})
+        self.group_expiry = group_expiry
+        self.tick = min(1.0, max(self.expiry / 10, 0.001))  # seconds per timer slot
+        self.channels: Dict[str, _Channel] = {}
+        self.groups: Dict[str, Dict[str, float]] = {}
+        # channel -> its group, or a set once it is in more than one (most sockets join one)
+        self._memberships: Dict[str, Union[str, Set[str]]] = {}
+        # slot -> channel names whose head message may expire in it; _due is a heap of the slots in use
+        self._slots: Dict[int, List] = {}
+        self._due: List[int] = []
+
+    # ---------------- timers ----------------
+
+    def _schedule(self, when: float, name: str) -> None:
+        slot = int(when // self.tick)
+        bucket = self._slots.get(slot)
+        if bucket is None:
+            bucket = self._slots[slot] = []
+            heapq.heappush(self._due, slot)
+        bucket.append(name)
+
+    def _expire(self) -> None:
+        now = time.time()
+        current = int(now // self.tick)
+        while self._due and self._due[0] <= current:
+            for name in self._slots.pop(heapq.heappop(self._due)):
+                self._expire_messages(name, now)
+
+    def _expire_messages(self, name: str, now: float) -> None:
+        channel = self.channels.get(name)
+        if channel is None:
+            return
+        expired = False
+        while channel.queue and channel.queue[0][0] < now:
+            channel.queue.popleft()
+            expired = True
+        if expired:
+            # like the stock layer: a channel that stops reading leaves its groups
+            for group in self._groups_of(name):
+                self._discard(group, name)
+        if channel.queue:
+            # not before the next slot, or this pass would pick it up again
+            self._schedule(max(channel.queue[0][0], now + self.tick), name)
+        elif channel.waiters:
+            channel.queue = None
+        else:
+            del self.channels[name]
+
+    # ---------------- channels ----------------
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        assert "__asgi_channel__" not in message
+        self._expire()
+        self._put(channel, dict(message), time.time() + self.expiry)
+
+    def _put(self, name: str, message: dict, expires_at: float) -> None:
+        channel = self.channels.get(name)
+        if channel is None:
+            channel = self.channels[name] = _Channel(self.get_capacity(name))
+        while channel.waiters:
+            waiter = channel.waiters.pop(0)
+            if not waiter.done():
+                waiter.set_result(message)
+                return
+        queue = channel.queue
+        if queue is None:
+            queue = channel.queue = deque()
+        if len(queue) >= channel.capacity:
+            raise ChannelFull(name)
+        if not queue:
+            # only the head can expire first; the timer re-arms for the next one
+            self._schedule(expires_at, name)
+        queue.append((expires_at, message))
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        self._expire()
+        name = channel
+        channel = self.channels.get(name)
+        if channel is not None and channel.queue and channel.queue[0][0] < time.time():
+            self._expire_messages(name, time.time())
+            channel = self.channels.get(name)
+        if channel is None:
+            channel = self.channels[name] = _Channel(self.get_capacity(name))
+        if channel.queue:
+            _, message = channel.queue.popleft()
+            if not channel.queue:
+                channel.queue = None
+                if not channel.waiters:
+                    del self.channels[name]
+            return message
+
+        waiter = asyncio.get_running_loop().create_future()
+        channel.waiters.append(waiter)
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # handed over just as we were cancelled: keep it for the next reader
+                if channel.queue is None:
+                    channel.queue = deque()
+                channel.queue.appendleft((time.time() + self.expiry, waiter.result()))
+                self._schedule(time.time() + self.expiry, name)
+            raise
+        finally:
+            try:
+                channel.waiters.remove(waiter)
+            except ValueError:
+                pass
+            if not channel.queue and not channel.waiters and self.channels.get(name) is channel:
+                del self.channels[name]
+
+    async def new_channel(self, prefix="specific."):
+        return "%s.inmemory!%s" % (prefix, "".join(random.choices(string.ascii_letters, k=12)))
+
+    # ---------------- groups ----------------
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        self.groups.setdefault(group, {})[channel] = time.time()
+        joined = self._memberships.get(channel)
+        if joined is None:
+            self._memberships[channel] = group
+        elif isinstance(joined, str):
+            if joined != group:
+                self._memberships[channel] = {joined, group}
+        else:
+            joined.add(group)
+
+    def _groups_of(self, channel: str) -> List[str]:
+        joined = self._memberships.get(channel)
+        if joined is None:
+            return []
+        return [joined] if isinstance(joined, str) else list(joined)
+
+    async def group_discard(self, group, channel):
+        self.require_valid_channel_name(channel)
+        self.require_valid_group_name(group)
+        self._discard(group, channel)
+
+    async def group_discard_bulk(self, pairs: Iterable):
+        """group_discard of many (group, channel) pairs in one call."""
+        for group, channel in pairs:
+            self.require_valid_group_name(group)
+            self._discard(group, channel)
+
+    def _discard(self, group: str, channel: str) -> None:
+        members = self.groups.get(group)
+        if members is not None and members.pop(channel, None) is not None:
+            if not members:
+                del self.groups[group]
+            joined = self._memberships[channel]
+            if isinstance(joined, str):
+                del self._memberships[channel]
+            else:
+                joined.discard(group)
+                if len(joined) == 1:
+                    self._memberships[channel] = joined.pop()
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        self.require_valid_group_name(group)
+        self._expire()
+        self._deliver(group, dict(message), time.time())
+
+    async def group_send_bulk(self, groups: Iterable[str], message):
+        """group_send of one message to many groups: validated, copied and timed once."""
+        assert isinstance(message, dict), "Message is not a dict"
+        self._expire()
+        message = dict(message)
+        now = time.time()
+        for group in groups:
+            self.require_valid_group_name(group)
+            self._deliver(group, message, now)
+
+    def _deliver(self, group: str, message: dict, now: float) -> None:
+        members = self.groups.get(group)
+        if not members:
+            return
+        expires_at = now + self.expiry
+        joined_after = now - self.group_expiry if self.group_expiry else None
+        # copied: _discard() changes the dict
+        for channel, joined in list(members.items()):
+            if joined_after is not None and joined < joined_after:
+                self._discard(group, channel)
+                continue
+            try:
+                self._put(channel, message, expires_at)
+            except ChannelFull:
+                pass
+
+    # ---------------- flush ----------------
+
+    async def flush(self):
+        self.channels = {}
+        self.groups = {}
+        self._memberships = {}
+        self._slots = {}
+        self._due = []
+
+    async def close(self):
+        pass
@@ -0,0 +1,16 @@
+"""Helpers shared by the bench_* commands."""
+
+from contextlib import contextmanager
+
+from django.db import connection
+
+
+@contextmanager
+def scratch_database():
+    """Run against a throwaway test database so benchmarks never touch real data."""
+    old_name = connection.settings_dict["NAME"]
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -0,0 +1,25 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat_backend import tiering
+
+
+class Command(BaseCommand):
+    help = "Move messages older than MESSAGE_ARCHIVE_AFTER_DAYS into per-chat segment files."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--older-than-days",
+            type=int,
+            default=settings.MESSAGE_ARCHIVE_AFTER_DAYS,
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options["older_than_days"])
+        stats = tiering.archive_cold_messages(cutoff)
+        self.stdout.write(
+            f"archived {stats['messages']} messages from {stats['chats']} chats (cutoff {cutoff.isoformat()})"
+        )
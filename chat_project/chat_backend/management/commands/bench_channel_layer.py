@@ -0,0 +1,69 @@
+import asyncio
+import time
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+
+from chat_backend.fanout import encoded_event
+from chat_backend.layers import InProcessChannelLayer
+
+
+def sample_event(i):
+    return encoded_event({
+        "type": "chat.message", "room": "group_1", "id": i, "sender_id": 7, "sender": "user7",
+        "text": "meeting moved to 5", "created_at": "2026-10-19T08:00:00+00:00", "seq": i,
+    })
+
+
+class Command(BaseCommand):
+    help = "Fan-out throughput of the stock InMemoryChannelLayer vs InProcessChannelLayer."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sockets", type=int, default=2000, help="channels in the room")
+        parser.add_argument("--messages", type=int, default=3)
+        parser.add_argument("--users", type=int, default=1000, help="user_<id> groups for the notification pass")
+
+    def handle(self, *args, **o):
+        for name, layer_class in (("stock", InMemoryChannelLayer), ("in-process", InProcessChannelLayer)):
+            room = asyncio.run(self.room(layer_class, o["sockets"], o["messages"]))
+            notify = asyncio.run(self.notify(layer_class, o["users"], o["messages"]))
+            self.stdout.write(
+                f"{name:11} room {o['sockets']} sockets: {room * 1000 / o['messages']:7.1f} ms/message "
+                f"({o['sockets'] * o['messages'] / room:9.0f} deliveries/s)   "
+                f"{o['users']} user groups: {notify * 1000 / o['messages']:7.1f} ms/message"
+            )
+
+    async def room(self, layer_class, sockets, messages):
+        """One group_send per message; every socket's consumer loop receives all of them."""
+        layer = layer_class(capacity=messages + 1)
+        channels = [await layer.new_channel() for _ in range(sockets)]
+        for channel in channels:
+            await layer.group_add("group_1", channel)
+
+        async def consumer(channel):
+            for _ in range(messages):
+                await layer.receive(channel)
+
+        readers = [asyncio.ensure_future(consumer(c)) for c in channels]
+        await asyncio.sleep(0)
+        began = time.perf_counter()
+        for i in range(messages):
+            await layer.group_send("group_1", sample_event(i))
+        await asyncio.gather(*readers)
+        return time.perf_counter() - began
+
+    async def notify(self, layer_class, users, messages):
+        """The member pass of a group message: the same event to every user_<id> group."""
+        layer = layer_class(capacity=messages + 1)
+        for uid in range(users):
+            await layer.group_add(f"user_{uid}", await layer.new_channel())
+        groups = [f"user_{uid}" for uid in range(users)]
+        began = time.perf_counter()
+        for i in range(messages):
+            event = sample_event(i)
+            if hasattr(layer, "group_send_bulk"):
+                await layer.group_send_bulk(groups, event)
+            else:
+                for group in groups:
+                    await layer.group_send(group, event)
+        return time.perf_counter() - began
@@ -0,0 +1,70 @@
+import asyncio
+import time
+
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat_backend import repositories as repo
+from chat_backend.fanout import FanoutEngine, group_notification_event
+from chat_backend.models import GroupChat, GroupMember, Message, MyUser
+from ._scratch import scratch_database
+
+
+class Command(BaseCommand):
+    help = "Fan a message out to a large group: inline per-member group_send vs the fan-out engine."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--members", type=int, default=10000)
+        parser.add_argument("--online", type=int, default=2000, help="members with a notification socket")
+        parser.add_argument("--room", type=int, default=200, help="sockets subscribed to the room")
+        parser.add_argument("--messages", type=int, default=5)
+
+    def handle(self, *args, **options):
+        with scratch_database():
+            MyUser.objects.bulk_create(
+                MyUser(username=f"fan{i}", password="x") for i in range(options["members"])
+            )
+            users = list(MyUser.objects.order_by("id"))
+            group = GroupChat.objects.create(name="big")
+            GroupMember.objects.bulk_create(GroupMember(group_chat=group, user=u) for u in users)
+            sender = users[0]
+            messages = [
+                Message.objects.create(group_chat=group, sender=sender, text=f"hello {i}")
+                for i in range(options["messages"])
+            ]
+            asyncio.run(self.run(options, group, sender, messages, users))
+
+    async def run(self, options, group, sender, messages, users):
+        layer = get_channel_layer()
+        for u in users[: options["online"]]:
+            await layer.group_add(f"user_{u.id}", await layer.new_channel())
+        for _ in range(options["room"]):
+            await layer.group_add(f"group_{group.id}", await layer.new_channel())
+
+        def inline(message):
+            # what send_direct_message_service does, once per member
+            for uid in repo.list_group_member_ids(group.id, exclude_user_id=sender.id):
+                async_to_sync(layer.group_send)(f"user_{uid}", group_notification_event(message, sender, group))
+
+        start = time.perf_counter()
+        for m in messages:
+            await sync_to_async(inline)(m)
+        inline_ms = (time.perf_counter() - start) * 1000 / len(messages)
+        self.stdout.write(f"inline: {inline_ms:.1f} ms on the request thread per message")
+
+        engine = FanoutEngine(settings.FANOUT_WORKERS, settings.FANOUT_CHUNK_SIZE)
+        await engine.ensure_running()
+        start = time.perf_counter()
+        for m in messages:
+            await sync_to_async(engine.publish_group_message)(group, m, sender)
+        publish_ms = (time.perf_counter() - start) * 1000 / len(messages)
+        await engine.jobs.join()
+
+        stats = engine.stats()
+        self.stdout.write(
+            f"engine: {publish_ms:.2f} ms on the request thread per message, "
+            f"{stats['deliveries']} deliveries, lag p50={stats['lag_ms_p50']}ms "
+            f"p99={stats['lag_ms_p99']}ms max={stats['lag_ms_max']}ms"
+        )
@@ -0,0 +1,92 @@
+import asyncio
+import contextlib
+import io
+import time
+from datetime import timedelta
+
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from chat_backend import inbox, routing, services
+from chat_backend import repositories as repo
+from chat_backend.jwt_middleware import SocketUser
+from chat_backend.models import DirectChat, GroupChat, GroupMember, Message, MyUser
+from ._scratch import scratch_database
+
+
+class Command(BaseCommand):
+    help = "What a reconnect costs: catching up chat by chat vs replaying the pending deliveries, then acking them."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--direct", type=int, default=500, help="direct chats of the reconnecting user")
+        parser.add_argument("--groups", type=int, default=200, help="groups the user is in")
+        parser.add_argument("--messages", type=int, default=100, help="direct messages sent while the user was away")
+
+    def handle(self, *args, **o):
+        with scratch_database():
+            me = MyUser.objects.create(username="away", password="x")
+            MyUser.objects.bulk_create(MyUser(username=f"peer{i}", password="x") for i in range(o["direct"]))
+            peers = list(MyUser.objects.exclude(id=me.id).order_by("id"))
+            DirectChat.objects.bulk_create(DirectChat(user1=me, user2=p) for p in peers)
+            chats = list(DirectChat.objects.filter(user1=me).select_related("user2").order_by("id"))
+            GroupChat.objects.bulk_create(GroupChat(name=f"g{i}") for i in range(o["groups"]))
+            GroupMember.objects.bulk_create(GroupMember(group_chat=g, user=me) for g in GroupChat.objects.all())
+
+            left_at = timezone.now() - timedelta(seconds=1)
+            for i in range(o["messages"]):
+                chat = chats[i * 7 % len(chats)]
+                services.send_direct_message_service(chat.user2, chat, f"while you were away {i}", None)
+
+            self.compare(me, left_at)
+            asyncio.run(self.reconnect(me, o["messages"]))
+
+    def compare(self, me, left_at):
+        def scan():
+            # without a queue: ask every chat of the user what is new since they left
+            found = 0
+            for chat_id in DirectChat.objects.filter(user1=me).values_list("id", flat=True):
+                found += len(Message.objects.filter(direct_chat_id=chat_id, created_at__gt=left_at)[:50])
+            for group_id in GroupMember.objects.filter(user=me).values_list("group_chat_id", flat=True):
+                found += len(Message.objects.filter(group_chat_id=group_id, created_at__gt=left_at)[:50])
+            return found
+
+        def replay():
+            since = timezone.now() - timedelta(days=settings.INBOX_MAX_AGE_DAYS)
+            return len(repo.list_pending_deliveries(me.id, 0, since, settings.INBOX_MAX_PENDING))
+
+        for name, catch_up in (("scan chats", scan), ("pending", replay)):
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                found = catch_up()
+                ms = (time.perf_counter() - start) * 1000
+            self.stdout.write(f"{name:10}  {found:4} notifications  {len(queries):4} queries  {ms:7.1f} ms")
+
+    async def reconnect(self, me, expected):
+        app = URLRouter(routing.websocket_urlpatterns)
+        c = WebsocketCommunicator(app, "/ws/notifications/")
+        c.scope["user"] = SocketUser(me.id, me.username)
+        with contextlib.redirect_stdout(io.StringIO()):  # the consumer prints per event
+            connected, _ = await c.connect()
+            assert connected
+            ids = []
+            # the replay, then the outbox's live copies of the same events, which are skipped
+            while not await c.receive_nothing(timeout=0.5):
+                event = await c.receive_json_from()
+                if "delivery_id" in event:
+                    ids.append(event["delivery_id"])
+            await c.send_json_to({"action": "ack", "delivery_id": ids[-1]})
+            await asyncio.sleep(0.1)
+            deleted = await inbox.head.flush()
+            await c.disconnect()
+
+        pending = await database_sync_to_async(repo.count_pending_deliveries)()
+        self.stdout.write(
+            f"reconnect: {len(ids)} delivered ({len(set(ids))} distinct, {expected} sent), "
+            f"one ack deleted {deleted}, {pending} still pending"
+        )
@@ -0,0 +1,74 @@
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+
+from chat_backend import hashing
+
+
+class Command(BaseCommand):
+    help = "Simulate a login storm and compare inline hashing with the hashing pool."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--logins", type=int, default=200)
+        parser.add_argument("--concurrency", type=int, default=32, help="request threads")
+
+    def handle(self, *args, **options):
+        encoded = make_password("storm-password")
+        logins = options["logins"]
+        concurrency = options["concurrency"]
+
+        modes = {
+            "inline": lambda: hashing._check_password("storm-password", encoded),
+            "pool": lambda: hashing.verify_password("storm-password", encoded),
+        }
+        # warm the pool so process start-up is not counted
+        hashing.verify_password("storm-password", encoded)
+
+        for name, verify in modes.items():
+            self.run_mode(name, verify, logins, concurrency)
+
+        hashing.shutdown()
+
+    def run_mode(self, name, verify, logins, concurrency):
+        rejected = 0
+        lock = threading.Lock()
+        probe = []
+        done = threading.Event()
+
+        def login():
+            nonlocal rejected
+            try:
+                verify()
+            except hashing.PoolSaturated:
+                with lock:
+                    rejected += 1
+
+        def probe_loop():
+            # stands in for the other requests on the worker: small pure-Python work
+            while not done.is_set():
+                start = time.perf_counter()
+                sum(range(2000))
+                probe.append((time.perf_counter() - start) * 1000)
+                time.sleep(0.005)
+
+        prober = threading.Thread(target=probe_loop)
+        prober.start()
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as ex:
+            for _ in range(logins):
+                ex.submit(login)
+        elapsed = time.perf_counter() - start
+        done.set()
+        prober.join()
+
+        probe.sort()
+        p99 = probe[int(len(probe) * 0.99) - 1] if probe else 0.0
+        self.stdout.write(
+            f"{name:>6}: {logins} logins in {elapsed:.2f}s "
+            f"({(logins - rejected) / elapsed:.1f}/s), 429s={rejected}, "
+            f"probe median={statistics.median(probe) if probe else 0:.3f}ms p99={p99:.3f}ms"
+        )
@@ -0,0 +1,108 @@
+import asyncio
+import os
+import shutil
+import time
+
+from django.conf import settings
+from django.core.asgi import get_asgi_application
+from django.core.management.base import BaseCommand
+
+from chat_backend.media_app import MediaFileApp
+
+
+async def not_found(scope, receive, send):
+    await send({"type": "http.response.start", "status": 404, "headers": []})
+    await send({"type": "http.response.body", "body": b""})
+
+
+class Sink:
+    """Plays the server: counts body bytes, sendfile()s zero-copy sends to /dev/null."""
+
+    def __init__(self):
+        self.bytes = 0
+        self.status = None
+        self.devnull = os.open(os.devnull, os.O_WRONLY)
+
+    async def send(self, message):
+        kind = message["type"]
+        if kind == "http.response.start":
+            self.status = message["status"]
+        elif kind == "http.response.body":
+            self.bytes += len(message.get("body", b""))
+        elif kind == "http.response.zerocopysend":
+            fd, offset, count = message["file"].fileno(), message.get("offset", 0), message["count"]
+            while count:
+                sent = os.sendfile(self.devnull, fd, offset, count)
+                offset, count, self.bytes = offset + sent, count - sent, self.bytes + sent
+
+
+def request_receiver():
+    """The request body once; after that, a client that never disconnects."""
+    sent = False
+
+    async def receive():
+        nonlocal sent
+        if sent:
+            await asyncio.Event().wait()
+        sent = True
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    return receive
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare serving /media/ files through Django's static view with the ASGI media app "
+        "(mmap chunks, and sendfile via the zero-copy extension)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--large-mb", type=int, default=64, help="size of the large file")
+        parser.add_argument("--large-requests", type=int, default=20)
+        parser.add_argument("--small-kb", type=int, default=40, help="size of the small file (a thumbnail)")
+        parser.add_argument("--small-requests", type=int, default=2000)
+
+    def handle(self, *args, **o):
+        if not settings.DEBUG:
+            self.stderr.write("Django only routes /media/ with DEBUG on; the django column will be 404s")
+        folder = os.path.join(settings.MEDIA_ROOT, "bench_media")
+        os.makedirs(folder, exist_ok=True)
+        files = {"large": o["large_mb"] * 1024 * 1024, "small": o["small_kb"] * 1024}
+        for label, size in files.items():
+            with open(os.path.join(folder, f"{label}.bin"), "wb") as f:
+                f.write(os.urandom(size))
+
+        apps = {
+            "django": get_asgi_application(),
+            "media_app (mmap)": MediaFileApp(not_found),
+            "media_app (sendfile)": MediaFileApp(not_found),
+        }
+        try:
+            for label, requests in (("large", o["large_requests"]), ("small", o["small_requests"])):
+                self.stdout.write(f"{label} file, {files[label]} bytes x {requests}:")
+                for name, app in apps.items():
+                    extensions = {"http.response.zerocopysend": {}} if "sendfile" in name else {}
+                    elapsed, sink = asyncio.run(self.run(app, f"{settings.MEDIA_URL}bench_media/{label}.bin", requests, extensions))
+                    if sink.status != 200:
+                        self.stdout.write(f"  {name:22} status {sink.status}")
+                        continue
+                    self.stdout.write(
+                        f"  {name:22} {requests / elapsed:8.0f} req/s {sink.bytes / elapsed / 1e6:9.0f} MB/s"
+                    )
+        finally:
+            shutil.rmtree(folder)
+
+    async def run(self, app, path, requests, extensions):
+        sink = Sink()
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+            "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"",
+            "root_path": "", "headers": [(b"host", b"localhost")], "server": ("localhost", 80),
+            "client": ("127.0.0.1", 1), "extensions": extensions,
+        }
+        began = time.perf_counter()
+        for _ in range(requests):
+            await app(dict(scope), request_receiver(), sink.send)
+        elapsed = time.perf_counter() - began
+        os.close(sink.devnull)
+        return elapsed, sink
@@ -0,0 +1,63 @@
+import hashlib
+import time
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+
+from chat_backend import media
+from chat_backend.models import Message
+from chat_backend.views import _message_json
+
+
+def history_rows(count, files_every):
+    created = datetime(2026, 10, 19, tzinfo=timezone.utc)
+    rows = []
+    for i in range(count):
+        name = None
+        if i % files_every == 0:
+            digest = hashlib.sha256(str(i % 500).encode()).hexdigest()  # forwarded media repeats
+            name = f"chat_media/{digest[:2]}/{digest}.jpg"
+        rows.append({
+            "id": i, "sender_id": 1 + i % 20, "sender": f"user{i % 20}", "text": "see you at 5",
+            "file": name, "created_at": created, "seq": i, "edited_at": None, "deleted": False,
+            "reply_to": None, "thread_root": None, "reply_count": 0, "reactions": {},
+        })
+    return rows
+
+
+class Command(BaseCommand):
+    help = "Time serializing one history page: FieldFile + build_absolute_uri per row vs cached media_url()."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=10000)
+        parser.add_argument("--files-every", type=int, default=3, help="one row in N has an attachment")
+        parser.add_argument("--rounds", type=int, default=5)
+
+    def handle(self, *args, **o):
+        rows = history_rows(o["rows"], o["files_every"])
+        field = Message._meta.get_field("file")
+        factory = RequestFactory()
+
+        def before(request):
+            # the old shape: services returned FieldFile, the view built each URL
+            out = []
+            for row in rows:
+                f = field.attr_class(None, field, row["file"]) if row["file"] else None
+                out.append({**row, "file": None, "file_url": request.build_absolute_uri(f.url) if f else None})
+            return out
+
+        def after(request):
+            return [_message_json(request, row) for row in rows]
+
+        assert [r["file_url"] for r in before(factory.get("/"))] == [r["file_url"] for r in after(factory.get("/"))]
+        for label, fn in (("FieldFile + build_absolute_uri", before), ("name + media_url()", after)):
+            best = min(self.timed(fn, factory.get("/")) for _ in range(o["rounds"]))
+            self.stdout.write(f"{label:32} {best * 1000:8.1f} ms per {len(rows)}-row page")
+        self.stdout.write(f"url cache: {len(media._urls)} entries, {media._urls.hits} hits, {media._urls.misses} misses")
+
+    @staticmethod
+    def timed(fn, request):
+        began = time.perf_counter()
+        fn(request)
+        return time.perf_counter() - began
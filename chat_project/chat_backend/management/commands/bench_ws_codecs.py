@@ -0,0 +1,42 @@
+import json
+import time
+
+import msgpack
+from django.core.management.base import BaseCommand
+
+from chat_backend.framing import JsonCodec, MsgpackCodec
+from .bench_ws_egress import sample_events
+
+
+class Command(BaseCommand):
+    help = "Compare JSON and tagged MessagePack frames: encode/decode CPU and frame size."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--events", type=int, default=20000)
+
+    def handle(self, *args, **options):
+        events = sample_events(options["events"])
+
+        codecs = [
+            ("json", JsonCodec.encode, JsonCodec.decode),
+            ("msgpack (string keys)", msgpack.packb, msgpack.unpackb),
+            ("msgpack (tagged)", MsgpackCodec.encode, MsgpackCodec.decode),
+        ]
+
+        self.stdout.write(f"{len(events)} events")
+        for name, encode, decode in codecs:
+            start = time.process_time()
+            frames = [encode(e) for e in events]
+            encode_cpu = time.process_time() - start
+
+            start = time.process_time()
+            decoded = [decode(f) for f in frames]
+            decode_cpu = time.process_time() - start
+
+            assert decoded[0] == json.loads(json.dumps(events[0]))
+            size = sum(len(f) for f in frames) / len(frames)
+            self.stdout.write(
+                f"{name:>22}: {size:6.1f} bytes/frame, "
+                f"encode {encode_cpu * 1e6 / len(events):5.2f} us, "
+                f"decode {decode_cpu * 1e6 / len(events):5.2f} us"
+            )
@@ -0,0 +1,103 @@
+import json
+import random
+import time
+import zlib
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+
+def sample_events(count, seed=1):
+    rng = random.Random(seed)
+    words = ["ok", "see you", "lol", "on my way", "what time?", "meeting moved to 5", "👍", "sure"]
+    events = []
+    for i in range(count):
+        if i % 4 == 0:
+            events.append({
+                "type": "message.received",
+                "event": "message_received",
+                "chat_type": "direct",
+                "chat_id": rng.randint(1, 500),
+                "message_id": 100000 + i,
+                "sender_id": rng.randint(1, 5000),
+                "sender": f"user{rng.randint(1, 5000)}",
+                "text": rng.choice(words),
+                "created_at": f"2026-10-19T08:{i // 60 % 60:02d}:{i % 60:02d}.{rng.randint(0, 999999):06d}+00:00",
+            })
+        else:
+            events.append({
+                "type": "chat.message",
+                "id": 100000 + i,
+                "sender_id": rng.randint(1, 50),
+                "sender": f"user{rng.randint(1, 50)}",
+                "text": " ".join(rng.choice(words) for _ in range(rng.randint(1, 4))),
+                "created_at": f"2026-10-19T08:{i // 60 % 60:02d}:{i % 60:02d}.{rng.randint(0, 999999):06d}+00:00",
+            })
+    return events
+
+
+def deflate_frame(compressor, payload):
+    # RFC 7692: sync flush and drop the trailing 00 00 ff ff
+    return compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)[:-4]
+
+
+def new_compressor():
+    return zlib.compressobj(
+        zlib.Z_DEFAULT_COMPRESSION,
+        zlib.DEFLATED,
+        -settings.WS_DEFLATE_WINDOW_BITS,
+        settings.WS_DEFLATE_MEM_LEVEL,
+    )
+
+
+class Command(BaseCommand):
+    help = "Compare bytes per message and CPU per message for WebSocket egress modes."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--events", type=int, default=20000)
+        parser.add_argument("--batch", type=int, default=8, help="events per tick in batched modes")
+
+    def handle(self, *args, **options):
+        events = sample_events(options["events"])
+        batch = options["batch"]
+
+        def plain():
+            return [json.dumps(e).encode() for e in events]
+
+        def deflate_fresh():
+            # no context takeover: a new compressor per frame
+            return [deflate_frame(new_compressor(), json.dumps(e).encode()) for e in events]
+
+        def deflate_context():
+            c = new_compressor()
+            return [deflate_frame(c, json.dumps(e).encode()) for e in events]
+
+        def batched():
+            return [json.dumps(events[i:i + batch]).encode() for i in range(0, len(events), batch)]
+
+        def batched_deflate():
+            c = new_compressor()
+            return [
+                deflate_frame(c, json.dumps(events[i:i + batch]).encode())
+                for i in range(0, len(events), batch)
+            ]
+
+        modes = [
+            ("json", plain),
+            ("deflate, no context takeover", deflate_fresh),
+            ("deflate, context takeover", deflate_context),
+            (f"batched x{batch}", batched),
+            (f"batched x{batch} + deflate", batched_deflate),
+        ]
+
+        self.stdout.write(f"{len(events)} events, window_bits={settings.WS_DEFLATE_WINDOW_BITS}")
+        for name, fn in modes:
+            start = time.process_time()
+            frames = fn()
+            cpu = time.process_time() - start
+            # 2-byte header for payloads < 126 bytes, 4 bytes up to 64KB
+            wire = sum(len(f) + (2 if len(f) < 126 else 4) for f in frames)
+            self.stdout.write(
+                f"{name:>30}: {wire / len(events):7.1f} bytes/msg on the wire, "
+                f"{cpu * 1e6 / len(events):6.2f} us/msg, {len(frames)} frames"
+            )
@@ -0,0 +1,85 @@
+import asyncio
+import contextlib
+import gc
+import io
+import os
+import resource
+from datetime import datetime, timedelta
+
+import jwt
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from chat_backend import routing
+from chat_backend.jwt_middleware import JWT_ALGORITHM, JWT_SECRET, JWTAuthMiddleware
+from chat_backend.models import MyUser
+from ._scratch import scratch_database
+
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # peak, not current, but it only grows here
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+async def bare_socket(scope, receive, send):
+    """What the test harness costs by itself: accept, then wait for the disconnect."""
+    await receive()
+    await send({"type": "websocket.accept"})
+    while (await receive())["type"] != "websocket.disconnect":
+        pass
+
+
+class Command(BaseCommand):
+    help = "Resident memory per idle WebSocket connection, through the JWT middleware and the real consumers."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sockets", type=int, default=10000)
+        parser.add_argument("--path", default="/ws/notifications/", help="e.g. /ws/multiplex/ or /ws/chat/direct/1/")
+
+    def handle(self, *args, **o):
+        with scratch_database():
+            MyUser.objects.bulk_create(MyUser(username=f"idle{i}", password="x") for i in range(o["sockets"]))
+            exp = datetime.utcnow() + timedelta(hours=1)
+            tokens = [
+                jwt.encode({"id": uid, "exp": exp}, JWT_SECRET, algorithm=JWT_ALGORITHM)
+                for uid in MyUser.objects.values_list("id", flat=True)
+            ]
+            app = JWTAuthMiddleware(URLRouter(routing.websocket_urlpatterns))
+
+            # with DEBUG every connect's user query is logged (up to 9000): not per-socket state
+            with override_settings(DEBUG=False):
+                harness, total = asyncio.run(self.run(app, tokens, o["path"]))
+            ours = total - harness
+            self.stdout.write(f"harness only   {harness:8.0f} B/socket")
+            self.stdout.write(f"with app       {total:8.0f} B/socket")
+            self.stdout.write(
+                f"app per socket {ours:8.0f} B  ->  {ours * 100_000 / 2**20:.0f} MiB for 100k idle sockets"
+            )
+
+    async def run(self, app, tokens, path):
+        # both sets stay open until the end: freed memory would be reused and hide growth
+        harness, bare = await self.open_all(bare_socket, tokens, path)
+        total, sockets = await self.open_all(app, tokens, path)
+        for c in bare + sockets:
+            await c.disconnect()
+        return harness, total
+
+    async def open_all(self, app, tokens, path):
+        gc.collect()
+        before = rss_bytes()
+        sockets = []
+        with contextlib.redirect_stdout(io.StringIO()):  # the consumers print on connect
+            for token in tokens:
+                c = WebsocketCommunicator(app, f"{path}?token={token}")
+                connected, _ = await c.connect()
+                assert connected, path
+                sockets.append(c)
+            await asyncio.sleep(0.1)  # let connect-time sends settle
+        gc.collect()
+        return (rss_bytes() - before) / len(sockets), sockets
@@ -0,0 +1,79 @@
+import asyncio
+import contextlib
+import gc
+import io
+import tracemalloc
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+
+from chat_backend import routing
+from chat_backend.models import GroupChat, GroupMember, MyUser
+from ._scratch import scratch_database
+
+
+class Command(BaseCommand):
+    help = "Measure memory per connected user: one socket per room vs the multiplexed socket."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=50)
+        parser.add_argument("--rooms", type=int, default=40, help="active chats per user")
+
+    def handle(self, *args, **options):
+        with scratch_database():
+            users = [MyUser.objects.create(username=f"bench{i}", password="x") for i in range(options["users"])]
+            groups = [GroupChat.objects.create(name=f"room{i}") for i in range(options["rooms"])]
+            GroupMember.objects.bulk_create(
+                GroupMember(group_chat=g, user=u) for g in groups for u in users
+            )
+            group_ids = [g.id for g in groups]
+
+            for name, connect in (("per-room sockets", self.connect_per_room), ("multiplexed", self.connect_multiplexed)):
+                per_user, sockets = asyncio.run(self.measure(connect, users, group_ids))
+                self.stdout.write(
+                    f"{name:>17}: {sockets // len(users)} sockets/user, {per_user / 1024:.1f} KiB/user"
+                )
+
+    async def measure(self, connect, users, group_ids):
+        app = URLRouter(routing.websocket_urlpatterns)
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+
+        communicators = []
+        # the legacy consumers print on connect
+        with contextlib.redirect_stdout(io.StringIO()):
+            for user in users:
+                communicators += await connect(app, user, group_ids)
+
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+
+        for c in communicators:
+            await c.disconnect()
+        return used / len(users), len(communicators)
+
+    @staticmethod
+    async def open(app, user, path):
+        c = WebsocketCommunicator(app, path)
+        c.scope["user"] = user
+        connected, _ = await c.connect()
+        assert connected, path
+        return c
+
+    async def connect_per_room(self, app, user, group_ids):
+        sockets = [await self.open(app, user, "/ws/notifications/")]
+        await sockets[0].receive_output()
+        for gid in group_ids:
+            sockets.append(await self.open(app, user, f"/ws/chat/group/{gid}/"))
+        return sockets
+
+    async def connect_multiplexed(self, app, user, group_ids):
+        c = await self.open(app, user, "/ws/multiplex/")
+        for gid in group_ids:
+            await c.send_json_to({"action": "subscribe", "room": f"group_{gid}"})
+            reply = await c.receive_json_from()
+            assert reply["event"] == "subscribed", reply
+        return [c]
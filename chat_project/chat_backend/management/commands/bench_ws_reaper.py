@@ -0,0 +1,97 @@
+import asyncio
+import contextlib
+import gc
+import io
+import tracemalloc
+
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.management.base import BaseCommand
+
+from chat_backend import routing
+from chat_backend.heartbeat import IDLE_CLOSE_CODE, reaper
+from chat_backend.models import MyUser
+from ._scratch import scratch_database
+
+
+class Command(BaseCommand):
+    help = "Worker memory over rounds of socket churn where some peers vanish without closing, with and without the reaper."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sockets", type=int, default=1000, help="notification sockets opened per round")
+        parser.add_argument("--rounds", type=int, default=6)
+        parser.add_argument("--silent", type=float, default=0.3, help="share of peers that vanish (half-open)")
+        parser.add_argument("--ping-ms", type=int, default=1000, help="scaled-down WS_PING_INTERVAL_S")
+
+    def handle(self, *args, **o):
+        with scratch_database():
+            users = [MyUser.objects.create(username=f"bench{i}", password="x") for i in range(o["sockets"])]
+            for name, reaping in (("no reaper", False), ("reaper", True)):
+                self.stdout.write(name)
+                asyncio.run(self.churn(users, o, reaping))
+
+    async def churn(self, users, o, reaping):
+        ping = o["ping_ms"] / 1000
+        reaper.ping_interval = ping if reaping else 3600
+        reaper.idle_timeout = ping * 3
+        layer = get_channel_layer()
+        await layer.flush()
+        app = URLRouter(routing.websocket_urlpatterns)
+        silent_per_round = int(len(users) * o["silent"])
+
+        gc.collect()
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+        abandoned = []
+        for round_no in range(1, o["rounds"] + 1):
+            silent, live = [], []
+            for i, user in enumerate(users):
+                with contextlib.redirect_stdout(io.StringIO()):  # the consumer prints on connect
+                    c = await self.open(app, user)
+                (silent if i < silent_per_round else live).append(c)
+                if i % 50 == 49:
+                    # connecting takes a while; the peers already here keep talking meanwhile
+                    await asyncio.gather(*(c.send_json_to({"action": "ping"}) for c in live))
+            abandoned += silent
+
+            # live peers keep talking through a few idle timeouts; silent ones never answer
+            for _ in range(8):
+                await asyncio.gather(*(c.send_json_to({"action": "ping"}) for c in live))
+                await asyncio.sleep(ping)
+            for c in live:
+                assert not self.closed(c), "a live socket was reaped"
+                await c.disconnect()
+            # what the server does once the close handshake of a reaped socket times out
+            for c in abandoned:
+                if self.closed(c):
+                    await c.disconnect()
+            abandoned = [c for c in abandoned if not c.future.done()]
+
+            gc.collect()
+            used = tracemalloc.get_traced_memory()[0] - base
+            self.stdout.write(
+                f"  round {round_no}: {used / 1024:8.0f} KiB   live {len(reaper.connections):5}"
+                f"   reaped {reaper.reaped:5}   layer groups {len(layer.groups):5}   layer channels {len(layer.channels):5}"
+            )
+        tracemalloc.stop()
+        for c in abandoned:
+            await c.disconnect()
+        reaper.reaped = 0
+
+    @staticmethod
+    async def open(app, user):
+        c = WebsocketCommunicator(app, "/ws/notifications/")
+        c.scope["user"] = user
+        connected, _ = await c.connect()
+        assert connected
+        return c
+
+    @staticmethod
+    def closed(c) -> bool:
+        """Drain what the socket was sent; True if that included our idle close."""
+        closed = False
+        while not c.output_queue.empty():
+            message = c.output_queue.get_nowait()
+            closed |= message["type"] == "websocket.close" and message.get("code") == IDLE_CLOSE_CODE
+        return closed
@@ -0,0 +1,33 @@
+import sys
+import unittest
+
+from channels.layers import InMemoryChannelLayer
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+
+from chat_backend.layers import InProcessChannelLayer
+from chat_backend.tests import ChannelLayerConformanceTests
+
+
+class Command(BaseCommand):
+    help = "Run the channel layer conformance tests against our in-process layer (or --backend)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--backend", default=None, help="dotted path of the layer class; --stock for Channels' own")
+        parser.add_argument("--stock", action="store_true", help="check channels.layers.InMemoryChannelLayer")
+
+    def handle(self, *args, **o):
+        if o["stock"]:
+            layer_class = InMemoryChannelLayer
+        elif o["backend"]:
+            layer_class = import_string(o["backend"])
+        else:
+            layer_class = InProcessChannelLayer
+
+        # the tests in chat_backend/tests.py, pointed at layer_class
+        checks = type(layer_class.__name__, (ChannelLayerConformanceTests,), {"layer_class": layer_class})
+        result = unittest.TextTestRunner(stream=sys.stdout, verbosity=2).run(
+            unittest.defaultTestLoader.loadTestsFromTestCase(checks)
+        )
+        if not result.wasSuccessful():
+            raise SystemExit(1)
@@ -0,0 +1,32 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat_backend import export
+
+
+class Command(BaseCommand):
+    help = "Stream a group's or a user's message history as NDJSON (optionally gzip-compressed)."
+
+    def add_arguments(self, parser):
+        target = parser.add_mutually_exclusive_group(required=True)
+        target.add_argument("--group", type=int, help="group chat id")
+        target.add_argument("--user", type=int, help="user id: every message they sent")
+        parser.add_argument("--gzip", action="store_true")
+        parser.add_argument("-o", "--output", help="file to write (default: stdout)")
+
+    def handle(self, *args, **options):
+        if options["group"] is not None:
+            records = export.group_records(options["group"])
+        else:
+            records = export.user_records(options["user"])
+
+        out = open(options["output"], "wb") if options["output"] else sys.stdout.buffer
+        try:
+            for chunk in export.ndjson_chunks(records, compress=options["gzip"]):
+                out.write(chunk)
+        except BrokenPipeError:
+            raise CommandError("output closed")
+        finally:
+            if options["output"]:
+                out.close()
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from chat_backend import media
+
+
+def _mb(n):
+    return f"{n / (1024 * 1024):.1f} MB"
+
+
+class Command(BaseCommand):
+    help = "Report content-addressed media usage: blobs, references and the storage deduplication saves."
+
+    def handle(self, *args, **options):
+        s = media.stats()
+        self.stdout.write(f"blobs: {s['blobs']}, message references: {s['references']}")
+        self.stdout.write(f"stored: {_mb(s['stored_bytes'])}, referenced: {_mb(s['logical_bytes'])}")
+        self.stdout.write(f"saved: {_mb(s['saved_bytes'])} ({s['saved_ratio']:.1%})")
@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from chat_backend import retention
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete messages past their retention window in small throttled batches, "
+        "remove their media and stale pending notifications, then hand freed pages back to the filesystem."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=None, help="rows per transaction")
+        parser.add_argument("--pause-ms", type=int, default=None, help="sleep between batches")
+        parser.add_argument("--restart", action="store_true", help="ignore a saved checkpoint")
+        parser.add_argument("--sweep-media", action="store_true", help="also delete unreferenced chat_media files")
+        parser.add_argument("--no-vacuum", action="store_true")
+        parser.add_argument(
+            "--enable-incremental-vacuum",
+            action="store_true",
+            help="switch SQLite to auto_vacuum=INCREMENTAL (one full VACUUM, blocks writers)",
+        )
+
+    def handle(self, *args, **options):
+        if options["enable_incremental_vacuum"]:
+            retention.enable_incremental_vacuum()
+            self.stdout.write("auto_vacuum set to INCREMENTAL")
+
+        stats = retention.prune_expired_messages(
+            batch_size=options["batch_size"], pause_ms=options["pause_ms"], restart=options["restart"]
+        )
+        self.stdout.write(
+            f"{'resumed, ' if stats['resumed'] else ''}pruned {stats['messages']} messages and "
+            f"{stats['archived']} archived messages from {stats['chats']} chats, {stats['files']} files removed"
+        )
+
+        deliveries = retention.prune_pending_deliveries(batch_size=options["batch_size"], pause_ms=options["pause_ms"])
+        self.stdout.write(f"dropped {deliveries} unacked notifications past their age")
+
+        if options["sweep_media"]:
+            self.stdout.write(f"removed {retention.sweep_orphaned_media()} orphaned media files")
+
+        if not options["no_vacuum"]:
+            if retention.incremental_vacuum_enabled():
+                self.stdout.write(f"released {retention.reclaim_space(pause_ms=options['pause_ms'])} pages")
+            elif connection.vendor == "sqlite":
+                self.stdout.write("incremental vacuum is off; run once with --enable-incremental-vacuum to release space")
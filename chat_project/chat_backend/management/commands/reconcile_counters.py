@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from chat_backend import counters
+
+
+class Command(BaseCommand):
+    help = "Recompute member/message counters and last-activity fields on every chat and fix any drift."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=0, help="chats per transaction")
+
+    def handle(self, *args, **options):
+        for chat_type, (checked, repaired) in counters.reconcile(options["batch_size"]).items():
+            self.stdout.write(f"{chat_type} chats: {checked} checked, {repaired} repaired")
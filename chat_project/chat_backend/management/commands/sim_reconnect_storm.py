@@ -0,0 +1,151 @@
+import asyncio
+import random
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat_backend.admission import OVERLOADED_CLOSE_CODE, AdmissionGate, AdmissionMiddleware
+
+
+class VirtualClockLoop(asyncio.SelectorEventLoop):
+    """Event loop whose clock jumps to the next timer whenever nothing is ready.
+
+    Sleeps cost no wall time, so a storm of 50k clients over minutes of
+    simulated time runs in seconds, and the Python overhead of simulating
+    them does not count as handshake time.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._now = 0.0
+
+    def time(self):
+        return self._now
+
+    def _run_once(self):
+        if not self._ready and self._scheduled:
+            self._now = max(self._now, self._scheduled[0]._when)
+        super()._run_once()
+
+
+class Storm:
+    """Every client reconnects at t=0 against a worker whose handshakes share one database thread."""
+
+    def __init__(self, clients: int, handshake_ms: float, client_timeout: float, gate=None):
+        self.clients = clients
+        self.handshake_s = handshake_ms / 1000
+        self.client_timeout = client_timeout
+        self.db = asyncio.Lock()  # thread-sensitive sync_to_async: one query at a time
+        self.app = AdmissionMiddleware(self.handshake, gate=gate) if gate else self.handshake
+
+        self.connected_at = []
+        self.attempts = 0
+        self.refused = 0
+        self.timed_out = 0
+        self.wasted = 0  # handshakes finished for a client that had already given up
+        self.retry_hints = []  # retry_after_ms of every refusal
+        self.other_closes = []  # close codes other than a refusal
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._handshakes = set()
+
+    async def handshake(self, scope, receive, send):
+        """The token lookup and the consumer's connect(): database work, then accept."""
+        await receive()
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            async with self.db:
+                await asyncio.sleep(self.handshake_s)
+        finally:
+            self.in_flight -= 1
+        if scope["client_gone"]:
+            self.wasted += 1
+        await send({"type": "websocket.accept"})
+
+    async def client(self, began: float) -> None:
+        while True:
+            self.attempts += 1
+            scope = {"type": "websocket", "path": "/ws/notifications/", "client_gone": False}
+            sent = []
+            received = asyncio.Queue()
+            received.put_nowait({"type": "websocket.connect"})
+
+            async def send(message):
+                sent.append(message)
+
+            task = asyncio.ensure_future(self.app(scope, received.get, send))
+            self._handshakes.add(task)
+            task.add_done_callback(self._handshakes.discard)
+            try:
+                await asyncio.wait_for(asyncio.shield(task), self.client_timeout)
+            except asyncio.TimeoutError:
+                # what clients do today: give up, wait a bit, dial again
+                scope["client_gone"] = True
+                received.put_nowait({"type": "websocket.disconnect", "code": 1006})
+                self.timed_out += 1
+                await asyncio.sleep(random.uniform(1, 3))
+                continue
+
+            close = next((m for m in sent if m["type"] == "websocket.close"), None)
+            if close and close.get("code") == OVERLOADED_CLOSE_CODE:
+                self.refused += 1
+                retry_after_ms = int(close["reason"].partition("=")[2])
+                self.retry_hints.append(retry_after_ms)
+                await asyncio.sleep(retry_after_ms / 1000)
+                continue
+            if close:
+                self.other_closes.append(close.get("code"))
+                return
+            self.connected_at.append(asyncio.get_running_loop().time() - began)
+            return
+
+    async def run(self, deadline: float):
+        began = asyncio.get_running_loop().time()
+        clients = [asyncio.ensure_future(self.client(began)) for _ in range(self.clients)]
+        done, pending = await asyncio.wait(clients, timeout=deadline)
+        leftover = pending | self._handshakes
+        for task in leftover:
+            task.cancel()
+        await asyncio.gather(*leftover, return_exceptions=True)
+        return self
+
+
+class Command(BaseCommand):
+    help = "Simulate a mass reconnect (every client at once) with and without connect admission control."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--clients", type=int, default=50000)
+        parser.add_argument("--handshake-ms", type=float, default=0.5, help="database time per handshake")
+        parser.add_argument("--client-timeout", type=float, default=10.0, help="seconds before a client gives up")
+        parser.add_argument("--deadline", type=float, default=180.0, help="simulated seconds before the run is cut off")
+
+    def handle(self, *args, **o):
+        for name, gate in (("unbounded", None), ("admission", self.gate)):
+            loop = VirtualClockLoop()
+            try:
+                storm = loop.run_until_complete(
+                    Storm(o["clients"], o["handshake_ms"], o["client_timeout"], gate and gate()).run(o["deadline"])
+                )
+            finally:
+                loop.close()
+            done = sorted(storm.connected_at)
+
+            def at(q):
+                return f"{done[int(len(done) * q) - 1]:6.1f}s" if len(done) >= o["clients"] * q else "   n/a"
+
+            self.stdout.write(
+                f"{name:10} connected {len(done)}/{o['clients']}  p50 {at(0.5)}  p99 {at(0.99)}  all {at(1.0)}"
+                f"  attempts {storm.attempts}  timeouts {storm.timed_out}  refused {storm.refused}"
+                f"  wasted handshakes {storm.wasted}  peak in flight {storm.peak_in_flight}"
+            )
+
+    @staticmethod
+    def gate():
+        return AdmissionGate(
+            settings.WS_CONNECT_CONCURRENCY,
+            settings.WS_CONNECT_QUEUE,
+            settings.WS_CONNECT_QUEUE_TIMEOUT_MS,
+            settings.WS_RETRY_MIN_MS,
+            settings.WS_RETRY_MAX_MS,
+        )
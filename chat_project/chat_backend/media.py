@@ -0,0 +1,222 @@
+"""Content-addressed storage for message attachments.
+
+Uploads are hashed (SHA-256) while they stream in: the upload handlers in
+FILE_UPLOAD_HANDLERS feed every chunk they keep to a digest and leave it on
+the finished file as `.sha256`. ContentAddressedStorage then stores the
+bytes under chat_media/<2 hex>/<digest><ext>. If that blob already exists
+the upload is done: nothing is written and the message points at the
+existing file.
+
+A blob can therefore back many messages. MediaBlob rows count them (live
+and archived), maintained by repositories.py in the transaction of the
+message change:
+
+  - retain_media() when a message with a file is created;
+  - release_media() when a tombstone, retention or a dropped archive block
+    takes one away. It returns the names nothing points at any more, and
+    only those files are deleted, via delete_files() after the commit,
+    unless an upload of the same bytes touched them within the grace
+    period; the orphan sweep gets those.
+
+Files stored before this scheme have no MediaBlob row; they belong to a
+single message and are deleted with it, as before.
+
+stats() reports how much the deduplication saves.
+
+Services hand file names (plain strings) to the views, which turn them into
+absolute URLs with media_url(): MEDIA_BASE_URL (a CDN, say) or the
+request's own origin, joined with the name once per path and cached.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import time
+from typing import Dict, Iterable, Optional
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+from django.utils.deconstruct import deconstructible
+from django.utils.encoding import filepath_to_uri
+
+from .cache import BoundedLRU
+
+
+logger = logging.getLogger(__name__)
+
+BLOB_RE = re.compile(r"(?:^|/)[0-9a-f]{2}/([0-9a-f]{64})(\.[a-z0-9]{1,10})?$")
+
+
+# =========================
+# UPLOAD HANDLERS
+# =========================
+
+
+class HashingUploadMixin:
+    """Digest the chunks this handler keeps and attach it to the file it returns."""
+
+    def new_file(self, *args, **kwargs):
+        self._digest = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        passed_on = super().receive_data_chunk(raw_data, start)
+        if passed_on is None:
+            # kept by this handler, not handed to the next one
+            self._digest.update(raw_data)
+        return passed_on
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.sha256 = self._digest.hexdigest()
+        return file
+
+
+class HashingMemoryFileUploadHandler(HashingUploadMixin, MemoryFileUploadHandler):
+    pass
+
+
+class HashingTemporaryFileUploadHandler(HashingUploadMixin, TemporaryFileUploadHandler):
+    pass
+
+
+# =========================
+# STORAGE
+# =========================
+
+
+def digest_of(name: Optional[str]) -> Optional[str]:
+    """The SHA-256 a blob name was stored under; None for names stored before dedup."""
+    match = BLOB_RE.search(name or "")
+    return match.group(1) if match else None
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """FileSystemStorage that names files by content and writes each content once."""
+
+    def __init__(self, *args, **kwargs):
+        # two first uploads of the same bytes may race; both write identical content
+        kwargs.setdefault("allow_overwrite", True)
+        super().__init__(*args, **kwargs)
+        self.uploads = 0
+        self.deduplicated = 0
+        self.bytes_skipped = 0
+
+    def get_available_name(self, name, max_length=None):
+        # the final name comes from the content in _save()
+        return name
+
+    def _save(self, name, content):
+        digest = getattr(content, "sha256", None)
+        if digest is None:
+            # not from the hashing upload handlers (e.g. ContentFile): hash it here
+            hasher = hashlib.sha256()
+            for chunk in content.chunks():
+                hasher.update(chunk if isinstance(chunk, bytes) else chunk.encode())
+            digest = hasher.hexdigest()
+            content.seek(0)
+
+        ext = os.path.splitext(name)[1].lower()
+        if not re.fullmatch(r"\.[a-z0-9]{1,10}", ext):
+            ext = ""
+        blob = f"{os.path.dirname(name)}/{digest[:2]}/{digest}{ext}".lstrip("/")
+
+        self.uploads += 1
+        if self.exists(blob):
+            # fresh mtime: the orphan sweep's grace period covers the pending message
+            os.utime(self.path(blob))
+            self.deduplicated += 1
+            self.bytes_skipped += content.size or 0
+            return blob
+        return super()._save(blob, content)
+
+
+def chat_media_storage():
+    return _storage
+
+
+_storage = ContentAddressedStorage()
+
+
+def delete_files(names: Iterable[str], grace_seconds: Optional[int] = None) -> int:
+    """Delete released files, skipping any that were referenced again in the meantime.
+
+    Files touched within RETENTION_MEDIA_GRACE_SECONDS are kept as well: an
+    upload of the same bytes refreshes the blob's mtime in _save() before its
+    message row commits, so the reference check cannot see it yet. If nothing
+    claims them, sweep_orphaned_media() deletes them later.
+    """
+    from . import repositories as repo
+
+    names = set(n for n in names if n)
+    if not names:
+        return 0
+    names -= repo.referenced_blob_names(names)
+    if grace_seconds is None:
+        grace_seconds = settings.RETENTION_MEDIA_GRACE_SECONDS
+    newest = time.time() - grace_seconds
+    removed = 0
+    for name in names:
+        try:
+            if os.path.getmtime(_storage.path(name)) > newest:
+                continue
+            _storage.delete(name)
+            removed += 1
+        except FileNotFoundError:
+            pass
+        except OSError:
+            logger.warning("could not delete media file %s", name, exc_info=True)
+    return removed
+
+
+# =========================
+# URLS
+# =========================
+
+
+_urls = BoundedLRU(settings.MEDIA_URL_CACHE_SIZE)
+
+
+def media_base(request=None) -> str:
+    """MEDIA_BASE_URL, or else the request's origin + MEDIA_URL, worked out once per request.
+
+    Responses with media URLs in them vary by it: put it in their ETag keys.
+    """
+    base = settings.MEDIA_BASE_URL
+    if not base:
+        base = getattr(request, "_media_base_url", None)
+        if base is None:
+            base = request._media_base_url = request.build_absolute_uri(settings.MEDIA_URL)
+    return base
+
+
+def media_url(name: Optional[str], request=None) -> Optional[str]:
+    """Absolute URL of a stored file (message attachment or profile picture), under media_base()."""
+    if not name:
+        return None
+    base = media_base(request)
+    key = (base, name)
+    url = _urls.get(key)
+    if url is None:
+        url = base + filepath_to_uri(name)
+        _urls.set(key, url)
+    return url
+
+
+def stats() -> Dict:
+    from . import repositories as repo
+
+    usage = repo.media_usage()
+    logical = usage["logical_bytes"]
+    return {
+        **usage,
+        "saved_bytes": logical - usage["stored_bytes"],
+        "saved_ratio": round(1 - usage["stored_bytes"] / logical, 3) if logical else 0.0,
+        "uploads": _storage.uploads,
+        "uploads_deduplicated": _storage.deduplicated,
+        "upload_bytes_not_written": _storage.bytes_skipped,
+    }
@@ -0,0 +1,174 @@
+"""ASGI app that serves MEDIA_ROOT in front of Django.
+
+Requests under MEDIA_URL never reach Django (whose static view only exists
+with DEBUG and reads every file through Python). Everything else is passed
+to the wrapped app. GET and HEAD are supported, with:
+
+  - ETag (mtime + size) and Last-Modified, answering If-None-Match and
+    If-Modified-Since with 304;
+  - single byte ranges (Range / If-Range) with 206, 416 when unsatisfiable;
+  - Cache-Control: content-addressed attachments (media.py) never change
+    under their name, so they are cached as immutable.
+
+The body goes out the cheapest way the server offers: the
+http.response.zerocopysend extension (the server sendfile()s from our file
+descriptor), http.response.pathsend for whole files, and otherwise slices
+of an mmap of the file, MEDIA_CHUNK_SIZE bytes per send: one copy out of
+the page cache per chunk, no read() calls or intermediate buffers.
+
+With MEDIA_ACCEL_REDIRECT set (e.g. "/protected-media/"), the response is
+just an X-Accel-Redirect header pointing nginx at its internal location for
+the file; nginx then does ranges, conditionals and sendfile itself.
+"""
+
+import mimetypes
+import mmap
+import os
+import stat
+from email.utils import formatdate
+from typing import List, Optional, Tuple
+from urllib.parse import quote
+
+from django.conf import settings
+from django.utils.http import parse_http_date_safe
+
+from .media import digest_of
+
+
+def _header(scope, name: bytes) -> Optional[str]:
+    for key, value in scope.get("headers", ()):
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+def parse_range(value: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """(start, end exclusive) for a single "bytes=" range; None to send the whole file.
+
+    Raises ValueError when the range cannot be satisfied.
+    """
+    if not value or not value.startswith("bytes=") or "," in value:
+        return None  # absent, other units, or multiple ranges: a full 200 is allowed
+    first, _, last = value[6:].strip().partition("-")
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix <= 0:
+                raise ValueError
+            start, end = max(0, size - suffix), size
+        else:
+            start = int(first)
+            end = min(int(last) + 1, size) if last else size
+    except ValueError:
+        return None  # malformed: ignore it
+    if start >= size or start >= end:
+        raise ValueError("unsatisfiable")
+    return start, end
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == "*":
+        return True
+    # weak comparison, as If-None-Match requires
+    return any(tag.strip().removeprefix("W/") == etag for tag in header.split(","))
+
+
+class MediaFileApp:
+    def __init__(self, app, prefix: Optional[str] = None, root=None):
+        self.app = app
+        self.prefix = prefix or settings.MEDIA_URL
+        self.root = os.path.realpath(root or settings.MEDIA_ROOT)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not scope["path"].startswith(self.prefix):
+            return await self.app(scope, receive, send)
+        if scope["method"] not in ("GET", "HEAD"):
+            return await self._respond(send, 405, [(b"allow", b"GET, HEAD")])
+
+        name = scope["path"][len(self.prefix):]
+        try:
+            path = os.path.realpath(os.path.join(self.root, name))
+            f = open(path, "rb") if path.startswith(self.root + os.sep) else None
+        except (OSError, ValueError):
+            # ValueError: a NUL byte in the path (/media/a%00b)
+            f = None
+        if f is None:
+            return await self._respond(send, 404)
+        with f:
+            st = os.fstat(f.fileno())
+            if not stat.S_ISREG(st.st_mode):
+                return await self._respond(send, 404)
+            await self._serve(scope, send, f, name, st)
+
+    async def _serve(self, scope, send, f, name: str, st) -> None:
+        content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        if digest_of(name):
+            cache_control = "public, max-age=31536000, immutable"
+        else:
+            cache_control = f"public, max-age={settings.MEDIA_CACHE_MAX_AGE}"
+        headers = [(b"content-type", content_type.encode()), (b"cache-control", cache_control.encode())]
+        if settings.MEDIA_ACCEL_REDIRECT:
+            location = settings.MEDIA_ACCEL_REDIRECT + quote(name)
+            return await self._respond(send, 200, headers + [(b"x-accel-redirect", location.encode())])
+
+        size = st.st_size
+        etag = f'"{st.st_mtime_ns:x}-{size:x}"'
+        headers += [
+            (b"etag", etag.encode()),
+            (b"last-modified", formatdate(st.st_mtime, usegmt=True).encode()),
+            (b"accept-ranges", b"bytes"),
+        ]
+
+        if_none_match = _header(scope, b"if-none-match")
+        if if_none_match is not None:
+            if _etag_matches(if_none_match, etag):
+                return await self._respond(send, 304, headers)
+        else:
+            since = parse_http_date_safe(_header(scope, b"if-modified-since") or "")
+            if since is not None and int(st.st_mtime) <= since:
+                return await self._respond(send, 304, headers)
+
+        try:
+            byte_range = parse_range(_header(scope, b"range"), size)
+        except ValueError:
+            return await self._respond(send, 416, [(b"content-range", f"bytes */{size}".encode())])
+        if_range = _header(scope, b"if-range")
+        if byte_range and if_range is not None and if_range.strip() != etag:
+            since = parse_http_date_safe(if_range)
+            if since is None or int(st.st_mtime) > since:
+                byte_range = None  # the client's partial copy is stale
+
+        status, (start, end) = (206, byte_range) if byte_range else (200, (0, size))
+        if status == 206:
+            headers.append((b"content-range", f"bytes {start}-{end - 1}/{size}".encode()))
+        headers.append((b"content-length", str(end - start).encode()))
+
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        if scope["method"] == "HEAD" or end == start:
+            return await send({"type": "http.response.body", "body": b""})
+        await self._send_file(scope, send, f, start, end, size)
+
+    async def _send_file(self, scope, send, f, start: int, end: int, size: int) -> None:
+        extensions = scope.get("extensions") or {}
+        if "http.response.zerocopysend" in extensions:
+            return await send({"type": "http.response.zerocopysend", "file": f, "offset": start, "count": end - start})
+        if "http.response.pathsend" in extensions and (start, end) == (0, size):
+            return await send({"type": "http.response.pathsend", "path": f.name})
+
+        chunk = settings.MEDIA_CHUNK_SIZE
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            view = memoryview(mm)
+            try:
+                for offset in range(start, end, chunk):
+                    stop = min(offset + chunk, end)
+                    # bytes(): the server may hold the body after send() returns
+                    await send({"type": "http.response.body", "body": bytes(view[offset:stop]), "more_body": stop < end})
+            finally:
+                view.release()
+
+    async def _respond(self, send, status: int, headers: Optional[List] = None) -> None:
+        headers = list(headers or [])
+        if status >= 400:
+            headers.append((b"content-type", b"text/plain"))
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": b""})
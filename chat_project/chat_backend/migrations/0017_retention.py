@@ -0,0 +1,37 @@
+# Generated by Django 6.0.1 on 2026-10-19 04:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_backend', '0016_resourceversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RetentionCheckpoint',
+            fields=[
+                ('job', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('now', models.DateTimeField()),
+                ('chat_type', models.CharField(max_length=10)),
+                ('chat_id', models.BigIntegerField(default=0)),
+                ('deleted', models.BigIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='groupchat',
+            name='retention_days',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['group_chat', 'created_at'], name='chat_backen_group_c_d0e86d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['direct_chat', 'created_at'], name='chat_backen_direct__5e0cb8_idx'),
+        ),
+    ]
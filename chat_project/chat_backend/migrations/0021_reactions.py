@@ -0,0 +1,32 @@
+# Generated by Django 6.0.1 on 2026-10-19 04:16
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_backend', '0020_message_threads'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='reaction_counts',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.CreateModel(
+            name='Reaction',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('emoji', models.CharField(max_length=32)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reactions', to='chat_backend.message')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reactions', to='chat_backend.myuser')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('message', 'user', 'emoji'), name='unique_reaction')],
+            },
+        ),
+    ]
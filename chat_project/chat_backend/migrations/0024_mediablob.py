@@ -0,0 +1,29 @@
+# Generated by Django 6.0.1 on 2026-10-19 04:24
+
+import chat_backend.media
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_backend', '0023_outboxevent'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaBlob',
+            fields=[
+                ('name', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('digest', models.CharField(max_length=64)),
+                ('size', models.BigIntegerField()),
+                ('ref_count', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='file',
+            field=models.FileField(blank=True, null=True, storage=chat_backend.media.chat_media_storage, upload_to='chat_media/'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 6.0.1 on 2026-10-19 05:28
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat_backend', '0024_mediablob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingDelivery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('payload', models.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat_backend.myuser')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', 'id'], name='chat_backen_user_id_6224ac_idx'), models.Index(fields=['created_at'], name='chat_backen_created_cd97dc_idx')],
+            },
+        ),
+    ]
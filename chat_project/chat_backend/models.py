@@ -1,6 +1,8 @@
 from django.db import models
 from django.core.exceptions import ValidationError
 
+from .media import chat_media_storage
+
 
 class MyUser(models.Model):
     GENDER_CHOICES = (
@@ -28,6 +30,13 @@ class DirectChat(models.Model):
     user2 = models.ForeignKey(MyUser, on_delete=models.CASCADE, related_name="chats2")
     created_at = models.DateTimeField(auto_now_add=True)
 
+    # maintained by the message write path; repaired by reconcile_counters
+    message_count = models.PositiveIntegerField(default=0)
+    last_message_id = models.BigIntegerField(null=True, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    # bumped by every message create/edit/delete; see Message.change_seq
+    change_seq = models.BigIntegerField(default=0)
+
     class Meta:
         unique_together = ("user1", "user2")
 
@@ -40,6 +49,15 @@ class DirectChat(models.Model):
 class GroupChat(models.Model):
     name = models.CharField(max_length=200)
     created_at = models.DateTimeField(auto_now_add=True)
+    # messages older than this are pruned (see retention.py); null = MESSAGE_RETENTION_DAYS
+    retention_days = models.PositiveIntegerField(null=True, blank=True)
+
+    # maintained by the member and message write paths; repaired by reconcile_counters
+    member_count = models.PositiveIntegerField(default=0)
+    message_count = models.PositiveIntegerField(default=0)
+    last_message_id = models.BigIntegerField(null=True, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    change_seq = models.BigIntegerField(default=0)
 
     def __str__(self):
         return self.name
@@ -79,10 +97,52 @@ class Message(models.Model):
     sender = models.ForeignKey(MyUser, on_delete=models.CASCADE)
     # text is optional now, because a message can be only media
     text = models.TextField(blank=True)
-    # optional uploaded file (image, video, document, etc.)
-    file = models.FileField(upload_to="chat_media/", null=True, blank=True)
+    # optional uploaded file (image, video, document, etc.), stored by content (media.py)
+    file = models.FileField(upload_to="chat_media/", storage=chat_media_storage, null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    # the chat's change_seq at this message's last create/edit/delete, so
+    # clients can ask for everything that changed after the seq they hold
+    change_seq = models.BigIntegerField(default=0)
+    edited_at = models.DateTimeField(null=True, blank=True)
+    # deleted messages stay as tombstones (no text, no file) so syncing clients see the delete
+    deleted_at = models.DateTimeField(null=True, blank=True)
+
+    # threads: thread_root is copied from the parent at insert time so a whole
+    # thread is one range on (thread_root, created_at). No FK constraint: a
+    # root may live on in the archive or be pruned while its replies remain.
+    reply_to = models.ForeignKey(
+        "self", on_delete=models.DO_NOTHING, db_constraint=False, null=True, blank=True, related_name="replies"
+    )
+    thread_root = models.ForeignKey(
+        "self", on_delete=models.DO_NOTHING, db_constraint=False, db_index=False,
+        null=True, blank=True, related_name="thread_messages",
+    )
+    # on a root: number of messages in its thread
+    reply_count = models.PositiveIntegerField(default=0)
+    # {emoji: count}, rebuilt from Reaction rows whenever they change so
+    # history pages never have to join them
+    reaction_counts = models.JSONField(default=dict, blank=True)
+    # sender-chosen id that makes resends idempotent (dedupe.py)
+    client_msg_id = models.CharField(max_length=64, null=True, blank=True)
+
+    class Meta:
+        # history pages and retention both walk a chat in created_at order
+        indexes = [
+            models.Index(fields=["group_chat", "created_at"]),
+            models.Index(fields=["direct_chat", "created_at"]),
+            models.Index(fields=["group_chat", "change_seq"]),
+            models.Index(fields=["direct_chat", "change_seq"]),
+            models.Index(fields=["thread_root", "created_at"]),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["sender", "client_msg_id"],
+                condition=models.Q(client_msg_id__isnull=False),
+                name="unique_client_msg_id",
+            ),
+        ]
+
     def clean(self):
         # Exactly one of direct_chat or group_chat must be set
         if bool(self.direct_chat) == bool(self.group_chat):
@@ -90,11 +150,118 @@ class Message(models.Model):
                 "Message must belong to exactly one of direct_chat or group_chat."
             )
 
-        # At least one of text or file must be present
-        if not self.text and not self.file:
+        # At least one of text or file must be present (tombstones have neither)
+        if not self.deleted_at and not self.text and not self.file:
             raise ValidationError(
                 "Message must contain text or a file."
             )
 
     def __str__(self):
         return f"Message {self.id}"
+
+
+class Reaction(models.Model):
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name="reactions")
+    user = models.ForeignKey(MyUser, on_delete=models.CASCADE, related_name="reactions")
+    emoji = models.CharField(max_length=32)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["message", "user", "emoji"], name="unique_reaction"),
+        ]
+
+    def __str__(self):
+        return f"{self.user} {self.emoji} on {self.message_id}"
+
+
+# -------- CACHE VALIDATION --------
+
+class ResourceVersion(models.Model):
+    """Change counter per cacheable resource, e.g. "user:5" or "group:3".
+
+    Bumped by the signal receivers in versions.py and used to build ETags,
+    so a conditional GET costs one primary-key lookup.
+    """
+
+    key = models.CharField(max_length=100, primary_key=True)
+    version = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.key}@{self.version}"
+
+
+class RetentionCheckpoint(models.Model):
+    """Where an interrupted retention run (retention.py) left off.
+
+    `now` is the reference time the run computed its cutoffs from, so a
+    resumed run deletes exactly what the original one would have.
+    """
+
+    job = models.CharField(max_length=50, primary_key=True)
+    now = models.DateTimeField()
+    chat_type = models.CharField(max_length=10)
+    chat_id = models.BigIntegerField(default=0)
+    deleted = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.job} at {self.chat_type}_{self.chat_id}"
+
+
+class OutboxEvent(models.Model):
+    """A notification for one user, written in the transaction that caused it.
+
+    outbox.py delivers it to the user's notification group and deletes it;
+    a failed delivery is retried at available_at.
+    """
+
+    user = models.ForeignKey(MyUser, on_delete=models.CASCADE, related_name="+")
+    payload = models.JSONField()
+    attempts = models.PositiveIntegerField(default=0)
+    available_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        # the dispatcher reads due rows in id order
+        indexes = [
+            models.Index(fields=["available_at", "id"]),
+        ]
+
+    def __str__(self):
+        return f"outbox {self.id} -> user {self.user_id}"
+
+
+class PendingDelivery(models.Model):
+    """A notification kept for its user until a client acks it (inbox.py).
+
+    Capped per user by INBOX_MAX_PENDING and dropped after INBOX_MAX_AGE_DAYS.
+    """
+
+    user = models.ForeignKey(MyUser, on_delete=models.CASCADE, related_name="+")
+    payload = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            # a reconnect reads one user's range in id order; acks delete a prefix of it
+            models.Index(fields=["user", "id"]),
+            # age purge across all users
+            models.Index(fields=["created_at"]),
+        ]
+
+    def __str__(self):
+        return f"delivery {self.id} -> user {self.user_id}"
+
+
+class MediaBlob(models.Model):
+    """One stored attachment file and how many messages (live or archived) point at it."""
+
+    name = models.CharField(max_length=255, primary_key=True)
+    digest = models.CharField(max_length=64)
+    size = models.BigIntegerField()
+    ref_count = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.name} x{self.ref_count}"
@@ -0,0 +1,199 @@
+"""Transactional outbox for per-user notifications.
+
+Services do not call the channel layer for notifications. They write an
+OutboxEvent (repo.add_outbox_event) in the same transaction as the message
+or membership it announces, so a notification exists exactly when its
+change was committed, and the request returns without waiting on delivery.
+
+OutboxDispatcher runs on the server's event loop, where the channel layer
+lives. It is started by the first notification socket of the process and
+woken (call_soon_threadsafe, no waiting) after each commit that queued an
+event and when one of its retries falls due; it also polls every
+OUTBOX_POLL_MS for rows left by a process that died before delivering
+them. Each pass:
+
+  1. reads up to OUTBOX_BATCH_SIZE due events in id order, leaving out users
+     that have an event waiting on a retry;
+  2. sends them to user_<id> one after another; after a failure the rest of
+     that user's events in the batch are held back, so every user sees their
+     notifications in commit order;
+  3. deletes the delivered rows and reschedules the failed ones with
+     exponential backoff from OUTBOX_RETRY_BASE_MS, dropping an event (with
+     an error log) after OUTBOX_MAX_ATTEMPTS.
+
+Delivery is at least once: a crash between sending and deleting resends the
+batch. Events sent while the user had no socket are not lost either: each
+one is also a pending delivery, replayed on the next connect (inbox.py). Only processes with OUTBOX_DISPATCH enabled run a dispatcher; with a
+shared channel layer enable it in one of them.
+"""
+
+import asyncio
+import contextvars
+import logging
+import time
+from collections import deque
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import repositories as repo
+
+
+logger = logging.getLogger(__name__)
+
+
+class OutboxDispatcher:
+    """Drains the outbox table into the channel layer from a task on the event loop."""
+
+    def __init__(self, batch_size: int, poll_ms: int, max_attempts: int, retry_base_ms: int):
+        self.batch_size = batch_size
+        self.poll_ms = poll_ms
+        self.max_attempts = max_attempts
+        self.retry_base_ms = retry_base_ms
+        self._loop = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._retry_at = 0.0  # monotonic time of the earliest retry this dispatcher scheduled
+
+        self._lags = deque(maxlen=1000)
+        self.delivered = 0
+        self.retried = 0
+        self.dropped = 0
+
+    # ---------------- control ----------------
+
+    async def ensure_running(self) -> None:
+        if not settings.OUTBOX_DISPATCH:
+            return
+        loop = asyncio.get_running_loop()
+        if loop is self._loop and not self._task.done():
+            return
+        # the event and the layer are loop-bound; the task gets a fresh
+        # context so it does not inherit the caller's executor
+        self._loop = loop
+        self._wakeup = asyncio.Event()
+        self._task = loop.create_task(self._run(), context=contextvars.Context())
+
+    def wake(self) -> None:
+        """Thread-safe nudge after a commit; a no-op until a dispatcher is running."""
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+        try:
+            loop.call_soon_threadsafe(self._wakeup.set)
+        except RuntimeError:
+            pass  # loop shut down between the check and the call
+
+    # ---------------- dispatcher ----------------
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                handled = await self.drain_once()
+            except Exception:
+                logger.exception("outbox pass failed")
+                handled = 0
+            if handled >= self.batch_size:
+                await asyncio.sleep(0)  # more waiting; let sockets run first
+                continue
+            timeout = self.poll_ms / 1000
+            if self._retry_at:
+                until_retry = self._retry_at - time.monotonic()
+                if until_retry <= 0:
+                    self._retry_at = 0.0
+                timeout = max(0.0, min(timeout, until_retry))
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def drain_once(self) -> int:
+        """Deliver one batch. Returns the number of events read."""
+        layer = get_channel_layer()
+        if layer is None:
+            return 0
+        events = await database_sync_to_async(repo.list_due_outbox_events)(timezone.now(), self.batch_size)
+        if not events:
+            return 0
+
+        delivered: List[int] = []
+        failed = []
+        held = set()  # users with a failure in this batch
+        for event in events:
+            if event.user_id in held:
+                continue
+            try:
+                await layer.group_send(f"user_{event.user_id}", event.payload)
+            except Exception:
+                logger.warning("outbox event %s to user %s failed", event.id, event.user_id, exc_info=True)
+                held.add(event.user_id)
+                failed.append(event)
+            else:
+                delivered.append(event.id)
+                self._lags.append((timezone.now() - event.created_at).total_seconds() * 1000)
+
+        await database_sync_to_async(self._settle)(delivered, failed)
+        self.delivered += len(delivered)
+        return len(events)
+
+    def _settle(self, delivered: List[int], failed) -> None:
+        now = timezone.now()
+        dropped = []
+        with transaction.atomic():
+            for event in failed:
+                attempts = event.attempts + 1
+                if attempts >= self.max_attempts:
+                    logger.error("dropping outbox event %s to user %s after %d attempts", event.id, event.user_id, attempts)
+                    dropped.append(event.id)
+                    continue
+                delay = timedelta(milliseconds=self.retry_base_ms * 2 ** (attempts - 1))
+                repo.retry_outbox_event(event.id, attempts, now + delay)
+                retry_at = time.monotonic() + delay.total_seconds()
+                self._retry_at = min(self._retry_at or retry_at, retry_at)
+                self.retried += 1
+            repo.delete_outbox_events(delivered + dropped)
+        self.dropped += len(dropped)
+
+    def stats(self) -> Dict:
+        lags = sorted(self._lags)
+
+        def pick(q):
+            return round(lags[min(len(lags) - 1, int(len(lags) * q))], 1) if lags else None
+
+        return {
+            "running": self._task is not None and not self._task.done(),
+            "delivered": self.delivered,
+            "retried": self.retried,
+            "dropped": self.dropped,
+            "lag_ms_p50": pick(0.5),
+            "lag_ms_p99": pick(0.99),
+        }
+
+
+dispatcher = OutboxDispatcher(
+    settings.OUTBOX_BATCH_SIZE,
+    settings.OUTBOX_POLL_MS,
+    settings.OUTBOX_MAX_ATTEMPTS,
+    settings.OUTBOX_RETRY_BASE_MS,
+)
+
+
+def notify(user_id: int, payload: Dict) -> None:
+    """Queue a notification for user_<id>, to be delivered once the current transaction commits.
+
+    It is also kept in the user's pending deliveries until a client acks it
+    (inbox.py), and goes out with that row's id as "delivery_id".
+    """
+    delivery = repo.add_pending_delivery(user_id, payload, settings.INBOX_MAX_PENDING)
+    repo.add_outbox_event(user_id, {**payload, "delivery_id": delivery.id})
+    transaction.on_commit(dispatcher.wake)
+
+
+def stats() -> Dict:
+    return {**dispatcher.stats(), "pending": repo.count_outbox_events()}
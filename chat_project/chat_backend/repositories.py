@@ -1,8 +1,19 @@
-from typing import List, Optional, Tuple
+from datetime import datetime
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 
-from django.db.models import QuerySet
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Q, QuerySet, Subquery, Sum
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_delete, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
 
-from .models import MyUser, DirectChat, GroupChat, GroupMember, Message
+from .cache import BoundedLRU
+from . import media
+from .media import digest_of
+from .models import MyUser, DirectChat, GroupChat, GroupMember, MediaBlob, Message, OutboxEvent, PendingDelivery, Reaction
 
 
 # =========================
@@ -18,8 +29,13 @@ def get_user_by_id(user_id: int) -> MyUser:
     return MyUser.objects.get(id=user_id)
 
 
+def update_user_password(user: MyUser, encoded: str) -> None:
+    user.password = encoded
+    user.save(update_fields=["password"])
+
+
 def list_users_basic() -> QuerySet:
-    return MyUser.objects.all().values("id", "username")
+    return MyUser.objects.all().values("id", "username", "profile_pic")
 
 
 # =========================
@@ -27,21 +43,64 @@ def list_users_basic() -> QuerySet:
 # =========================
 
 
-def get_or_create_direct_chat(user1: MyUser, user2: MyUser) -> Tuple[DirectChat, bool]:
-    # keep ordering stable so unique_together works as expected
-    if user1.id > user2.id:
-        user1, user2 = user2, user1
+# (low user id, high user id) -> DirectChat id
+_direct_chat_ids = BoundedLRU(settings.DIRECT_CHAT_CACHE_SIZE)
+
+
+def direct_chat_pair(user_a_id: int, user_b_id: int) -> Tuple[int, int]:
+    return (user_a_id, user_b_id) if user_a_id <= user_b_id else (user_b_id, user_a_id)
+
 
-    chat, created = DirectChat.objects.get_or_create(user1=user1, user2=user2)
-    return chat, created
+def find_direct_chat_id(user_a_id: int, user_b_id: int) -> Optional[int]:
+    """Chat id for a pair, from the cache or one indexed lookup; None if it does not exist."""
+    pair = direct_chat_pair(user_a_id, user_b_id)
+    chat_id = _direct_chat_ids.get(pair)
+    if chat_id is None:
+        chat_id = (
+            DirectChat.objects.filter(user1_id=pair[0], user2_id=pair[1])
+            .values_list("id", flat=True)
+            .first()
+        )
+        if chat_id is not None:
+            _direct_chat_ids.set(pair, chat_id)
+    return chat_id
+
+
+def upsert_direct_chat(user_a_id: int, user_b_id: int) -> int:
+    """Create the pair's chat if missing and return its id.
+
+    INSERT ... ON CONFLICT DO NOTHING on the (user1, user2) unique index, then
+    read the row back, so two first contacts racing each other both end up
+    with the same chat instead of one failing with IntegrityError.
+    """
+    pair = direct_chat_pair(user_a_id, user_b_id)
+    DirectChat.objects.bulk_create(
+        [DirectChat(user1_id=pair[0], user2_id=pair[1])], ignore_conflicts=True
+    )
+    chat_id = DirectChat.objects.filter(user1_id=pair[0], user2_id=pair[1]).values_list("id", flat=True).get()
+    _direct_chat_ids.set(pair, chat_id)
+    return chat_id
+
+
+@receiver(post_delete, sender=DirectChat)
+def _forget_direct_chat(sender, instance, **kwargs):
+    _direct_chat_ids.pop(direct_chat_pair(instance.user1_id, instance.user2_id))
+
+
+def user_exists(user_id: int) -> bool:
+    return MyUser.objects.filter(id=user_id).exists()
 
 
 def get_direct_chat_by_id(chat_id: int) -> DirectChat:
     return DirectChat.objects.get(id=chat_id)
 
 
-def list_messages_for_direct_chat(chat: DirectChat) -> QuerySet:
-    return Message.objects.filter(direct_chat=chat).order_by("created_at")
+def is_direct_chat_participant(chat_id: int, user_id: int) -> bool:
+    return DirectChat.objects.filter(id=chat_id).filter(Q(user1_id=user_id) | Q(user2_id=user_id)).exists()
+
+
+def list_messages_for_direct_chat(chat_id: int) -> QuerySet:
+    return Message.objects.filter(direct_chat_id=chat_id).select_related("sender").order_by("created_at")
 
 
 # =========================
@@ -62,11 +121,15 @@ def get_group_by_id(group_id: int) -> GroupChat:
 
 
 def add_group_member(group: GroupChat, user: MyUser, role: str = "member") -> Tuple[GroupMember, bool]:
-    return GroupMember.objects.get_or_create(
-        group_chat=group,
-        user=user,
-        defaults={"role": role},
-    )
+    with transaction.atomic():
+        member, created = GroupMember.objects.get_or_create(
+            group_chat=group,
+            user=user,
+            defaults={"role": role},
+        )
+        if created:
+            GroupChat.objects.filter(id=group.id).update(member_count=F("member_count") + 1)
+    return member, created
 
 
 def is_group_admin(group: GroupChat, user: MyUser) -> bool:
@@ -77,6 +140,17 @@ def is_group_member(group: GroupChat, user: MyUser) -> bool:
     return GroupMember.objects.filter(group_chat=group, user=user).exists()
 
 
+def is_group_member_by_id(group_id: int, user_id: int) -> bool:
+    return GroupMember.objects.filter(group_chat_id=group_id, user_id=user_id).exists()
+
+
+def list_group_member_ids(group_id: int, exclude_user_id: Optional[int] = None) -> List[int]:
+    qs = GroupMember.objects.filter(group_chat_id=group_id)
+    if exclude_user_id is not None:
+        qs = qs.exclude(user_id=exclude_user_id)
+    return list(qs.values_list("user_id", flat=True))
+
+
 def list_group_members(group: GroupChat) -> QuerySet:
     return GroupMember.objects.filter(group_chat=group).select_related("user")
 
@@ -85,28 +159,476 @@ def list_groups_for_user(user: MyUser) -> QuerySet:
     return GroupChat.objects.filter(members__user=user)
 
 
+def list_groups_for_user_by_activity(user: MyUser) -> QuerySet:
+    """The user's groups, most recently active first (no aggregation: uses the maintained counters)."""
+    return list_groups_for_user(user).order_by(F("last_message_at").desc(nulls_last=True), "-id")
+
+
 # =========================
 # MESSAGE REPOSITORY
 # =========================
 
 
-def create_direct_message(chat: DirectChat, sender: MyUser, text: str = "", file=None) -> Message:
-    return Message.objects.create(
-        direct_chat=chat,
-        sender=sender,
-        text=text,
-        file=file,
+def _chat_model(chat_type: str):
+    return DirectChat if chat_type == "direct" else GroupChat
+
+
+def _record_new_message(chat_type: str, chat_id: int, message: Message) -> None:
+    _chat_model(chat_type).objects.filter(id=chat_id).update(
+        message_count=F("message_count") + 1,
+        last_message_id=message.id,
+        last_message_at=message.created_at,
+    )
+
+
+def record_messages_removed(chat_type: str, chat_id: int, count: int) -> None:
+    """Keep message_count in step with rows deleted outside the create path (retention)."""
+    _chat_model(chat_type).objects.filter(id=chat_id).update(
+        message_count=Greatest(F("message_count") - count, 0)
+    )
+
+
+def _next_change_seq(chat_type: str, chat_id: int, count: int = 1) -> int:
+    """Claim the chat's next `count` change sequence numbers and return the last.
+
+    Call inside the transaction of the change.
+    """
+    chats = _chat_model(chat_type).objects.filter(id=chat_id)
+    chats.update(change_seq=F("change_seq") + count)
+    return chats.values_list("change_seq", flat=True).get()
+
+
+def _create_message(
+    chat_type: str, chat_id: int, sender: MyUser, text: str, file, reply_to: Optional[Message], client_msg_id: Optional[str], **chat
+) -> Message:
+    with transaction.atomic():
+        thread_root_id = None
+        if reply_to is None:
+            seq = _next_change_seq(chat_type, chat_id)
+        else:
+            # the root's reply_count is a change too: it takes the seq before the reply's
+            seq = _next_change_seq(chat_type, chat_id, 2)
+            thread_root_id = reply_to.thread_root_id or reply_to.id
+            Message.objects.filter(id=thread_root_id).update(reply_count=F("reply_count") + 1, change_seq=seq - 1)
+
+        message = Message.objects.create(
+            **chat,
+            sender=sender,
+            text=text,
+            file=file,
+            change_seq=seq,
+            reply_to=reply_to,
+            thread_root_id=thread_root_id,
+            client_msg_id=client_msg_id,
+        )
+        _record_new_message(chat_type, chat_id, message)
+        if message.file:
+            retain_media(message.file.name, message.file.size)
+    return message
+
+
+def create_direct_message(
+    chat: DirectChat, sender: MyUser, text: str = "", file=None, reply_to: Optional[Message] = None, client_msg_id: Optional[str] = None
+) -> Message:
+    return _create_message("direct", chat.id, sender, text, file, reply_to, client_msg_id, direct_chat=chat)
+
+
+def create_group_message(
+    group: GroupChat, sender: MyUser, text: str = "", file=None, reply_to: Optional[Message] = None, client_msg_id: Optional[str] = None
+) -> Message:
+    return _create_message("group", group.id, sender, text, file, reply_to, client_msg_id, group_chat=group)
+
+
+def message_chat(message: Message) -> Tuple[str, int]:
+    if message.direct_chat_id:
+        return "direct", message.direct_chat_id
+    return "group", message.group_chat_id
+
+
+def get_message(message_id: int) -> Message:
+    return Message.objects.select_related("sender").get(id=message_id)
+
+
+def edit_message(message: Message, text: str) -> Message:
+    with transaction.atomic():
+        message.change_seq = _next_change_seq(*message_chat(message))
+        message.text = text
+        message.edited_at = timezone.now()
+        message.save(update_fields=["text", "edited_at", "change_seq"])
+    return message
+
+
+def tombstone_message(message: Message) -> bool:
+    """Blank the message and mark it deleted; the row stays so the delete can be synced.
+
+    Returns False if it was already deleted, e.g. by a concurrent retry of
+    the same request: only the call that tombstoned it may release its file.
+    """
+    with transaction.atomic():
+        deleted_at = timezone.now()
+        if not Message.objects.filter(id=message.id, deleted_at__isnull=True).update(
+            text="", file=None, deleted_at=deleted_at, reaction_counts={}
+        ):
+            return False
+        message.change_seq = _next_change_seq(*message_chat(message))
+        Message.objects.filter(id=message.id).update(change_seq=message.change_seq)
+        message.text = ""
+        message.file = None
+        message.deleted_at = deleted_at
+        message.reaction_counts = {}
+        Reaction.objects.filter(message_id=message.id).delete()
+    return True
+
+
+def lock_reactions(message: Message) -> None:
+    """Claim the message's next change seq and reload its reaction state.
+
+    The seq UPDATE locks the chat row, so a concurrent tap waits for this
+    transaction to commit and what is read after it stays current until this
+    one ends: limits checked against message.reaction_counts hold, and the
+    refresh after the row change counts every committed row. Call inside the
+    transaction, before add_reaction() or remove_reaction().
+    """
+    message.change_seq = _next_change_seq(*message_chat(message))
+    message.reaction_counts, message.deleted_at = (
+        Message.objects.filter(id=message.id).values_list("reaction_counts", "deleted_at").get()
+    )
+
+
+def _refresh_reaction_counts(message: Message) -> None:
+    """Rebuild the message's {emoji: count} from its rows; runs after the row change, under lock_reactions()."""
+    message.reaction_counts = dict(
+        Reaction.objects.filter(message_id=message.id)
+        .values("emoji")
+        .annotate(n=Count("id"))
+        .order_by("emoji")
+        .values_list("emoji", "n")
+    )
+    message.save(update_fields=["reaction_counts", "change_seq"])
+
+
+def add_reaction(message: Message, user: MyUser, emoji: str) -> bool:
+    """Returns False if the user already reacted with this emoji."""
+    with transaction.atomic():
+        _, created = Reaction.objects.get_or_create(message_id=message.id, user_id=user.id, emoji=emoji)
+        if created:
+            _refresh_reaction_counts(message)
+    return created
+
+
+def remove_reaction(message: Message, user: MyUser, emoji: str) -> bool:
+    with transaction.atomic():
+        deleted, _ = Reaction.objects.filter(message_id=message.id, user_id=user.id, emoji=emoji).delete()
+        if deleted:
+            _refresh_reaction_counts(message)
+    return bool(deleted)
+
+
+def list_message_changes(chat_type: str, chat_id: int, since: int, limit: int) -> QuerySet:
+    """Messages changed after `since`, in change order (one range scan on (chat, change_seq))."""
+    return (
+        Message.objects.filter(**_chat_filter(chat_type, chat_id), change_seq__gt=since)
+        .select_related("sender")
+        .order_by("change_seq")[:limit]
     )
 
 
-def create_group_message(group: GroupChat, sender: MyUser, text: str = "", file=None) -> Message:
-    return Message.objects.create(
-        group_chat=group,
-        sender=sender,
-        text=text,
-        file=file,
+def find_message(message_id: int) -> Optional[Message]:
+    return Message.objects.select_related("sender").filter(id=message_id).first()
+
+
+def get_chat_message(chat_type: str, chat_id: int, message_id: int) -> Message:
+    """A live message of this chat; DoesNotExist if it is elsewhere, archived or pruned."""
+    return Message.objects.only("id", "thread_root_id", "deleted_at", "created_at").get(
+        id=message_id, **_chat_filter(chat_type, chat_id)
     )
 
 
+def list_thread(root_id: int, after: Optional[Message], limit: int) -> QuerySet:
+    """Replies of a thread in created_at order, resuming after `after` (one range on the thread index)."""
+    qs = Message.objects.filter(thread_root_id=root_id)
+    if after is not None:
+        qs = qs.filter(Q(created_at__gt=after.created_at) | Q(created_at=after.created_at, id__gt=after.id))
+    return qs.select_related("sender").order_by("created_at", "id")[:limit]
+
+
+def get_change_seq(chat_type: str, chat_id: int) -> int:
+    return _chat_model(chat_type).objects.filter(id=chat_id).values_list("change_seq", flat=True).get()
+
+
 def list_messages_for_group_chat(group: GroupChat) -> QuerySet:
     return Message.objects.filter(group_chat=group).select_related("sender").order_by("created_at")
+
+
+
+# =========================
+# ARCHIVE REPOSITORY
+# =========================
+
+
+def _chat_filter(chat_type: str, chat_id: int) -> dict:
+    if chat_type == "direct":
+        return {"direct_chat_id": chat_id}
+    return {"group_chat_id": chat_id}
+
+
+def list_chats_with_messages_before(cutoff: datetime) -> List[Tuple[str, int]]:
+    old = Message.objects.filter(created_at__lt=cutoff)
+    direct = old.filter(direct_chat__isnull=False).values_list("direct_chat_id", flat=True).distinct()
+    group = old.filter(group_chat__isnull=False).values_list("group_chat_id", flat=True).distinct()
+    return [("direct", i) for i in direct] + [("group", i) for i in group]
+
+
+def iter_messages_to_archive(chat_type: str, chat_id: int, cutoff: datetime, after_id: int = 0) -> Iterator[dict]:
+    return (
+        Message.objects.filter(**_chat_filter(chat_type, chat_id), created_at__lt=cutoff, id__gt=after_id)
+        .order_by("id")
+        .values(
+            "id", "sender_id", "sender__username", "text", "file", "created_at",
+            "change_seq", "edited_at", "deleted_at", "reply_to_id", "thread_root_id", "reply_count", "reaction_counts",
+        )
+        .iterator(chunk_size=2000)
+    )
+
+
+def iter_messages_for_export(chat_type: str, chat_id: int, after_id: int = 0, sender_id: Optional[int] = None, files_only: bool = False) -> Iterator[dict]:
+    qs = Message.objects.filter(**_chat_filter(chat_type, chat_id), id__gt=after_id)
+    if sender_id is not None:
+        qs = qs.filter(sender_id=sender_id)
+    if files_only:
+        qs = qs.exclude(file="").exclude(file__isnull=True)
+    return (
+        qs.order_by("id")
+        .values(
+            "id", "sender_id", "sender__username", "text", "file", "created_at",
+            "change_seq", "edited_at", "deleted_at", "reply_to_id", "thread_root_id", "reply_count", "reaction_counts",
+        )
+        .iterator(chunk_size=settings.EXPORT_CHUNK_SIZE)
+    )
+
+
+def list_chats_for_user_export(user_id: int) -> List[Tuple[str, int]]:
+    """Chats the user is in, plus groups they left but still have live messages in."""
+    direct = DirectChat.objects.filter(Q(user1_id=user_id) | Q(user2_id=user_id)).values_list("id", flat=True)
+    groups = set(GroupMember.objects.filter(user_id=user_id).values_list("group_chat_id", flat=True))
+    groups.update(
+        Message.objects.filter(sender_id=user_id, group_chat__isnull=False)
+        .values_list("group_chat_id", flat=True)
+        .distinct()
+    )
+    return [("direct", i) for i in direct] + [("group", i) for i in sorted(groups)]
+
+
+def delete_messages_up_to(chat_type: str, chat_id: int, last_id: int) -> int:
+    deleted, _ = Message.objects.filter(**_chat_filter(chat_type, chat_id), id__lte=last_id).delete()
+    return deleted
+
+
+# =========================
+# RETENTION REPOSITORY
+# =========================
+
+
+def list_group_retention(after_id: int = 0) -> Iterator[Tuple[int, Optional[int]]]:
+    """(group id, retention_days) for every group with id >= after_id, in id order."""
+    return (
+        GroupChat.objects.filter(id__gte=after_id)
+        .order_by("id")
+        .values_list("id", "retention_days")
+        .iterator(chunk_size=2000)
+    )
+
+
+def list_direct_chats_with_messages_before(cutoff: datetime, after_id: int = 0) -> List[int]:
+    return list(
+        Message.objects.filter(direct_chat_id__gte=after_id, created_at__lt=cutoff)
+        .order_by("direct_chat_id")
+        .values_list("direct_chat_id", flat=True)
+        .distinct()
+    )
+
+
+def list_expired_messages(chat_type: str, chat_id: int, cutoff: datetime, limit: int) -> List[Tuple[int, str]]:
+    """Oldest (id, file name) rows of a chat created before cutoff, via the (chat, created_at) index."""
+    return list(
+        Message.objects.filter(**_chat_filter(chat_type, chat_id), created_at__lt=cutoff)
+        .order_by("created_at")
+        .values_list("id", "file")[:limit]
+    )
+
+
+def delete_messages_by_ids(ids: List[int]) -> int:
+    deleted, _ = Message.objects.filter(id__in=ids).delete()
+    return deleted
+
+
+def list_referenced_media(prefix: str) -> set:
+    return set(
+        Message.objects.filter(file__startswith=prefix).values_list("file", flat=True).iterator(chunk_size=5000)
+    )
+
+
+def set_group_retention(group: GroupChat, days: Optional[int]) -> None:
+    group.retention_days = days
+    group.save(update_fields=["retention_days"])
+
+
+# =========================
+# MEDIA REPOSITORY
+# =========================
+
+
+def retain_media(name: str, size: int) -> None:
+    """Count one more message on a stored blob; call in the transaction that creates it."""
+    digest = digest_of(name)
+    if digest is None:
+        return
+    if MediaBlob.objects.filter(name=name).update(ref_count=F("ref_count") + 1):
+        return
+    try:
+        with transaction.atomic():
+            MediaBlob.objects.create(name=name, digest=digest, size=size, ref_count=1)
+    except IntegrityError:
+        # a concurrent first upload of the same content created it
+        MediaBlob.objects.filter(name=name).update(ref_count=F("ref_count") + 1)
+
+
+def release_media(names: Iterable[str]) -> List[str]:
+    """Drop one reference per name; returns the names no message refers to any more.
+
+    Call in the transaction that removes the references and delete the
+    returned files (media.delete_files) after it commits.
+    """
+    counts = Counter(n for n in names if n)
+    if not counts:
+        return []
+    blobs = set(MediaBlob.objects.filter(name__in=counts).values_list("name", flat=True))
+    # files stored before dedup belong to exactly one message; a blob without
+    # a row was attached outside _create_message and is left to the orphan sweep
+    released = [n for n in counts if digest_of(n) is None]
+
+    by_count = defaultdict(list)
+    for name in blobs:
+        by_count[counts[name]].append(name)
+    for n, group in by_count.items():
+        MediaBlob.objects.filter(name__in=group).update(ref_count=F("ref_count") - n)
+
+    gone = MediaBlob.objects.filter(name__in=blobs, ref_count__lte=0)
+    released.extend(gone.values_list("name", flat=True))
+    gone.delete()
+    return released
+
+
+def _release_media_of(messages: QuerySet) -> None:
+    released = release_media(messages.exclude(file="").exclude(file__isnull=True).values_list("file", flat=True))
+    if released:
+        transaction.on_commit(lambda: media.delete_files(released))
+
+
+# Retention and tombstones release their messages' files themselves; these
+# cover messages removed by cascade, which would otherwise keep their blobs'
+# ref_count up (and the files on disk) forever. They run before the cascade,
+# while the messages are still there.
+
+@receiver(pre_delete, sender=DirectChat)
+def _release_direct_chat_media(sender, instance, **kwargs):
+    _release_media_of(Message.objects.filter(direct_chat_id=instance.id))
+
+
+@receiver(pre_delete, sender=GroupChat)
+def _release_group_media(sender, instance, **kwargs):
+    _release_media_of(Message.objects.filter(group_chat_id=instance.id))
+
+
+@receiver(pre_delete, sender=MyUser)
+def _release_user_media(sender, instance, **kwargs):
+    # their direct chats go too, and release their own messages
+    _release_media_of(Message.objects.filter(sender_id=instance.id, group_chat__isnull=False))
+
+
+def referenced_blob_names(names: Iterable[str]) -> set:
+    return set(MediaBlob.objects.filter(name__in=list(names), ref_count__gt=0).values_list("name", flat=True))
+
+
+def media_usage() -> dict:
+    usage = MediaBlob.objects.aggregate(
+        blobs=Count("name"),
+        references=Sum("ref_count"),
+        stored_bytes=Sum("size"),
+        logical_bytes=Sum(F("size") * F("ref_count")),
+    )
+    return {key: value or 0 for key, value in usage.items()}
+
+
+# =========================
+# OUTBOX REPOSITORY
+# =========================
+
+
+def add_outbox_event(user_id: int, payload: dict) -> OutboxEvent:
+    """Queue a notification; call inside the transaction of the change it announces."""
+    return OutboxEvent.objects.create(user_id=user_id, payload=payload, available_at=timezone.now())
+
+
+def list_due_outbox_events(now: datetime, limit: int) -> List[OutboxEvent]:
+    """Oldest due events, skipping every user whose queue is waiting on a retry."""
+    waiting = OutboxEvent.objects.filter(available_at__gt=now).values("user_id")
+    return list(
+        OutboxEvent.objects.filter(available_at__lte=now)
+        .exclude(user_id__in=waiting)
+        .order_by("id")
+        .only("id", "user_id", "payload", "attempts", "created_at")[:limit]
+    )
+
+
+def delete_outbox_events(ids: List[int]) -> None:
+    OutboxEvent.objects.filter(id__in=ids).delete()
+
+
+def retry_outbox_event(event_id: int, attempts: int, available_at: datetime) -> None:
+    OutboxEvent.objects.filter(id=event_id).update(attempts=attempts, available_at=available_at)
+
+
+def count_outbox_events() -> int:
+    return OutboxEvent.objects.count()
+
+
+# =========================
+# PENDING DELIVERY REPOSITORY
+# =========================
+
+
+def add_pending_delivery(user_id: int, payload: dict, max_pending: int) -> PendingDelivery:
+    """Keep a notification until it is acked, dropping the user's oldest beyond max_pending."""
+    delivery = PendingDelivery.objects.create(user_id=user_id, payload=payload)
+    # the id of the max_pending-th newest row, found along the (user, id) index
+    boundary = PendingDelivery.objects.filter(user_id=user_id).order_by("-id").values("id")[max_pending - 1 : max_pending]
+    PendingDelivery.objects.filter(user_id=user_id, id__lt=Subquery(boundary)).delete()
+    return delivery
+
+
+def list_pending_deliveries(user_id: int, after_id: int, since: datetime, limit: int) -> List[Tuple[int, dict]]:
+    """(id, payload) of the user's deliveries after `after_id`, oldest first: one range of the (user, id) index."""
+    return list(
+        PendingDelivery.objects.filter(user_id=user_id, id__gt=after_id, created_at__gte=since)
+        .order_by("id")
+        .values_list("id", "payload")[:limit]
+    )
+
+
+def ack_pending_deliveries(acked: Dict[int, int]) -> int:
+    """Delete every user's deliveries up to the acked id; {user_id: id}."""
+    deleted = 0
+    with transaction.atomic():
+        for user_id, up_to in acked.items():
+            deleted += PendingDelivery.objects.filter(user_id=user_id, id__lte=up_to).delete()[0]
+    return deleted
+
+
+def delete_pending_deliveries_before(cutoff: datetime, limit: int) -> int:
+    ids = PendingDelivery.objects.filter(created_at__lt=cutoff).order_by("created_at").values_list("id", flat=True)[:limit]
+    return PendingDelivery.objects.filter(id__in=list(ids)).delete()[0]
+
+
+def count_pending_deliveries() -> int:
+    return PendingDelivery.objects.count()
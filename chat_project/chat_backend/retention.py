@@ -0,0 +1,227 @@
+"""Retention: prune messages that are older than their chat's window.
+
+Groups can set GroupChat.retention_days; other groups and all direct chats
+use MESSAGE_RETENTION_DAYS, where 0 keeps history forever.
+
+Chats are processed one at a time, groups then direct chats, each in id
+order. Within a chat, expired rows are deleted oldest first along the
+(chat, created_at) index in batches of RETENTION_BATCH_SIZE. Every batch is
+its own short transaction and is followed by a RETENTION_BATCH_PAUSE_MS
+sleep, so request handlers get the SQLite write lock in between instead of
+waiting for one huge DELETE.
+
+The position is saved in RetentionCheckpoint after every batch. A run that
+finds a checkpoint resumes from that chat with the original reference time,
+and the checkpoint is removed once a run completes.
+
+Attachments lose a reference with each deleted message (media.py); files
+no message refers to any more are removed after their batch commits. Archived history (tiering.py) is trimmed a block at a time.
+Notifications left unacked past INBOX_MAX_AGE_DAYS (inbox.py) are dropped.
+Freed SQLite pages are handed back with PRAGMA incremental_vacuum in small
+steps, which requires auto_vacuum=INCREMENTAL (enable_incremental_vacuum()).
+"""
+
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, Optional, Tuple
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from . import repositories as repo
+from . import media
+from . import tiering
+from .models import Message, RetentionCheckpoint
+
+
+logger = logging.getLogger(__name__)
+
+JOB = "messages"
+_CHAT_ORDER = {"group": 0, "direct": 1}
+
+
+def _cutoff(now: datetime, days: Optional[int]) -> Optional[datetime]:
+    if days is None:
+        days = settings.MESSAGE_RETENTION_DAYS
+    return now - timedelta(days=days) if days else None
+
+
+def _chats(now: datetime, start: Tuple[str, int]) -> Iterator[Tuple[str, int, datetime]]:
+    """(chat_type, chat_id, cutoff) for every chat with a window, from `start` on."""
+    if _CHAT_ORDER[start[0]] == 0:
+        for group_id, days in repo.list_group_retention(after_id=start[1]):
+            cutoff = _cutoff(now, days)
+            if cutoff is not None:
+                yield "group", group_id, cutoff
+
+    cutoff = _cutoff(now, None)
+    if cutoff is None:
+        return
+    after_id = start[1] if start[0] == "direct" else 0
+    chat_ids = set(repo.list_direct_chats_with_messages_before(cutoff, after_id=after_id))
+    chat_ids.update(i for t, i in tiering.list_archived_chats() if t == "direct" and i >= after_id)
+    for chat_id in sorted(chat_ids):
+        yield "direct", chat_id, cutoff
+
+
+def prune_chat(chat_type: str, chat_id: int, cutoff: datetime, batch_size: int, pause: float, on_batch=None) -> Dict[str, int]:
+    stats = {"messages": 0, "files": 0, "archived": 0}
+
+    while True:
+        rows = repo.list_expired_messages(chat_type, chat_id, cutoff, batch_size)
+        if not rows:
+            break
+        with transaction.atomic():
+            repo.delete_messages_by_ids([message_id for message_id, _ in rows])
+            repo.record_messages_removed(chat_type, chat_id, len(rows))
+            released = repo.release_media(name for _, name in rows)
+            if on_batch:
+                on_batch(len(rows))
+        stats["messages"] += len(rows)
+        stats["files"] += media.delete_files(released)
+        if len(rows) < batch_size:
+            break
+        time.sleep(pause)
+
+    archived, files = tiering.drop_blocks_before(chat_type, chat_id, cutoff)
+    if archived:
+        with transaction.atomic():
+            repo.record_messages_removed(chat_type, chat_id, archived)
+            released = repo.release_media(files)
+        stats["files"] += media.delete_files(released)
+    stats["archived"] += archived
+    return stats
+
+
+def prune_expired_messages(batch_size: Optional[int] = None, pause_ms: Optional[int] = None, restart: bool = False) -> Dict[str, int]:
+    """Run (or resume) a retention pass over every chat."""
+    batch_size = batch_size or settings.RETENTION_BATCH_SIZE
+    pause = (settings.RETENTION_BATCH_PAUSE_MS if pause_ms is None else pause_ms) / 1000
+
+    if restart:
+        RetentionCheckpoint.objects.filter(job=JOB).delete()
+    checkpoint, created = RetentionCheckpoint.objects.get_or_create(
+        job=JOB, defaults={"now": timezone.now(), "chat_type": "group", "chat_id": 0}
+    )
+    if not created:
+        logger.info("resuming retention at %s_%s", checkpoint.chat_type, checkpoint.chat_id)
+
+    stats = {"chats": 0, "messages": 0, "files": 0, "archived": 0, "resumed": int(not created)}
+
+    def on_batch(deleted):
+        # same transaction as the batch, so the two never disagree
+        checkpoint.deleted += deleted
+        checkpoint.save(update_fields=["chat_type", "chat_id", "deleted", "updated_at"])
+
+    for chat_type, chat_id, cutoff in _chats(checkpoint.now, (checkpoint.chat_type, checkpoint.chat_id)):
+        checkpoint.chat_type, checkpoint.chat_id = chat_type, chat_id
+        chat_stats = prune_chat(chat_type, chat_id, cutoff, batch_size, pause, on_batch)
+        if chat_stats["messages"] or chat_stats["archived"]:
+            stats["chats"] += 1
+            for key in ("messages", "files", "archived"):
+                stats[key] += chat_stats[key]
+
+    checkpoint.delete()
+    return stats
+
+
+# =========================
+# MEDIA
+# =========================
+
+
+def sweep_orphaned_media(grace_seconds: Optional[int] = None) -> int:
+    """Delete files under chat_media/ that no message, live or archived, refers to.
+
+    Files newer than RETENTION_MEDIA_GRACE_SECONDS are skipped: an upload is
+    written before the message row that points to it is committed.
+    """
+    if grace_seconds is None:
+        grace_seconds = settings.RETENTION_MEDIA_GRACE_SECONDS
+    field = Message._meta.get_field("file")
+    storage = field.storage
+    prefix = field.upload_to.rstrip("/")
+    if not storage.exists(prefix):
+        return 0
+
+    referenced = repo.list_referenced_media(prefix + "/")
+    for chat_type, chat_id in tiering.list_archived_chats():
+        referenced.update(r["file"] for r in tiering.iter_archived(chat_type, chat_id) if r["file"])
+
+    newest = time.time() - grace_seconds
+    root = storage.path(prefix)
+    orphans = []
+    # blobs sit one directory down (media.py); older uploads directly in prefix
+    for dirpath, _, files in os.walk(root):
+        for filename in files:
+            path = os.path.join(dirpath, filename)
+            name = f"{prefix}/{os.path.relpath(path, root)}".replace(os.sep, "/")
+            if name in referenced:
+                continue
+            if os.path.getmtime(path) > newest:
+                continue
+            orphans.append(name)
+    return media.delete_files(orphans, grace_seconds)
+
+
+# =========================
+# PENDING DELIVERIES
+# =========================
+
+
+def prune_pending_deliveries(batch_size: Optional[int] = None, pause_ms: Optional[int] = None) -> int:
+    """Delete notifications nobody acked within INBOX_MAX_AGE_DAYS (inbox.py), oldest first."""
+    batch_size = batch_size or settings.RETENTION_BATCH_SIZE
+    pause = (settings.RETENTION_BATCH_PAUSE_MS if pause_ms is None else pause_ms) / 1000
+    cutoff = timezone.now() - timedelta(days=settings.INBOX_MAX_AGE_DAYS)
+
+    deleted = 0
+    while True:
+        batch = repo.delete_pending_deliveries_before(cutoff, batch_size)
+        deleted += batch
+        if batch < batch_size:
+            return deleted
+        time.sleep(pause)
+
+
+# =========================
+# SPACE RECLAMATION
+# =========================
+
+
+def incremental_vacuum_enabled() -> bool:
+    if connection.vendor != "sqlite":
+        return False
+    with connection.cursor() as c:
+        c.execute("PRAGMA auto_vacuum")
+        return c.fetchone()[0] == 2
+
+
+def enable_incremental_vacuum() -> None:
+    """One-off switch to auto_vacuum=INCREMENTAL. Runs a full VACUUM, which blocks writers."""
+    with connection.cursor() as c:
+        c.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        c.execute("VACUUM")
+
+
+def reclaim_space(pages_per_step: Optional[int] = None, pause_ms: Optional[int] = None) -> int:
+    """Return free pages to the filesystem a few at a time. Returns pages freed."""
+    if not incremental_vacuum_enabled():
+        return 0
+    pages_per_step = pages_per_step or settings.RETENTION_VACUUM_PAGES
+    pause = (settings.RETENTION_BATCH_PAUSE_MS if pause_ms is None else pause_ms) / 1000
+
+    freed = 0
+    with connection.cursor() as c:
+        while True:
+            c.execute("PRAGMA freelist_count")
+            free = c.fetchone()[0]
+            if not free:
+                return freed
+            c.execute(f"PRAGMA incremental_vacuum({min(free, pages_per_step):d})")
+            c.fetchall()  # the pragma frees one page per step of the statement
+            freed += min(free, pages_per_step)
+            time.sleep(pause)
@@ -1,9 +1,11 @@
 from django.urls import re_path
-from .consumers import ChatConsumer, NotificationConsumer
+from .consumers import ChatConsumer, MultiplexConsumer, NotificationConsumer
 
 websocket_urlpatterns = [
     re_path(r"ws/chat/direct/(?P<direct_chat_id>\d+)/$", ChatConsumer.as_asgi()),
     re_path(r"ws/chat/group/(?P<group_id>\d+)/$", ChatConsumer.as_asgi()),
     re_path(r"ws/notifications/$", NotificationConsumer.as_asgi()),
+    # one socket for every room + notifications, rooms managed in-band
+    re_path(r"ws/multiplex/$", MultiplexConsumer.as_asgi()),
 ]
   
\ No newline at end of file
@@ -1,13 +1,13 @@
 from rest_framework import serializers
 from django.contrib.auth import authenticate
 from .models import MyUser
-from django.contrib.auth.hashers import make_password
+from . import hashing
 class RegisterSerializer(serializers.ModelSerializer):
     class Meta:
         model = MyUser
         fields = ['username', 'password', 'age', 'gender', 'profile_pic']
     def create(self, data):
-        data["password"]=make_password(data["password"])      
+        data["password"]=hashing.hash_password(data["password"])      
         return MyUser.objects.create(**data)
 
     
\ No newline at end of file
@@ -2,13 +2,18 @@ from typing import Dict, List, Tuple
 
 import jwt
 from datetime import datetime, timedelta
-from django.contrib.auth.hashers import check_password
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import IntegrityError, transaction
 
 from .models import MyUser, DirectChat, GroupChat, GroupMember, Message
 from .serializers import RegisterSerializer
 from . import repositories as repo
+from . import hashing
+from . import tiering
+from . import fanout
+from . import dedupe
+from . import media
+from . import outbox
 
 
 JWT_SECRET = "keys"
@@ -21,14 +26,22 @@ JWT_ALGORITHM = "HS256"
 
 
 def login_user(username: str, password: str) -> Tuple[str, MyUser]:
-    """Validate credentials and return (token, user) or raise ValueError."""
+    """Validate credentials and return (token, user) or raise ValueError.
+
+    Raises hashing.PoolSaturated when the hashing pool is full.
+    """
     user = repo.get_user_by_username(username)
     if not user:
         raise ValueError("user_not_found")
 
-    if not check_password(password, user.password):
+    ok, new_encoded = hashing.verify_password(password, user.password)
+    if not ok:
         raise ValueError("wrong_password")
 
+    # stored hash uses outdated parameters; upgrade it while we know the password
+    if new_encoded:
+        repo.update_user_password(user, new_encoded)
+
     token = jwt.encode(
         {"id": user.id, "exp": datetime.utcnow() + timedelta(hours=24)},
         JWT_SECRET,
@@ -55,32 +68,62 @@ def list_users() -> List[Dict]:
 # =========================
 
 
-def start_direct_chat_service(user1_id: int, user2_id: int) -> Tuple[DirectChat, List[Dict]]:
-    """Create or fetch a direct chat between two users and return chat + messages."""
-    try:
-        user1 = repo.get_user_by_id(user1_id)
-        user2 = repo.get_user_by_id(user2_id)
-    except MyUser.DoesNotExist:
-        # Let the view decide how to map this to an HTTP response
-        raise ValueError("user_not_found")
+def start_direct_chat_service(user1_id: int, user2_id: int) -> Tuple[int, List[Dict]]:
+    """Create or fetch a direct chat between two users and return (chat_id, messages).
 
-    chat, _ = repo.get_or_create_direct_chat(user1, user2)
+    user1 is the authenticated caller. Opening an existing chat resolves the
+    pair from the cache (or one indexed lookup) without loading either user;
+    user2 is only checked when the chat has to be created.
+    """
+    chat_id = repo.find_direct_chat_id(user1_id, user2_id)
+    if chat_id is None:
+        if not repo.user_exists(user2_id):
+            # Let the view decide how to map this to an HTTP response
+            raise ValueError("user_not_found")
+        chat_id = repo.upsert_direct_chat(user1_id, user2_id)
+
+    data = _history("direct", chat_id, repo.list_messages_for_direct_chat(chat_id))
+    return chat_id, data
+
+
+def _message_row(m: Message) -> Dict:
+    return {
+        "id": m.id,
+        "sender_id": m.sender.id,
+        "sender": m.sender.username,
+        "text": m.text,
+        "file": m.file.name or None,  # storage name; views turn it into a URL (media.media_url)
+        "created_at": m.created_at,
+        "seq": m.change_seq,
+        "edited_at": m.edited_at,
+        "deleted": m.deleted_at is not None,
+        "reply_to": m.reply_to_id,
+        "thread_root": m.thread_root_id,
+        "reply_count": m.reply_count,
+        "reactions": m.reaction_counts,
+    }
+
+
+def _history(chat_type: str, chat_id: int, messages_qs, before_id: int | None = None, limit: int | None = None) -> List[Dict]:
+    """Read history through both tiers: archived segment first, then the Message table.
+
+    Without a limit the whole history is returned. With a limit, returns the
+    newest `limit` messages with id < before_id, taking from the archive only
+    when the table runs out.
+    """
+    mark = tiering.watermark(chat_type, chat_id)
+    messages_qs = messages_qs.filter(id__gt=mark)
 
-    messages = repo.list_messages_for_direct_chat(chat)
-    data: List[Dict] = []
-    for m in messages:
-        data.append(
-            {
-                "id": m.id,
-                "sender_id": m.sender.id,
-                "sender": m.sender.username,
-                "text": m.text,
-                "file": m.file,  # caller builds absolute URL if needed
-                "created_at": m.created_at,
-            }
-        )
+    if limit is None:
+        return tiering.read_archived(chat_type, chat_id) + [_message_row(m) for m in messages_qs]
 
-    return chat, data
+    if before_id is not None:
+        messages_qs = messages_qs.filter(id__lt=before_id)
+    data = [_message_row(m) for m in reversed(messages_qs.order_by("-id")[:limit])]
+
+    if len(data) < limit and mark:
+        data = tiering.read_archived_page(chat_type, chat_id, before_id, limit - len(data)) + data
+    return data
 
 
 # =========================
@@ -88,30 +131,33 @@ def start_direct_chat_service(user1_id: int, user2_id: int) -> Tuple[DirectChat,
 # =========================
 
 def my_groups_service(user: MyUser) -> List[Dict]:
-    groups = repo.list_groups_for_user(user)
-    data = [{"id": g.id, "name": g.name} for g in groups]
+    """The user's groups, most recently active first."""
+    groups = repo.list_groups_for_user_by_activity(user)
+    data = [
+        {
+            "id": g.id,
+            "name": g.name,
+            "member_count": g.member_count,
+            "message_count": g.message_count,
+            "last_message_id": g.last_message_id,
+            "last_message_at": g.last_message_at.isoformat() if g.last_message_at else None,
+        }
+        for g in groups
+    ]
     return data
 
 
-def list_group_messages_service(user: MyUser, group: GroupChat) -> Tuple[bool, List[Dict] | str]:
-    """Return (ok, data_or_error). Only members (including admins) can view messages."""
+def list_group_messages_service(
+    user: MyUser, group: GroupChat, before_id: int | None = None, limit: int | None = None
+) -> Tuple[bool, List[Dict] | str]:
+    """Return (ok, data_or_error). Only members (including admins) can view messages.
+
+    Pass limit (and optionally before_id) to fetch one page instead of the full history.
+    """
     if not repo.is_group_member(group, user):
         return False, "Not allowed"
 
-    messages_qs = repo.list_messages_for_group_chat(group)
-    data: List[Dict] = []
-    for m in messages_qs:
-        data.append(
-            {
-                "id": m.id,
-                "sender_id": m.sender.id,
-                "sender": m.sender.username,
-                "text": m.text,
-                "file": m.file,  # caller builds absolute URL if needed
-                "created_at": m.created_at,
-            }
-        )
-
+    data = _history("group", group.id, repo.list_messages_for_group_chat(group), before_id, limit)
     return True, data
 
 
@@ -122,6 +168,17 @@ def create_group_service(creator: MyUser, name: str) -> GroupChat:
     return group
 
 
+def _group_added_event(admin: MyUser, group: GroupChat) -> Dict:
+    return {
+        "type": "group.added",
+        "event": "group_added",
+        "group_id": group.id,
+        "group_name": group.name,
+        "added_by_id": admin.id,
+        "added_by_username": admin.username,
+    }
+
+
 def add_user_to_group_service(admin: MyUser, group: GroupChat, user_id: int) -> Tuple[bool, str]:
     """Return (success, error_message_if_any)."""
     if not repo.is_group_admin(group, admin):
@@ -132,22 +189,12 @@ def add_user_to_group_service(admin: MyUser, group: GroupChat, user_id: int) ->
     except MyUser.DoesNotExist:
         return False, "User not found"
 
-    member, created = repo.add_group_member(group, new_user)
-    if not created:
-        return False, "User already in group"
-
-    # Notify the added user via WebSocket (if connected)
-    channel_layer = get_channel_layer()
-    if channel_layer is not None:
-        async_to_sync(channel_layer.group_send)(
-            f"user_{new_user.id}",
-            {
-            "group_id": group.id,
-                "group_name": group.name,
-                "added_by_id": admin.id,
-                "added_by_username": admin.username,
-            },
-        )
+    with transaction.atomic():
+        member, created = repo.add_group_member(group, new_user)
+        if not created:
+            return False, "User already in group"
+        # delivered by the outbox dispatcher once this commits
+        outbox.notify(new_user.id, _group_added_event(admin, group))
 
     return True, "User added successfully"
 
@@ -160,7 +207,7 @@ def add_users_to_group_service(admin: MyUser, group: GroupChat, user_ids: List[i
     if not repo.is_group_admin(group, admin):
         return False, "Only admins can add users"
 
-    channel_layer = get_channel_layer()
+    event = _group_added_event(admin, group)
     results: List[Dict] = []
 
     for raw_id in user_ids:
@@ -176,30 +223,23 @@ def add_users_to_group_service(admin: MyUser, group: GroupChat, user_ids: List[i
             results.append({"user_id": uid, "status": "not_found"})
             continue
 
-        member, created = repo.add_group_member(group, new_user)
+        with transaction.atomic():
+            member, created = repo.add_group_member(group, new_user)
+            if created:
+                outbox.notify(new_user.id, event)
         if not created:
             results.append({"user_id": uid, "status": "already_in_group"})
             continue
 
-        # send notification per successfully added user
-        if channel_layer is not None:
-            async_to_sync(channel_layer.group_send)(
-                f"user_{new_user.id}",
-                {
-                    "type": "group.added",
-                    "event": "group_added",
-                    "group_id": group.id,
-                    "group_name": group.name,
-                    "added_by_id": admin.id,
-                    "added_by_username": admin.username,
-                },
-            )
-
         results.append({"user_id": uid, "status": "added"})
 
     return True, results
 
 
+def is_group_admin_service(user: MyUser, group: GroupChat) -> bool:
+    return repo.is_group_admin(group, user)
+
+
 def group_members_service(user: MyUser, group: GroupChat) -> Tuple[bool, List[Dict] | str]:
     if not repo.is_group_member(group, user):
         return False, "Not allowed"
@@ -216,30 +256,79 @@ def group_members_service(user: MyUser, group: GroupChat) -> Tuple[bool, List[Di
     return True, data
 
 
+def set_group_retention_service(admin: MyUser, group: GroupChat, days) -> Tuple[bool, str]:
+    """Admins set how many days of history the group keeps; None falls back to the default."""
+    if not repo.is_group_admin(group, admin):
+        return False, "Only admin can change retention"
+    if days is not None:
+        try:
+            days = int(days)
+        except (TypeError, ValueError):
+            return False, "retention_days must be a positive integer or null"
+        if days <= 0:
+            return False, "retention_days must be a positive integer or null"
+    repo.set_group_retention(group, days)
+    return True, "Retention updated"
+
+
 
 # =========================
 # MESSAGE SERVICES
 # =========================
 
 
-def send_direct_message_service(user: MyUser, chat: DirectChat, text: str, file) -> Message:
+def can_access_room_service(user_id: int, chat_type: str, chat_id: int) -> bool:
+    """Whether the user may read/post in direct_<id> or group_<id>."""
+    if chat_type == "direct":
+        return repo.is_direct_chat_participant(chat_id, user_id)
+    return repo.is_group_member_by_id(chat_id, user_id)
+
+
+def _reply_parent(chat_type: str, chat_id: int, reply_to_id) -> Message | None:
+    """Resolve a reply target; it must be a live, undeleted message of the same chat."""
+    if reply_to_id is None:
+        return None
+    try:
+        parent = repo.get_chat_message(chat_type, chat_id, int(reply_to_id))
+    except (TypeError, ValueError, Message.DoesNotExist):
+        raise ValueError("invalid_reply_to")
+    if parent.deleted_at:
+        raise ValueError("message_deleted")
+    return parent
+
+
+def _create_once(create, user: MyUser, client_msg_id, **kwargs) -> Message:
+    """Run a repo create unless client_msg_id was already used (raises dedupe.DuplicateMessage)."""
+    client_msg_id = dedupe.clean_key(client_msg_id)
+    dedupe.check(user.id, client_msg_id)
+    try:
+        message = create(sender=user, client_msg_id=client_msg_id, **kwargs)
+    except IntegrityError:
+        if client_msg_id is None:
+            raise
+        # a concurrent copy of this send won the unique index
+        dedupe.check(user.id, client_msg_id)
+        raise
+    # callers may wrap this in a larger transaction: a rolled-back send must stay retryable
+    transaction.on_commit(lambda: dedupe.remember(message))
+    return message
+
+
+def send_direct_message_service(user: MyUser, chat: DirectChat, text: str, file, reply_to_id=None, client_msg_id=None) -> Message:
+    """Raises PermissionError, ValueError or dedupe.DuplicateMessage (a resend; nothing was written)."""
     # Ensure user is a participant in the chat
     if user.id not in (chat.user1_id, chat.user2_id):
         raise PermissionError("not_allowed")
 
-    # create the message in DB
-    message = repo.create_direct_message(chat, user, text=text, file=file)
-
-    # Notify the other participant via the user's notification group (if connected)
-    try:
-        other_user_id = chat.user2_id if user.id == chat.user1_id else chat.user1_id
-    except Exception:
-        other_user_id = None
-
-    channel_layer = get_channel_layer()
-    if channel_layer is not None and other_user_id is not None:
-        async_to_sync(channel_layer.group_send)(
-            f"user_{other_user_id}",
+    other_user_id = chat.user2_id if user.id == chat.user1_id else chat.user1_id
+    parent = _reply_parent("direct", chat.id, reply_to_id)
+    with transaction.atomic():
+        message = _create_once(
+            repo.create_direct_message, user, client_msg_id, chat=chat, text=text, file=file, reply_to=parent
+        )
+        # the other participant's notification commits with the message
+        outbox.notify(
+            other_user_id,
             {
                 "type": "message.received",
                 "event": "message_received",
@@ -253,11 +342,141 @@ def send_direct_message_service(user: MyUser, chat: DirectChat, text: str, file)
             },
         )
 
+    # room subscribers
+    fanout.publish_direct_message(chat, message, user)
+
     return message
 
 
-def send_group_message_service(user: MyUser, group: GroupChat, text: str, file) -> Message:
+def send_group_message_service(user: MyUser, group: GroupChat, text: str, file, reply_to_id=None, client_msg_id=None) -> Message:
+    """Raises PermissionError, ValueError or dedupe.DuplicateMessage (a resend; nothing was written)."""
     if not repo.is_group_member(group, user):
         raise PermissionError("not_allowed")
 
-    return repo.create_group_message(group, user, text=text, file=file)
+    parent = _reply_parent("group", group.id, reply_to_id)
+    message = _create_once(
+        repo.create_group_message, user, client_msg_id, group=group, text=text, file=file, reply_to=parent
+    )
+
+    # room subscribers and every member's notification socket, off the request thread
+    fanout.publish_group_message(group, message, user)
+    return message
+
+
+def edit_message_service(user: MyUser, message_id: int, text: str) -> Message:
+    """Only the sender can edit, and only while the message is live (not deleted or archived).
+
+    Raises Message.DoesNotExist, PermissionError("not_allowed") or
+    ValueError("text_required" / "message_deleted").
+    """
+    if not text:
+        raise ValueError("text_required")
+    message = repo.get_message(message_id)
+    if message.sender_id != user.id:
+        raise PermissionError("not_allowed")
+    if message.deleted_at:
+        raise ValueError("message_deleted")
+
+    with transaction.atomic():
+        repo.edit_message(message, text)
+        fanout.publish_message_change(*repo.message_chat(message), message)
+    return message
+
+
+def delete_message_service(user: MyUser, message_id: int) -> Message:
+    """The sender, or an admin of the group, replaces the message with a tombstone."""
+    message = repo.get_message(message_id)
+    chat_type, chat_id = repo.message_chat(message)
+    if message.sender_id != user.id:
+        if chat_type == "direct" or not repo.is_group_admin(message.group_chat, user):
+            raise PermissionError("not_allowed")
+    if message.deleted_at:
+        return message
+
+    file_name = message.file.name if message.file else None
+    with transaction.atomic():
+        if not repo.tombstone_message(message):
+            # a concurrent delete got there first and released the file
+            return repo.get_message(message_id)
+        fanout.publish_message_change(chat_type, chat_id, message)
+        # the file goes only if no other message shares it
+        released = repo.release_media([file_name])
+        if released:
+            transaction.on_commit(lambda: media.delete_files(released))
+    return message
+
+
+def react_service(user: MyUser, message_id: int, emoji, add: bool = True) -> Message:
+    """Add or remove the user's emoji reaction on a message.
+
+    Raises Message.DoesNotExist, PermissionError("not_allowed") or
+    ValueError("invalid_emoji" / "message_deleted" / "too_many_reactions").
+    """
+    if not isinstance(emoji, str) or not 0 < len(emoji) <= 32:
+        raise ValueError("invalid_emoji")
+    message = repo.get_message(message_id)
+    chat_type, chat_id = repo.message_chat(message)
+    if not can_access_room_service(user.id, chat_type, chat_id):
+        raise PermissionError("not_allowed")
+
+    with transaction.atomic():
+        # the copy above was read before the lock: a concurrent tap or delete may have changed it
+        repo.lock_reactions(message)
+        if message.deleted_at:
+            raise ValueError("message_deleted")
+        if add:
+            if emoji not in message.reaction_counts and len(message.reaction_counts) >= settings.REACTION_MAX_KINDS:
+                raise ValueError("too_many_reactions")
+            changed = repo.add_reaction(message, user, emoji)
+        else:
+            changed = repo.remove_reaction(message, user, emoji)
+        if changed:
+            fanout.publish_reactions(chat_type, chat_id, message)
+    return message
+
+
+def thread_service(user: MyUser, message_id: int, after_id: int | None, limit: int) -> Tuple[bool, Dict | str]:
+    """One page of the thread that message_id starts or belongs to.
+
+    The root is included on the first page. Pass the last reply's id as
+    after_id for the next one. Raises Message.DoesNotExist.
+    """
+    message = repo.get_message(message_id)
+    chat_type, chat_id = repo.message_chat(message)
+    if not can_access_room_service(user.id, chat_type, chat_id):
+        return False, "Not allowed"
+
+    root_id = message.thread_root_id or message.id
+    after = None
+    if after_id is not None:
+        after = repo.get_chat_message(chat_type, chat_id, after_id)
+
+    replies = [_message_row(m) for m in repo.list_thread(root_id, after, limit + 1)]
+    data = {
+        "thread_root": root_id,
+        "replies": replies[:limit],
+        "has_more": len(replies) > limit,
+    }
+    if after is None:
+        # the root may already be archived or pruned
+        root = message if root_id == message.id else repo.find_message(root_id)
+        data["root"] = _message_row(root) if root else None
+    return True, data
+
+
+def list_changes_service(user: MyUser, chat_type: str, chat_id: int, since: int, limit: int) -> Tuple[bool, Dict | str]:
+    """Messages created, edited or deleted after change sequence `since`, oldest change first.
+
+    The client stores the returned `seq` and passes it as `since` next time
+    (straight away while `has_more` is set). Only the live table is
+    consulted: a client behind the archive cutoff should reload history.
+    """
+    if not can_access_room_service(user.id, chat_type, chat_id):
+        return False, "Not allowed"
+
+    current = repo.get_change_seq(chat_type, chat_id)
+    changes = [_message_row(m) for m in repo.list_message_changes(chat_type, chat_id, since, limit + 1)]
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    seq = changes[-1]["seq"] if has_more else max([current, since] + [c["seq"] for c in changes[-1:]])
+    return True, {"seq": seq, "changes": changes, "has_more": has_more}
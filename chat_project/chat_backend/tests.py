@@ -1,3 +1,510 @@
-from django.test import TestCase
+import asyncio
+import contextlib
+import io
+import os
+import shutil
+import signal
+import tempfile
+import time
+from datetime import datetime, timedelta
+from unittest import mock
 
-# Create your tests here.
+import jwt
+import msgpack
+from asgiref.sync import async_to_sync, sync_to_async
+from channels.db import database_sync_to_async
+from channels.exceptions import ChannelFull
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+
+from . import fanout, hashing, outbox, retention, routing, services
+from . import repositories as repo
+from .framing import MSGPACK_SUBPROTOCOL, MsgpackCodec, tag_event
+from .jwt_middleware import JWT_ALGORITHM, JWT_SECRET, SocketUser
+from .layers import InProcessChannelLayer
+from .management.commands.sim_reconnect_storm import Command as StormCommand, Storm, VirtualClockLoop
+from .media_app import MediaFileApp
+from .models import DirectChat, GroupChat, GroupMember, MediaBlob, Message, MyUser
+
+
+class ApiTestCase(TestCase):
+    """A group member and the Authorization header login_required expects."""
+
+    def setUp(self):
+        self.user = MyUser.objects.create(username="member", password="x")
+        self.group = GroupChat.objects.create(name="g")
+        GroupMember.objects.create(group_chat=self.group, user=self.user)
+        token = jwt.encode(
+            {"id": self.user.id, "exp": datetime.utcnow() + timedelta(hours=1)}, JWT_SECRET, algorithm=JWT_ALGORITHM
+        )
+        self.auth = {"HTTP_AUTHORIZATION": f"Bearer {token}"}
+
+    def get(self, path, **params):
+        return self.client.get(path, params, **self.auth)
+
+
+class GroupHistoryPagingTests(ApiTestCase):
+    def test_limit_out_of_range_is_rejected(self):
+        url = f"/api/auth/group_chat_messages/{self.group.id}/"
+        for limit in (0, -1, 10**9):
+            self.assertEqual(self.get(url, limit=limit).status_code, 400, limit)
+        self.assertEqual(self.get(url, limit=50).status_code, 200)
+
+
+class ChangeFeedTests(ApiTestCase):
+    def test_limit_below_one_is_rejected(self):
+        repo.create_group_message(self.group, self.user, "hi")
+        url = f"/api/auth/group_chat_changes/{self.group.id}/"
+        for limit in (0, -5):
+            self.assertEqual(self.get(url, since=0, limit=limit).status_code, 400, limit)
+        response = self.get(url, since=0, limit=1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["changes"]), 1)
+
+
+@override_settings(MEDIA_BASE_URL="", ALLOWED_HOSTS=["testserver", "chat.example"])
+class MediaUrlEtagTests(ApiTestCase):
+    def test_etag_differs_by_host(self):
+        for path in ("/api/auth/get_users/", "/api/auth/get_profile/"):
+            etag = self.get(path)["ETag"]
+            # the URLs in the body are built on the request's origin
+            response = self.client.get(path, HTTP_HOST="chat.example", HTTP_IF_NONE_MATCH=etag, **self.auth)
+            self.assertEqual(response.status_code, 200, path)
+            self.assertEqual(self.client.get(path, HTTP_IF_NONE_MATCH=etag, **self.auth).status_code, 304, path)
+
+class ThreadTests(ApiTestCase):
+    def test_limit_below_one_is_rejected(self):
+        root = repo.create_group_message(self.group, self.user, "root")
+        repo.create_group_message(self.group, self.user, "reply", reply_to=root)
+        url = f"/api/auth/thread/{root.id}/"
+        for limit in (0, -3):
+            self.assertEqual(self.get(url, limit=limit).status_code, 400, limit)
+        self.assertEqual(self.get(url, limit=1).status_code, 200)
+
+
+class IdempotentSendTests(ApiTestCase):
+    def test_rolled_back_send_can_be_retried(self):
+        peer = MyUser.objects.create(username="peer", password="x")
+        chat = DirectChat.objects.create(user1=self.user, user2=peer)
+        with mock.patch.object(outbox, "notify", side_effect=RuntimeError("outbox down")):
+            with self.assertRaises(RuntimeError):
+                services.send_direct_message_service(self.user, chat, "hi", None, client_msg_id="c-1")
+        self.assertFalse(Message.objects.exists())
+
+        message = services.send_direct_message_service(self.user, chat, "hi", None, client_msg_id="c-1")
+        self.assertEqual(Message.objects.get().id, message.id)
+
+
+class MediaReferenceTests(ApiTestCase):
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media_settings = self.settings(MEDIA_ROOT=media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+
+    def attach(self, create, chat):
+        # same bytes every time: one blob shared by all the messages
+        return create(chat, self.user, file=SimpleUploadedFile("a.txt", b"shared"))
+
+    def refs(self, message):
+        return MediaBlob.objects.filter(name=message.file.name).values_list("ref_count", flat=True).first()
+
+    def test_concurrent_deletes_release_once(self):
+        first = self.attach(repo.create_group_message, self.group)
+        second = self.attach(repo.create_group_message, self.group)
+        self.assertEqual(self.refs(second), 2)
+
+        stale = repo.get_message(first.id)
+        services.delete_message_service(self.user, first.id)
+        # a retry that read the message before the first delete committed
+        with mock.patch.object(repo, "get_message", side_effect=[stale, repo.get_message(first.id)]):
+            services.delete_message_service(self.user, first.id)
+        self.assertEqual(self.refs(second), 1)
+
+    def test_cascade_deletes_release_references(self):
+        peer = MyUser.objects.create(username="peer", password="x")
+        chat = DirectChat.objects.create(user1=self.user, user2=peer)
+        in_group = self.attach(repo.create_group_message, self.group)
+        in_chat = self.attach(repo.create_direct_message, chat)
+        self.assertEqual(self.refs(in_chat), 2)
+
+        self.group.delete()
+        self.assertEqual(self.refs(in_chat), 1)
+        self.user.delete()
+        self.assertIsNone(self.refs(in_chat))
+
+    def test_recently_touched_file_is_left_to_the_sweep(self):
+        message = self.attach(repo.create_group_message, self.group)
+        path = message.file.path
+        # released while a new upload of the same bytes may still be committing
+        with self.captureOnCommitCallbacks(execute=True):
+            services.delete_message_service(self.user, message.id)
+        self.assertTrue(os.path.exists(path))
+
+        past_grace = time.time() - settings.RETENTION_MEDIA_GRACE_SECONDS - 1
+        os.utime(path, (past_grace, past_grace))
+        self.assertEqual(retention.sweep_orphaned_media(), 1)
+        self.assertFalse(os.path.exists(path))
+
+
+class MediaFileAppTests(TestCase):
+    def test_nul_byte_in_path_is_not_found(self):
+        app = MediaFileApp(None, prefix="/media/", root=tempfile.gettempdir())
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "method": "GET", "path": "/media/a\x00b", "headers": []}
+        async_to_sync(app)(scope, None, send)
+        self.assertEqual(sent[0]["status"], 404)
+
+
+class ReconnectStormTests(SimpleTestCase):
+    """50k clients reconnecting at once, on a virtual clock (sim_reconnect_storm)."""
+
+    def test_admission_control_absorbs_the_storm(self):
+        clients = 50_000
+        gate = StormCommand.gate()
+        loop = VirtualClockLoop()
+        try:
+            storm = loop.run_until_complete(Storm(clients, 0.5, 10.0, gate).run(deadline=180.0))
+        finally:
+            loop.close()
+
+        self.assertLessEqual(gate.peak_in_flight, settings.WS_CONNECT_CONCURRENCY)
+        self.assertLessEqual(storm.peak_in_flight, settings.WS_CONNECT_CONCURRENCY)
+
+        # some are turned away, all with the overload code and a hint in range
+        self.assertGreater(storm.refused, 0)
+        self.assertEqual(storm.other_closes, [])
+        self.assertEqual(len(storm.retry_hints), storm.refused)
+        self.assertGreaterEqual(min(storm.retry_hints), settings.WS_RETRY_MIN_MS)
+        self.assertLessEqual(max(storm.retry_hints), settings.WS_RETRY_MAX_MS)
+
+        # and everyone gets in, without a handshake done for a client that left
+        self.assertEqual(len(storm.connected_at), clients)
+        self.assertEqual(storm.timed_out, 0)
+        self.assertEqual(storm.wasted, 0)
+
+
+@override_settings(PASSWORD_HASH_WORKERS=1, PASSWORD_HASH_MAX_PENDING=2, PASSWORD_HASH_TIMEOUT=30)
+class HashingPoolTests(SimpleTestCase):
+    def tearDown(self):
+        hashing.shutdown()
+
+    def test_dead_worker_is_replaced(self):
+        hashing.hash_password("warm up")
+        for pid in list(hashing._pool._processes):
+            os.kill(pid, signal.SIGKILL)
+        with self.assertRaises(hashing.PoolSaturated):
+            for _ in range(50):  # until the pool notices
+                hashing.hash_password("x")
+                time.sleep(0.1)
+        self.assertTrue(hashing.hash_password("x"))
+
+
+class FrameDecodingTests(SimpleTestCase):
+    async def test_frames_that_are_not_events_get_an_error(self):
+        app = URLRouter(routing.websocket_urlpatterns)
+        socket = WebsocketCommunicator(app, "/ws/chat/group/1/", subprotocols=[MSGPACK_SUBPROTOCOL])
+        socket.scope["user"] = SocketUser(1, "member")
+        with contextlib.redirect_stdout(io.StringIO()):  # the consumer prints on connect
+            connected, _ = await socket.connect()
+        self.assertTrue(connected)
+
+        for frame in (msgpack.packb(5), msgpack.packb([1, 2]), b"\x82\xa1", b"\xc1"):
+            await socket.send_to(bytes_data=frame)
+            reply = MsgpackCodec.decode(await socket.receive_from())
+            self.assertEqual(reply, {"event": "error", "error": "invalid_frame"}, frame)
+
+        # the socket survived
+        await socket.send_to(bytes_data=msgpack.packb(tag_event({"action": "ping"})))
+        self.assertEqual(MsgpackCodec.decode(await socket.receive_from()), {"event": "pong"})
+        await socket.disconnect()
+
+
+@override_settings(OUTBOX_DISPATCH=False)
+class DeletedChatTests(ApiTestCase):
+    async def test_send_to_a_deleted_group_drops_the_room(self):
+        socket = WebsocketCommunicator(URLRouter(routing.websocket_urlpatterns), "/ws/multiplex/")
+        socket.scope["user"] = SocketUser(self.user.id, self.user.username)
+        self.assertTrue((await socket.connect())[0])
+        room = f"group_{self.group.id}"
+        await socket.send_json_to({"action": "subscribe", "room": room})
+        self.assertEqual(await socket.receive_json_from(), {"event": "subscribed", "room": room})
+
+        await database_sync_to_async(self.group.delete)()
+        await socket.send_json_to({"action": "send", "room": room, "text": "anyone?"})
+        self.assertEqual(await socket.receive_json_from(), {"event": "error", "room": room, "error": "not_found"})
+        await socket.send_json_to({"action": "send", "room": room, "text": "anyone?"})
+        self.assertEqual(await socket.receive_json_from(), {"event": "error", "room": room, "error": "not_subscribed"})
+        await socket.disconnect()
+
+
+class FanoutWithoutServerLoopTests(ApiTestCase):
+    """manage.py shell, management commands, WSGI: no socket ever bound fan-out to a loop."""
+
+    def test_group_message_is_delivered_inline(self):
+        layer = get_channel_layer()
+        member = MyUser.objects.create(username="other", password="x")
+        GroupMember.objects.create(group_chat=self.group, user=member)
+        room_socket = async_to_sync(layer.new_channel)()
+        member_socket = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(f"group_{self.group.id}", room_socket)
+        async_to_sync(layer.group_add)(f"user_{member.id}", member_socket)
+
+        message = repo.create_group_message(self.group, self.user, "hi")
+        fanout.engine.publish_group_message(self.group, message, self.user)
+
+        self.assertEqual(async_to_sync(layer.receive)(room_socket)["payload"]["id"], message.id)
+        self.assertEqual(async_to_sync(layer.receive)(member_socket)["payload"]["message_id"], message.id)
+        self.assertNotIn(message.id, fanout.engine._remaining)
+
+    def test_failed_chunk_still_completes_the_message(self):
+        GroupMember.objects.create(group_chat=self.group, user=MyUser.objects.create(username="other", password="x"))
+        message = repo.create_group_message(self.group, self.user, "hi")
+        lags = len(fanout.engine._lags)
+        with mock.patch.object(get_channel_layer(), "group_send_bulk", side_effect=RuntimeError("layer down")):
+            with self.assertLogs("chat_backend.fanout", "ERROR"):
+                fanout.engine.publish_group_message(self.group, message, self.user)
+        self.assertNotIn(message.id, fanout.engine._remaining)
+        self.assertEqual(len(fanout.engine._lags), lags + 1)
+
+    def test_reactions_are_broadcast_inline(self):
+        layer = get_channel_layer()
+        socket = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)("group_9", socket)
+        fanout.reactions.publish("group_9", 1, 5, {"+1": 1})
+        event = async_to_sync(layer.receive)(socket)
+        self.assertEqual(event["payload"]["reactions"], [{"id": 1, "seq": 5, "counts": {"+1": 1}}])
+
+
+class ReactionWindowTests(SimpleTestCase):
+    async def test_updates_from_request_threads_share_one_broadcast(self):
+        layer = get_channel_layer()
+        socket = await layer.new_channel()
+        await layer.group_add("group_9", socket)
+        await fanout.ensure_running()  # what a consumer's connect does
+
+        publish = sync_to_async(fanout.reactions.publish, thread_sensitive=False)
+        await publish("group_9", 1, 5, {"+1": 1})
+        await publish("group_9", 1, 6, {"+1": 2})
+        await publish("group_9", 2, 7, {"ok": 1})
+        event = await asyncio.wait_for(layer.receive(socket), 2)
+        self.assertEqual(
+            event["payload"]["reactions"],
+            [{"id": 1, "seq": 6, "counts": {"+1": 2}}, {"id": 2, "seq": 7, "counts": {"ok": 1}}],
+        )
+
+
+class ReactionLimitTests(ApiTestCase):
+    @override_settings(REACTION_MAX_KINDS=1)
+    def test_limit_counts_kinds_added_after_the_message_was_read(self):
+        message = repo.create_group_message(self.group, self.user, "hi")
+        stale = repo.get_message(message.id)
+        services.react_service(self.user, message.id, "+1")
+        # a second tap that loaded the message before the first committed
+        with mock.patch.object(repo, "get_message", return_value=stale):
+            with self.assertRaisesMessage(ValueError, "too_many_reactions"):
+                services.react_service(self.user, message.id, "ok")
+        self.assertEqual(repo.get_message(message.id).reaction_counts, {"+1": 1})
+
+
+async def receive_nothing(layer, channel, timeout=0.2):
+    try:
+        await asyncio.wait_for(layer.receive(channel), timeout)
+    except asyncio.TimeoutError:
+        return True
+    return False
+
+
+class ChannelLayerConformanceTests(SimpleTestCase):
+    """The behaviour Channels' own layer test-suite expects of an in-memory layer.
+
+    check_channel_layer runs these against another layer class (--stock, --backend).
+    """
+
+    layer_class = InProcessChannelLayer
+
+    def make(self, **kwargs):
+        return self.layer_class(**kwargs)
+
+    async def test_send_receive(self):
+        layer = self.make()
+        await layer.send("test-channel-1", {"type": "test.message", "text": "Ahoy-hoy!"})
+        message = await layer.receive("test-channel-1")
+        self.assertEqual((message["type"], message["text"]), ("test.message", "Ahoy-hoy!"))
+
+    async def test_send_capacity(self):
+        layer = self.make(capacity=3)
+        for _ in range(3):
+            await layer.send("test-channel-1", {"type": "test.message"})
+        with self.assertRaises(ChannelFull):
+            await layer.send("test-channel-1", {"type": "test.message"})
+        # the first three are still there
+        for _ in range(3):
+            await layer.receive("test-channel-1")
+
+    async def test_channel_capacity_patterns(self):
+        layer = self.make(capacity=10, channel_capacity={"big-*": 20, "small-*": 1})
+        await layer.send("small-1", {"type": "test.message"})
+        with self.assertRaises(ChannelFull):
+            await layer.send("small-1", {"type": "test.message"})
+        for _ in range(15):
+            await layer.send("big-1", {"type": "test.message"})
+
+    async def test_process_local_send_receive(self):
+        layer = self.make()
+        channel_name = await layer.new_channel()
+        await layer.send(channel_name, {"type": "test.message", "text": "Local only please"})
+        self.assertEqual((await layer.receive(channel_name))["text"], "Local only please")
+
+    async def test_multi_send_receive(self):
+        layer = self.make()
+        for n in (1, 2, 3):
+            await layer.send("test-channel-3", {"type": f"message.{n}"})
+        received = [(await layer.receive("test-channel-3"))["type"] for _ in range(3)]
+        self.assertEqual(received, ["message.1", "message.2", "message.3"])
+
+    async def test_waiting_receiver(self):
+        layer = self.make()
+        task = asyncio.ensure_future(layer.receive("test-channel-w"))
+        await asyncio.sleep(0.01)
+        await layer.send("test-channel-w", {"type": "test.message"})
+        self.assertEqual((await asyncio.wait_for(task, 1))["type"], "test.message")
+
+    async def test_receive_cancel(self):
+        layer = self.make()
+        for _ in range(10):
+            task = asyncio.ensure_future(layer.receive("test-channel-c"))
+            await asyncio.sleep(0)
+            await layer.send("test-channel-c", {"type": "test.message"})
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                # a cancelled receive must not swallow the message
+                message = await asyncio.wait_for(layer.receive("test-channel-c"), 1)
+                self.assertEqual(message["type"], "test.message")
+
+    async def test_groups_basic(self):
+        layer = self.make()
+        await layer.group_add("test-group", "test-gr-chan-1")
+        await layer.group_add("test-group", "test-gr-chan-2")
+        await layer.group_add("test-group", "test-gr-chan-3")
+        await layer.group_discard("test-group", "test-gr-chan-2")
+        await layer.group_send("test-group", {"type": "message.1"})
+        self.assertEqual((await layer.receive("test-gr-chan-1"))["type"], "message.1")
+        self.assertEqual((await layer.receive("test-gr-chan-3"))["type"], "message.1")
+        self.assertTrue(await receive_nothing(layer, "test-gr-chan-2"))
+
+    async def test_groups_channel_full(self):
+        layer = self.make(capacity=3)
+        await layer.group_add("test-group", "test-gr-chan-1")
+        for _ in range(5):
+            await layer.group_send("test-group", {"type": "message.1"})
+        for _ in range(3):
+            await layer.receive("test-gr-chan-1")
+        self.assertTrue(await receive_nothing(layer, "test-gr-chan-1"))
+
+    async def test_group_discard_unknown(self):
+        layer = self.make()
+        await layer.group_discard("no-such-group", "no-such-channel")
+        await layer.group_add("test-group", "test-gr-chan-1")
+        await layer.group_discard("test-group", "test-gr-chan-1")
+        await layer.group_discard("test-group", "test-gr-chan-1")
+        self.assertFalse(layer.groups)
+
+    async def test_expiry_single(self):
+        layer = self.make(expiry=0.1)
+        await layer.send("test-channel-1", {"type": "message.1"})
+        self.assertEqual(len(layer.channels), 1)
+        await asyncio.sleep(0.15)
+        self.assertTrue(await receive_nothing(layer, "test-channel-1", 0.5))
+        self.assertEqual(len(layer.channels), 0)
+
+    async def test_expiry_unread(self):
+        layer = self.make(expiry=0.1)
+        await layer.group_add("test-group", "test-channel-1")
+        await layer.send("test-channel-2", {"type": "message.1"})
+        await asyncio.sleep(0.15)
+        await layer.group_send("test-group", {"type": "message.2"})
+        # test-channel-1 never read past its deadline: cleaned up, still in the group
+        self.assertEqual((await layer.receive("test-channel-1"))["type"], "message.2")
+        self.assertTrue(await receive_nothing(layer, "test-channel-2"))
+
+    async def test_expiry_leaves_groups(self):
+        layer = self.make(expiry=0.1)
+        await layer.group_add("test-group", "test-channel-1")
+        await layer.group_send("test-group", {"type": "message.1"})
+        await asyncio.sleep(0.15)
+        await layer.group_send("test-group", {"type": "message.2"})
+        self.assertNotIn("test-channel-1", layer.groups.get("test-group", {}))
+        self.assertTrue(await receive_nothing(layer, "test-channel-1"))
+
+    async def test_expiry_multi(self):
+        layer = self.make(expiry=0.1)
+        await layer.send("test-channel-1", {"type": "message.1"})
+        await layer.send("test-channel-1", {"type": "message.2"})
+        await asyncio.sleep(0.15)
+        await layer.send("test-channel-1", {"type": "message.3"})
+        self.assertEqual((await layer.receive("test-channel-1"))["type"], "message.3")
+        self.assertTrue(await receive_nothing(layer, "test-channel-1"))
+        self.assertEqual(len(layer.channels), 0)
+
+    async def test_group_expiry(self):
+        layer = self.make(group_expiry=1)
+        await layer.group_add("test-group", "test-gr-chan-1")
+        await asyncio.sleep(2.1)  # the stock layer compares against whole seconds
+        await layer.group_send("test-group", {"type": "message.1"})
+        self.assertTrue(await receive_nothing(layer, "test-gr-chan-1"))
+
+    async def test_sender_mutation(self):
+        layer = self.make()
+        await layer.group_add("test-group", "test-gr-chan-1")
+        message = {"type": "message.1"}
+        await layer.group_send("test-group", message)
+        message["type"] = "changed"
+        self.assertEqual((await layer.receive("test-gr-chan-1"))["type"], "message.1")
+
+    async def test_invalid_names(self):
+        layer = self.make()
+        with self.assertRaises(TypeError):
+            await layer.send("bad name!", {"type": "x"})
+        with self.assertRaises(TypeError):
+            await layer.group_add("bad group!", "ok-channel")
+
+    async def test_flush(self):
+        layer = self.make()
+        await layer.send("test-channel-1", {"type": "message.1"})
+        await layer.group_add("test-group", "test-channel-1")
+        await layer.flush()
+        self.assertTrue(await receive_nothing(layer, "test-channel-1"))
+        self.assertFalse(layer.groups)
+
+
+class SeedSyntheticTests(TransactionTestCase):
+    def seed(self, **options):
+        call_command("seed_synthetic", users=6, groups=2, direct_chats=3, messages=20, stdout=io.StringIO(), **options)
+
+    def test_second_run_with_the_same_prefix_is_refused(self):
+        self.seed(prefix="a")
+        with self.assertRaisesMessage(CommandError, "prefix 'a' already exist"):
+            self.seed(prefix="a")
+
+    def test_another_prefix_seeds_alongside(self):
+        self.seed(prefix="a")
+        self.seed(prefix="b", seed=2)
+        users = set(MyUser.objects.filter(username__startswith="b_").values_list("id", flat=True))
+        members = GroupMember.objects.filter(group_chat__name__startswith="b_g").values_list("user_id", flat=True)
+        self.assertLessEqual(set(members), users)
+        self.assertEqual(Message.objects.filter(sender__username__startswith="b_").count(), 20)
@@ -0,0 +1,299 @@
+"""Cold-tier storage for message history.
+
+Messages older than MESSAGE_ARCHIVE_AFTER_DAYS are moved out of the Message
+table into one append-only segment file per chat:
+
+    <MESSAGE_ARCHIVE_ROOT>/<chat_type>_<chat_id>.seg   zlib-compressed JSON blocks
+    <MESSAGE_ARCHIVE_ROOT>/<chat_type>_<chat_id>.idx   one fixed-size entry per block
+
+Each index entry records the id range, the created_at range and the byte
+offset/length of its block, so readers can binary-search it by id and
+decompress only the blocks they need. Segments are read through mmap.
+
+The highest archived id of a chat is its watermark: rows at or below it are
+served from the segment, rows above it from the database.
+
+Retention (retention.py) drops whole blocks from the front of the index with
+drop_blocks_before(). Their bytes stay in the segment until every block of
+the chat has expired and both files are removed.
+"""
+
+import bisect
+import json
+import mmap
+import os
+import struct
+import zlib
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Iterator, List, NamedTuple, Optional
+
+from django.conf import settings
+
+
+# first_id, last_id, first_ts, last_ts, offset, length
+_INDEX_ENTRY = struct.Struct("<qqddQI")
+
+
+class IndexEntry(NamedTuple):
+    first_id: int
+    last_id: int
+    first_ts: float
+    last_ts: float
+    offset: int
+    length: int
+
+
+def _base(chat_type: str, chat_id: int) -> Path:
+    root = Path(settings.MESSAGE_ARCHIVE_ROOT)
+    return root / f"{chat_type}_{chat_id}"
+
+
+def _read_index(chat_type: str, chat_id: int) -> List[IndexEntry]:
+    path = _base(chat_type, chat_id).with_suffix(".idx")
+    try:
+        raw = path.read_bytes()
+    except FileNotFoundError:
+        return []
+    # ignore a torn trailing entry from an interrupted append
+    usable = len(raw) - len(raw) % _INDEX_ENTRY.size
+    return [IndexEntry(*e) for e in _INDEX_ENTRY.iter_unpack(raw[:usable])]
+
+
+def watermark(chat_type: str, chat_id: int) -> int:
+    """Highest message id that lives in the archive for this chat (0 if none)."""
+    path = _base(chat_type, chat_id).with_suffix(".idx")
+    try:
+        with open(path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            end = f.tell() - f.tell() % _INDEX_ENTRY.size
+            if end == 0:
+                return 0
+            f.seek(end - _INDEX_ENTRY.size)
+            return IndexEntry(*_INDEX_ENTRY.unpack(f.read(_INDEX_ENTRY.size))).last_id
+    except FileNotFoundError:
+        return 0
+
+
+# =========================
+# WRITE PATH
+# =========================
+
+
+def _encode_row(row: Dict) -> Dict:
+    return {
+        "id": row["id"],
+        "sender_id": row["sender_id"],
+        "sender": row["sender__username"],
+        "text": row["text"],
+        "file": row["file"] or None,
+        "created_at": row["created_at"].isoformat(),
+        "seq": row["change_seq"],
+        "edited_at": row["edited_at"].isoformat() if row["edited_at"] else None,
+        "deleted": row["deleted_at"] is not None,
+        "reply_to": row["reply_to_id"],
+        "thread_root": row["thread_root_id"],
+        "reply_count": row["reply_count"],
+        "reactions": row["reaction_counts"],
+    }
+
+
+def append_block(chat_type: str, chat_id: int, rows: List[Dict]) -> IndexEntry:
+    """Append one compressed block and its index entry. rows must be in id order."""
+    base = _base(chat_type, chat_id)
+    base.parent.mkdir(parents=True, exist_ok=True)
+
+    payload = zlib.compress(
+        json.dumps([_encode_row(r) for r in rows], separators=(",", ":")).encode(),
+        settings.MESSAGE_ARCHIVE_COMPRESSION_LEVEL,
+    )
+
+    with open(base.with_suffix(".seg"), "ab") as seg:
+        offset = seg.tell()
+        seg.write(payload)
+        seg.flush()
+        os.fsync(seg.fileno())
+
+    entry = IndexEntry(
+        first_id=rows[0]["id"],
+        last_id=rows[-1]["id"],
+        first_ts=rows[0]["created_at"].timestamp(),
+        last_ts=rows[-1]["created_at"].timestamp(),
+        offset=offset,
+        length=len(payload),
+    )
+    # the index entry is written last: a block without an entry is never read
+    with open(base.with_suffix(".idx"), "ab") as idx:
+        idx.write(_INDEX_ENTRY.pack(*entry))
+        idx.flush()
+        os.fsync(idx.fileno())
+    return entry
+
+
+def archive_chat(chat_type: str, chat_id: int, cutoff: datetime) -> int:
+    """Move messages of one chat created before cutoff into its segment.
+
+    Returns the number of messages archived. Safe to re-run after a crash:
+    rows already covered by the watermark are deleted without being rewritten.
+    """
+    from . import repositories as repo
+
+    block_size = settings.MESSAGE_ARCHIVE_BLOCK_SIZE
+    mark = watermark(chat_type, chat_id)
+    archived = 0
+
+    block: List[Dict] = []
+    for row in repo.iter_messages_to_archive(chat_type, chat_id, cutoff, after_id=mark):
+        block.append(row)
+        if len(block) >= block_size:
+            mark = append_block(chat_type, chat_id, block).last_id
+            archived += len(block)
+            block = []
+    if block:
+        mark = append_block(chat_type, chat_id, block).last_id
+        archived += len(block)
+
+    if mark:
+        repo.delete_messages_up_to(chat_type, chat_id, mark)
+    return archived
+
+
+def archive_cold_messages(cutoff: datetime) -> Dict[str, int]:
+    from . import repositories as repo
+
+    stats = {"chats": 0, "messages": 0}
+    for chat_type, chat_id in repo.list_chats_with_messages_before(cutoff):
+        moved = archive_chat(chat_type, chat_id, cutoff)
+        if moved:
+            stats["chats"] += 1
+            stats["messages"] += moved
+    return stats
+
+
+# =========================
+# READ PATH
+# =========================
+
+
+def _decode_row(row: Dict) -> Dict:
+    row["created_at"] = datetime.fromisoformat(row["created_at"])
+    # blocks written before edits, threads and reactions existed lack these
+    row.setdefault("seq", 0)
+    row["edited_at"] = datetime.fromisoformat(row["edited_at"]) if row.get("edited_at") else None
+    row.setdefault("deleted", False)
+    row.setdefault("reply_to", None)
+    row.setdefault("thread_root", None)
+    row.setdefault("reply_count", 0)
+    row.setdefault("reactions", {})
+    row["file"] = row["file"] or None
+    return row
+
+
+def _iter_blocks(chat_type: str, chat_id: int, entries: List[IndexEntry]) -> Iterator[List[Dict]]:
+    if not entries:
+        return
+    with open(_base(chat_type, chat_id).with_suffix(".seg"), "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for e in entries:
+                rows = json.loads(zlib.decompress(mm[e.offset:e.offset + e.length]))
+                yield [_decode_row(r) for r in rows]
+
+
+def iter_archived(chat_type: str, chat_id: int) -> Iterator[Dict]:
+    """Every archived message of a chat, oldest first, one block in memory at a time."""
+    entries = _read_index(chat_type, chat_id)
+    for block in _iter_blocks(chat_type, chat_id, entries):
+        yield from block
+
+
+def archive_summary(chat_type: str, chat_id: int) -> Optional[tuple]:
+    """(message count, last id, last created_at) of a chat's archive, or None if it has none.
+
+    Counting decompresses every block; meant for repair jobs, not requests.
+    """
+    entries = _read_index(chat_type, chat_id)
+    if not entries:
+        return None
+    count = sum(len(block) for block in _iter_blocks(chat_type, chat_id, entries))
+    last = entries[-1]
+    return count, last.last_id, datetime.fromtimestamp(last.last_ts, tz=timezone.utc)
+
+
+def read_archived(chat_type: str, chat_id: int) -> List[Dict]:
+    """Every archived message of a chat, oldest first."""
+    return list(iter_archived(chat_type, chat_id))
+
+
+def read_archived_page(chat_type: str, chat_id: int, before_id: Optional[int], limit: int) -> List[Dict]:
+    """Up to `limit` archived messages with id < before_id, oldest first.
+
+    Only the blocks that overlap the page are mapped and decompressed.
+    """
+    entries = _read_index(chat_type, chat_id)
+    if before_id is not None:
+        # blocks starting at or after before_id cannot contribute
+        entries = entries[:bisect.bisect_left([e.first_id for e in entries], before_id)]
+
+    page: List[Dict] = []
+    for block in _iter_blocks(chat_type, chat_id, entries[::-1]):
+        if before_id is not None:
+            block = [r for r in block if r["id"] < before_id]
+        page = block + page
+        if len(page) >= limit:
+            break
+    return page[-limit:]
+
+
+# =========================
+# RETENTION
+# =========================
+
+
+def list_archived_chats() -> List[tuple]:
+    """(chat_type, chat_id) of every chat with an index file."""
+    root = Path(settings.MESSAGE_ARCHIVE_ROOT)
+    if not root.is_dir():
+        return []
+    chats = []
+    for path in root.glob("*.idx"):
+        chat_type, _, chat_id = path.stem.partition("_")
+        if chat_id.isdigit():
+            chats.append((chat_type, int(chat_id)))
+    return sorted(chats)
+
+
+def drop_blocks_before(chat_type: str, chat_id: int, cutoff: datetime) -> tuple:
+    """Forget the leading blocks whose newest message is older than cutoff.
+
+    A block that straddles the cutoff is kept whole until it has fully
+    expired. Returns (messages dropped, file names they referenced).
+    """
+    entries = _read_index(chat_type, chat_id)
+    limit = cutoff.timestamp()
+    expired = 0
+    while expired < len(entries) and entries[expired].last_ts < limit:
+        expired += 1
+    if not expired:
+        return 0, []
+
+    rows = 0
+    files = []
+    for block in _iter_blocks(chat_type, chat_id, entries[:expired]):
+        rows += len(block)
+        files.extend(r["file"] for r in block if r["file"])
+
+    base = _base(chat_type, chat_id)
+    kept = entries[expired:]
+    if kept:
+        # index first, atomically; the segment keeps the dead bytes
+        tmp = base.with_suffix(".idx.tmp")
+        with open(tmp, "wb") as idx:
+            idx.write(b"".join(_INDEX_ENTRY.pack(*e) for e in kept))
+            idx.flush()
+            os.fsync(idx.fileno())
+        os.replace(tmp, base.with_suffix(".idx"))
+    else:
+        # no index means no blocks: remove it before the segment it points into
+        base.with_suffix(".idx").unlink()
+        base.with_suffix(".seg").unlink(missing_ok=True)
+    return rows, files
@@ -25,6 +25,28 @@ urlpatterns = [
     path('add_user_to_group/<int:group_id>/', add_user_to_group),
 
     path('group_members/<int:group_id>/', group_members),
+
+    # send (text / file / reply_to / client_msg_id)
+    path('send_group_message/<int:group_id>/', send_group_message),
+    path('send_direct_message/<int:chat_id>/', send_direct_message),
+
+    # edit / delete / incremental sync (?since=<seq>)
+    path('edit_message/<int:message_id>/', edit_message),
+    path('delete_message/<int:message_id>/', delete_message),
+    path('group_chat_changes/<int:group_id>/', group_chat_changes),
+    path('direct_chat_changes/<int:chat_id>/', direct_chat_changes),
+
+    # reactions ({"emoji": "👍"})
+    path('add_reaction/<int:message_id>/', add_reaction),
+    path('remove_reaction/<int:message_id>/', remove_reaction),
+
+    # threads (?after=<reply id>&limit=)
+    path('thread/<int:message_id>/', message_thread),
+    path('group_retention/<int:group_id>/', group_retention),
+
+    # export (NDJSON, ?gzip=1)
+    path('export/group/<int:group_id>/', export_group_history),
+    path('export/me/', export_my_history),
     
 
     # profile
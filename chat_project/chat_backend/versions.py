@@ -0,0 +1,87 @@
+"""Version counters behind the ETags of the polled read endpoints.
+
+Keys and what bumps them:
+
+    users               any MyUser created, changed or deleted   (get_users)
+    user:<id>           that user changed                        (get_profile)
+    user_groups:<id>    user joined/left a group, or one of its
+                        groups was renamed                       (my_groups, user_groups_from_token)
+    group:<id>          group renamed, membership changed, or a
+                        member's profile changed                 (group_members)
+
+Bumps run in the same transaction as the change. Writes that skip model
+signals (queryset.update(), bulk_create) must call bump() themselves.
+
+activity:<user id> (my_groups, user_groups_from_token) is derived, not
+stored: get_versions() summarises the counters on the user's groups
+(counters.py), which change with every message and would be too hot to
+bump once per member.
+"""
+
+from typing import Iterable, List
+
+from django.db import connection
+from django.db.models import Max, Sum
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import GroupChat, GroupMember, MyUser, ResourceVersion
+
+
+def bump(*keys: str) -> None:
+    """Increment each key's version with a single upsert per key (race-free)."""
+    qn = connection.ops.quote_name
+    table, key_col, version_col = qn(ResourceVersion._meta.db_table), qn("key"), qn("version")
+    with connection.cursor() as cursor:
+        for key in keys:
+            cursor.execute(
+                f"INSERT INTO {table} ({key_col}, {version_col}) VALUES (%s, 1) "
+                f"ON CONFLICT ({key_col}) DO UPDATE SET {version_col} = {table}.{version_col} + 1",
+                [key],
+            )
+
+
+def _activity_version(user_id: int) -> str:
+    totals = GroupChat.objects.filter(members__user_id=user_id).aggregate(
+        last=Max("last_message_id"), messages=Sum("message_count"), members=Sum("member_count")
+    )
+    return f"{totals['last'] or 0}.{totals['messages'] or 0}.{totals['members'] or 0}"
+
+
+def get_versions(keys: Iterable[str]) -> List:
+    """Current version of each key, in order; 0 for keys never bumped."""
+    keys = list(keys)
+    found = dict(ResourceVersion.objects.filter(key__in=keys).values_list("key", "version"))
+    for key in keys:
+        if key.startswith("activity:"):
+            found[key] = _activity_version(int(key.partition(":")[2]))
+    return [found.get(k, 0) for k in keys]
+
+
+# =========================
+# SIGNAL RECEIVERS
+# =========================
+
+
+@receiver(post_save, sender=MyUser)
+@receiver(post_delete, sender=MyUser)
+def _user_changed(sender, instance, update_fields=None, **kwargs):
+    # password rehash on login does not change anything we serve
+    if update_fields is not None and set(update_fields) <= {"password"}:
+        return
+    group_ids = GroupMember.objects.filter(user_id=instance.id).values_list("group_chat_id", flat=True)
+    bump("users", f"user:{instance.id}", *(f"group:{gid}" for gid in group_ids))
+
+
+@receiver(post_save, sender=GroupChat)
+def _group_changed(sender, instance, created, **kwargs):
+    if created:
+        return
+    member_ids = GroupMember.objects.filter(group_chat_id=instance.id).values_list("user_id", flat=True)
+    bump(f"group:{instance.id}", *(f"user_groups:{uid}" for uid in member_ids))
+
+
+@receiver(post_save, sender=GroupMember)
+@receiver(post_delete, sender=GroupMember)
+def _membership_changed(sender, instance, **kwargs):
+    bump(f"group:{instance.group_chat_id}", f"user_groups:{instance.user_id}")
@@ -2,10 +2,16 @@ from rest_framework.decorators import api_view, authentication_classes, permissi
 from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
 from rest_framework import status
-from rest_framework.parsers import MultiPartParser, FormParser
+from rest_framework.parsers import JSONParser, MultiPartParser, FormParser
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from .models import DirectChat, GroupChat, GroupMember, Message, MyUser
 from . import services
+from . import export
+from .media import media_base, media_url
+from .hashing import PoolSaturated
+from .dedupe import DuplicateMessage
+from .conditional import etag_from
 from chat_project.decoraters import login_required
 
 # =====================================================
@@ -23,6 +29,8 @@ def login(request):
             username=data.get("username"),
             password=data.get("password"),
         )
+    except PoolSaturated:
+        return Response({"error": "server busy, try again"}, status=429, headers={"Retry-After": "1"})
     except ValueError as exc:
         code = str(exc)
         if code == "user_not_found":
@@ -38,7 +46,10 @@ def login(request):
 @authentication_classes([])
 @permission_classes([AllowAny])
 def signup(request):
-    ok, payload = services.register_user(request.data)
+    try:
+        ok, payload = services.register_user(request.data)
+    except PoolSaturated:
+        return Response({"error": "server busy, try again"}, status=429, headers={"Retry-After": "1"})
     if ok:
         return Response(payload, status=201)
     return Response(payload, status=400)
@@ -49,15 +60,22 @@ def signup(request):
 # 🔥 DIRECT CHAT
 # =====================================================
 
-def get_or_create_direct_chat(user1, user2):
-    if user1.id > user2.id:
-        user1, user2 = user2, user1
-
-    chat, created = DirectChat.objects.get_or_create(
-        user1=user1,
-        user2=user2
-    )
-    return chat
+def _message_json(request, m):
+    return {
+        "id": m["id"],
+        "sender_id": m["sender_id"],
+        "sender": m["sender"],
+        "text": m["text"],
+        "file_url": media_url(m["file"], request),
+        "created_at": m["created_at"],
+        "seq": m["seq"],
+        "edited_at": m["edited_at"],
+        "deleted": m["deleted"],
+        "reply_to": m["reply_to"],
+        "thread_root": m["thread_root"],
+        "reply_count": m["reply_count"],
+        "reactions": m["reactions"],
+    }
 
 
 @api_view(["POST"])
@@ -74,29 +92,17 @@ def start_direct_chat(request):
         return Response({"error": "user_id required"}, status=400)
 
     try:
-        chat, messages = services.start_direct_chat_service(int(user1_id), int(user2_id))
+        chat_id, messages = services.start_direct_chat_service(int(user1_id), int(user2_id))
     except ValueError as exc:
         if str(exc) == "user_not_found":
             return Response({"error": "user not found"}, status=404)
         raise
 
-    data = []
-    for m in messages:
-        file_field = m.get("file")
-        data.append(
-            {
-                "id": m["id"],
-                "sender_id": m["sender_id"],
-                "sender": m["sender"],
-                "text": m["text"],
-                "file_url": request.build_absolute_uri(file_field.url) if file_field else None,
-                "created_at": m["created_at"],
-            }
-        )
+    data = [_message_json(request, m) for m in messages]
 
     return Response({
-        "chat_id": chat.id,
-        "room_name": f"direct_{chat.id}",
+        "chat_id": chat_id,
+        "room_name": f"direct_{chat_id}",
         "receiver_id": int(user2_id),
         "messages": data,
     })
@@ -107,6 +113,7 @@ def start_direct_chat(request):
 @authentication_classes([])
 @permission_classes([AllowAny])
 @login_required
+@etag_from(lambda request: [f"user_groups:{request.user.id}", f"activity:{request.user.id}"])
 def my_groups(request):
 
     user = request.user
@@ -122,6 +129,7 @@ def my_groups(request):
 @authentication_classes([])
 @permission_classes([AllowAny])
 @login_required
+@etag_from(lambda request: [f"user_groups:{request.user.id}", f"user:{request.user.id}", f"activity:{request.user.id}"])
 def user_groups_from_token(request):
     """Return all groups for the authenticated user, using only JWT (no body params)."""
 
@@ -148,23 +156,21 @@ def group_chat_messages(request, group_id):
     user = request.user
     group = get_object_or_404(GroupChat, id=group_id)
 
-    ok, result = services.list_group_messages_service(user, group)
+    # optional paging: ?limit=50&before=<oldest id already loaded>
+    try:
+        limit = int(request.GET["limit"]) if "limit" in request.GET else None
+        before_id = int(request.GET["before"]) if "before" in request.GET else None
+    except ValueError:
+        return Response({"error": "limit and before must be integers"}, status=400)
+    if limit is not None and not 1 <= limit <= 500:
+        # a page, not the whole live and archived history in one response
+        return Response({"error": "limit must be between 1 and 500"}, status=400)
+
+    ok, result = services.list_group_messages_service(user, group, before_id, limit)
     if not ok:
         return Response({"error": result}, status=403)
 
-    messages = []
-    for m in result:
-        file_field = m.get("file")
-        messages.append(
-            {
-                "id": m["id"],
-                "sender_id": m["sender_id"],
-                "sender": m["sender"],
-                "text": m["text"],
-                "file_url": request.build_absolute_uri(file_field.url) if file_field else None,
-                "created_at": m["created_at"],
-            }
-        )
+    messages = [_message_json(request, m) for m in result]
 
     return Response(
         {
@@ -179,22 +185,16 @@ def group_chat_messages(request, group_id):
 @authentication_classes([])
 @permission_classes([AllowAny])
 @login_required
+@etag_from(lambda request: ["users", f"media:{media_base(request)}"])
 def get_users(request):
-    users = MyUser.objects.all()
-    data = []
-    for u in users:
-        profile_pic_url = (
-            request.build_absolute_uri(u.profile_pic.url)
-            if u.profile_pic
-            else None
-        )
-        data.append(
-            {
-                "id": u.id,
-                "username": u.username,
-                "profile_pic_url": profile_pic_url,
-            }
-        )
+    data = [
+        {
+            "id": u["id"],
+            "username": u["username"],
+            "profile_pic_url": media_url(u["profile_pic"], request),
+        }
+        for u in services.list_users()
+    ]
 
     return Response({"users": data}, status=200)
 
@@ -268,10 +268,18 @@ def add_user_to_group(request, group_id):
 
 
 
+def _group_members_etag_keys(request, group_id):
+    # non-members fall through to the view, which answers 403
+    if not services.can_access_room_service(request.user.id, "group", group_id):
+        return None
+    return [f"group:{group_id}"]
+
+
 @api_view(["GET"])
 @authentication_classes([])
 @permission_classes([AllowAny])
 @login_required
+@etag_from(_group_members_etag_keys)
 def group_members(request, group_id):
 
     user = request.user
@@ -284,6 +292,263 @@ def group_members(request, group_id):
     return Response(result, status=200)
 
 
+# GROUP RETENTION (ADMIN ONLY)
+
+@api_view(["POST"])
+@authentication_classes([])
+@permission_classes([AllowAny])
+@login_required
+def group_retention(request, group_id):
+
+    group = get_object_or_404(GroupChat, id=group_id)
+    ok, result = services.set_group_retention_service(
+        request.user, group, request.data.get("retention_days")
+    )
+    if not ok:
+        status = 403 if result.startswith("Only admin") else 400
+        return Response({"error": result}, status=status)
+
+    return Response({"group_id": group.id, "retention_days": group.retention_days}, status=200)
+
+
+# =====================================================
+# 🔥 EDIT / DELETE / SYNC
+# =====================================================
+
+_MESSAGE_ERRORS = {"text_required": 400, "message_deleted": 409}
+
+
+@api_view(["POST"])
+@authentication_classes([])
+@permission_classes([AllowAny])
+@login_required
+def edit_message(request, message_id):
+
+    try:
+        message = services.edit_message_service(request.user, message_id, request.data.get("text", ""))
+    except Message.DoesNotExist:
+        return Response({"error": "message not found"}, status=404)
+    except PermissionError:
+        return Response({"error": "Not allowed"}, status=403)
+    except ValueError as exc:
+        return Response({"error": str(exc)}, status=_MESSAGE_ERRORS.get(str(exc), 400))
+
+    return Response({"id": message.id, "seq": message.change_seq, "text": message.text, "edited_at": message.edited_at})
+
+
+@api_view(["POST"])
+@authentication_classes([])
+@permission_classes([AllowAny])
+@login_required
+def delete_message(request, message_id):
+
+    try:
+        message = services.delete_message_service(request.user, message_id)
+    except Message.DoesNotExist:
+        return Response({"error": "message not found"}, status=404)
+    except PermissionError:
+        return Response({"error": "Not allowed"}, status=403)
+
+    return Response({"id": message.id, "seq": message.change_seq, "deleted": True})
+
+
+def _chat_changes(request, chat_type, chat_id):
+    # ?since=<last seq the client holds>&limit=
+    try:
+        since = int(request.GET.get("since", 0))
+        limit = min(int(request.GET.get("limit", 200)), 1000)
+    except ValueError:
+        return Response({"error": "since and limit must be integers"}, status=400)
+    if limit < 1:
+        return Response({"error": "limit must be at least 1"}, status=400)
+
+    ok, result = services.list_changes_service(request.user, chat_type, chat_id, since, limit)
+    if not ok:
+        return Response({"error": result}, status=403)
+
+    result["changes"] = [_message_json(request, m) for m in result["changes"]]
+    return Response({"chat_type": chat_type, "chat_id": chat_id, **result}, status=200)
+
+
+@api_view(["GET"])
+@authentication_classes([])
+@permission_classes([AllowAny])
+@login_required
+def group_chat_changes(request, group_id):
+    get_object_or_404(GroupChat, id=group_id)
+    return _chat_changes(request, "group", group_id)
+
+
+@api_view(["GET"])
+@authentication_classes([])
+@permission_classes([AllowAny])
+@login_required
+def direct_chat_changes(request, chat_id):
+    get_object_or_404(DirectChat, id=chat_id)
+    return _chat_changes(request, "direct", chat_id)
+
+
+# =====================================================
+# 🔥 SEND (REST; sockets use the consumers)
+# =====================================================
+
+def _send(request, send, chat):
+    text = request.data.get("text", "")
+    file = request.FILES.get("file")
+    if not text and not file:
+        return Response({"error": "text or file required"}, status=400)
+
+    try:
+        message = send(
+            request.user, chat, text, file,
+            reply_to_id=request.data.get("reply_to") or None,
+            client_msg_id=request.data.get("client_msg_id"),
+        )
+    except PermissionError:
+        return Response({"error": "Not allowed"}, status=403)
+    except ValueError as exc:
+        return Response({"error": str(exc)}, status=_MESSAGE_ERRORS.get(str(exc), 400))
+    except DuplicateMessage as dup:
+        # a retry of a send that already went through
+        return Response({"id": dup.message_id, "created_at": dup.created_at, "duplicate": True}, status=200)
+
+    return Response(
+        {"id": message.id, "created_at": message.created_at, "seq": message.change_seq, "duplicate": False},
+        status=201,
+    )
+
+
+@api_view(["POST"])
+@authentication_classes([])
+@permission_classes([AllowAny])
+@login_required
+@parser_classes([JSONParser, MultiPartParser, FormParser])
+def send_group_message(request, group_id):
+    group = get_object_or_404(GroupChat, id=group_id)
+    return _send(request, services.send_group_message_service, group)
+
+
+@api_view(["POST"])
+@authentication_classes([])
+@permission_classes([AllowAny])
+@login_required
+@parser_classes([JSONParser, MultiPartParser, FormParser])
+def send_direct_message(request, chat_id):
+    chat = get_object_or_404(DirectChat, id=chat_id)
+    return _send(request, services.send_direct_message_service, chat)
+
+
+# =====================================================
+# 🔥 REACTIONS
+# =====================================================
+
+_REACTION_ERRORS = {"message_deleted": 409, "too_many_reactions": 409}
+
+
+def _react(request, message_id, add):
+    try:
+        message = services.react_service(request.user, message_id, request.data.get("emoji"), add=add)
+    except Message.DoesNotExist:
+        return Response({"error": "message not found"}, status=404)
+    except PermissionError:
+        return Response({"error": "Not allowed"}, status=403)
+    except ValueError as exc:
+        return Response({"error": str(exc)}, status=_REACTION_ERRORS.get(str(exc), 400))
+
+    return Response({"id": message.id, "seq": message.change_seq, "reactions": message.reaction_counts})
+
+
+@api_view(["POST"])
+@authentication_classes([])
+@permission_classes([AllowAny])
+@login_required
+def add_reaction(request, message_id):
+    return _react(request, message_id, add=True)
+
+
+@api_view(["POST"])
+@authentication_classes([])
+@permission_classes([AllowAny])
+@login_required
+def remove_reaction(request, message_id):
+    return _react(request, message_id, add=False)
+
+
+# =====================================================
+# 🔥 THREADS
+# =====================================================
+
+@api_view(["GET"])
+@authentication_classes([])
+@permission_classes([AllowAny])
+@login_required
+def message_thread(request, message_id):
+    """The thread a message starts or belongs to, oldest reply first (?after=<reply id>&limit=)."""
+
+    try:
+        after_id = int(request.GET["after"]) if "after" in request.GET else None
+        limit = min(int(request.GET.get("limit", 50)), 500)
+    except ValueError:
+        return Response({"error": "after and limit must be integers"}, status=400)
+    if limit < 1:
+        return Response({"error": "limit must be at least 1"}, status=400)
+
+    try:
+        ok, result = services.thread_service(request.user, message_id, after_id, limit)
+    except Message.DoesNotExist:
+        return Response({"error": "message not found"}, status=404)
+    if not ok:
+        return Response({"error": result}, status=403)
+
+    result["replies"] = [_message_json(request, m) for m in result["replies"]]
+    if result.get("root"):
+        result["root"] = _message_json(request, result["root"])
+    return Response(result, status=200)
+
+
+# =====================================================
+# 🔥 EXPORT
+# =====================================================
+
+def _export_response(records, filename, compress):
+    response = StreamingHttpResponse(
+        export.ndjson_chunks(records, compress=compress),
+        content_type="application/gzip" if compress else "application/x-ndjson",
+    )
+    if compress:
+        filename += ".gz"
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    return response
+
+
+# EXPORT GROUP HISTORY (ADMIN ONLY), ?gzip=1 for a compressed file
+
+@api_view(["GET"])
+@authentication_classes([])
+@permission_classes([AllowAny])
+@login_required
+def export_group_history(request, group_id):
+
+    group = get_object_or_404(GroupChat, id=group_id)
+    if not services.is_group_admin_service(request.user, group):
+        return Response({"error": "Only admins can export"}, status=403)
+
+    compress = request.GET.get("gzip") in ("1", "true")
+    return _export_response(export.group_records(group.id), f"group_{group.id}.ndjson", compress)
+
+
+# EXPORT EVERYTHING THE AUTHENTICATED USER SENT
+
+@api_view(["GET"])
+@authentication_classes([])
+@permission_classes([AllowAny])
+@login_required
+def export_my_history(request):
+
+    compress = request.GET.get("gzip") in ("1", "true")
+    return _export_response(export.user_records(request.user.id), f"user_{request.user.id}.ndjson", compress)
+
+
 # =====================================================
 # 🔥 PROFILE PHOTO
 # =====================================================
@@ -304,7 +569,7 @@ def update_profile_photo(request):
     user.profile_pic = file
     user.save()
 
-    url = request.build_absolute_uri(user.profile_pic.url) if user.profile_pic else None
+    url = media_url(user.profile_pic.name, request)
 
     return Response({
         "message": "Profile photo updated successfully",
@@ -316,15 +581,12 @@ def update_profile_photo(request):
 @authentication_classes([])
 @permission_classes([AllowAny])
 @login_required
+@etag_from(lambda request: [f"user:{request.user.id}", f"media:{media_base(request)}"])
 def get_profile(request):
 
     user = request.user
 
-    profile_pic_url = (
-        request.build_absolute_uri(user.profile_pic.url)
-        if user.profile_pic
-        else None
-    )
+    profile_pic_url = media_url(user.profile_pic.name, request)
 
     return Response(
         {
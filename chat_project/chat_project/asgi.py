@@ -9,13 +9,19 @@ django_asgi_app = get_asgi_application()
 
 from channels.routing import ProtocolTypeRouter, URLRouter
 import chat_backend.routing
+from chat_backend.admission import AdmissionMiddleware
 from chat_backend.jwt_middleware import JWTAuthMiddleware
+from chat_backend.media_app import MediaFileApp
 
 application = ProtocolTypeRouter({
-    "http": django_asgi_app,
-    "websocket": JWTAuthMiddleware(
-        URLRouter(
-            chat_backend.routing.websocket_urlpatterns
+    # /media/ is served straight from disk; everything else goes to Django
+    "http": MediaFileApp(django_asgi_app),
+    # handshakes are admitted before the token lookup hits the database
+    "websocket": AdmissionMiddleware(
+        JWTAuthMiddleware(
+            URLRouter(
+                chat_backend.routing.websocket_urlpatterns
+            )
         )
     ),
 })
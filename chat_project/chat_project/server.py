@@ -0,0 +1,51 @@
+"""Daphne entrypoint with permessage-deflate enabled.
+
+Compression is negotiated by the WebSocket server, not by the ASGI app, and
+stock Daphne never accepts a permessage-deflate offer. This wraps Daphne's
+CLI with a Server that does, keeping context takeover on so each connection
+reuses one compressor and repeated keys (sender_id, created_at, event, ...)
+shrink to back-references across frames.
+
+    python -m chat_project.server -b 0.0.0.0 -p 8000 chat_project.asgi:application
+"""
+
+from autobahn.websocket.compress import PerMessageDeflateOffer, PerMessageDeflateOfferAccept
+from daphne.cli import CommandLineInterface
+from daphne.server import Server
+from django.conf import settings
+from twisted.internet import reactor
+
+
+def accept_deflate(offers):
+    """Pick the client's permessage-deflate offer, if any, with our window/memory limits."""
+    bits = settings.WS_DEFLATE_WINDOW_BITS
+    for offer in offers:
+        if not isinstance(offer, PerMessageDeflateOffer):
+            continue
+        return PerMessageDeflateOfferAccept(
+            offer,
+            request_max_window_bits=bits if offer.accept_max_window_bits else 0,
+            window_bits=min(bits, offer.request_max_window_bits or bits),
+            mem_level=settings.WS_DEFLATE_MEM_LEVEL,
+        )
+    return None
+
+
+class CompressingServer(Server):
+    def run(self):
+        # Server.run() builds ws_factory and then starts the reactor; this fires
+        # in between, before any connection is accepted
+        reactor.callWhenRunning(self.enable_compression)
+        super().run()
+
+    def enable_compression(self):
+        if settings.WS_PERMESSAGE_DEFLATE:
+            self.ws_factory.setProtocolOptions(perMessageCompressionAccept=accept_deflate)
+
+
+class CompressingCommandLineInterface(CommandLineInterface):
+    server_class = CompressingServer
+
+
+if __name__ == "__main__":
+    CompressingCommandLineInterface.entrypoint()
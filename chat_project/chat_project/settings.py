@@ -80,12 +80,41 @@ TEMPLATES = [
 # ASGI / CHANNELS
 ASGI_APPLICATION = 'chat_project.asgi.application'
 
+# single process: chat_backend.layers is the stock in-memory layer with O(1) groups and timer-based expiry
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        'BACKEND': 'chat_backend.layers.InProcessChannelLayer',
     },
 }
 
+# permessage-deflate negotiation (only when served via `python -m chat_project.server`).
+# Window/memory level bound per-connection zlib state: 11/4 is ~16KB per socket
+# instead of ~256KB for zlib defaults, and still spans several recent events.
+WS_PERMESSAGE_DEFLATE = True
+WS_DEFLATE_WINDOW_BITS = 11
+WS_DEFLATE_MEM_LEVEL = 4
+# sockets opened with ?batch=1 coalesce events sent within this window into one frame
+WS_BATCH_WINDOW_MS = 5
+# rooms one /ws/multiplex/ socket may subscribe to
+WS_MULTIPLEX_MAX_ROOMS = 500
+# HEARTBEAT (chat_backend/heartbeat.py): sockets quiet this long get an application-level ping ...
+WS_PING_INTERVAL_S = int(os.getenv("WS_PING_INTERVAL_S", "25"))
+# ... and are closed, their groups discarded, after this long without any frame
+WS_IDLE_TIMEOUT_S = int(os.getenv("WS_IDLE_TIMEOUT_S", "75"))
+WS_REAP_BATCH_SIZE = 500  # sockets whose groups are discarded per reaper step
+# CONNECT ADMISSION (chat_backend/admission.py)
+WS_CONNECT_CONCURRENCY = int(os.getenv("WS_CONNECT_CONCURRENCY", "32"))  # handshakes in flight
+WS_CONNECT_QUEUE = 1000  # handshakes waiting for a slot; beyond that connects are refused at once
+WS_CONNECT_QUEUE_TIMEOUT_MS = 3000
+# refused connects are told to retry after a jittered delay in this range
+WS_RETRY_MIN_MS = 500
+WS_RETRY_MAX_MS = 30000
+
+# GROUP FAN-OUT (chat_backend/fanout.py)
+FANOUT_WORKERS = int(os.getenv("FANOUT_WORKERS", "4"))
+FANOUT_CHUNK_SIZE = 500  # members per delivery job
+FANOUT_LAG_WARN_MS = 2000
+
 # WSGI (not used, but Django needs it)
 WSGI_APPLICATION = 'chat_project.wsgi.application'
 
@@ -113,6 +142,14 @@ AUTH_PASSWORD_VALIDATORS = [
     },
 ]
 
+# PASSWORD HASHING POOL
+# PBKDF2 runs in these worker processes instead of on the request thread.
+# Set PASSWORD_HASH_WORKERS=0 to hash inline (e.g. in tests).
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "2"))
+# hashing jobs allowed in flight before login/signup answer 429
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "16"))
+PASSWORD_HASH_TIMEOUT = 10  # seconds
+
 # INTERNATIONALIZATION
 LANGUAGE_CODE = 'en-us'
 TIME_ZONE = 'UTC'
@@ -125,6 +162,65 @@ STATIC_URL = 'static/'
 # MEDIA FILES (for chat attachments)
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
+# uploads are hashed as they stream in, for content-addressed storage (chat_backend/media.py)
+FILE_UPLOAD_HANDLERS = [
+    "chat_backend.media.HashingMemoryFileUploadHandler",
+    "chat_backend.media.HashingTemporaryFileUploadHandler",
+]
+# absolute base for media links in API responses, e.g. "https://cdn.example.com/media/";
+# empty: the request's origin + MEDIA_URL
+MEDIA_BASE_URL = os.getenv("MEDIA_BASE_URL", "")
+MEDIA_URL_CACHE_SIZE = 100000  # (base, file name) -> URL, per process
+# MEDIA_URL is answered by chat_backend/media_app.py ahead of Django (ASGI)
+MEDIA_CHUNK_SIZE = 256 * 1024  # bytes per body message when the server has no sendfile extension
+MEDIA_CACHE_MAX_AGE = 3600  # seconds, for files not stored by content
+# e.g. "/protected-media/": hand files to nginx (internal location aliased to MEDIA_ROOT)
+MEDIA_ACCEL_REDIRECT = os.getenv("MEDIA_ACCEL_REDIRECT", "")
+
+# user pair -> direct chat id, per worker process
+DIRECT_CHAT_CACHE_SIZE = 50000
+
+# log the 304 ratio of each ETag-enabled view every N requests
+ETAG_STATS_LOG_EVERY = 1000
+
+# MESSAGE ARCHIVE (cold tier, see chat_backend/tiering.py)
+MESSAGE_ARCHIVE_ROOT = BASE_DIR / 'archive'
+MESSAGE_ARCHIVE_AFTER_DAYS = int(os.getenv("MESSAGE_ARCHIVE_AFTER_DAYS", "90"))
+MESSAGE_ARCHIVE_BLOCK_SIZE = 256  # messages per compressed block
+MESSAGE_ARCHIVE_COMPRESSION_LEVEL = 6
+
+# HISTORY EXPORT (chat_backend/export.py)
+EXPORT_CHUNK_SIZE = 2000  # rows fetched per cursor round trip
+EXPORT_BUFFER_BYTES = 64 * 1024  # NDJSON bytes per streamed chunk
+
+# RETENTION (chat_backend/retention.py, manage.py prune_messages)
+MESSAGE_RETENTION_DAYS = int(os.getenv("MESSAGE_RETENTION_DAYS", "0"))  # default window, 0 = keep forever
+RETENTION_BATCH_SIZE = 500  # rows deleted per transaction
+RETENTION_BATCH_PAUSE_MS = 50  # sleep between batches so live writers get the lock
+RETENTION_VACUUM_PAGES = 256  # pages released per incremental_vacuum step
+RETENTION_MEDIA_GRACE_SECONDS = 3600  # unreferenced uploads younger than this are kept
+
+# IDEMPOTENT SENDS (chat_backend/dedupe.py)
+SEND_DEDUPE_WINDOW = 50000  # recent (sender, client_msg_id) keys kept in memory per process
+
+# NOTIFICATION OUTBOX (chat_backend/outbox.py)
+OUTBOX_DISPATCH = os.getenv("OUTBOX_DISPATCH", "1") == "1"  # run a dispatcher in this process
+OUTBOX_BATCH_SIZE = 200
+OUTBOX_POLL_MS = 1000  # retries and rows left by dead processes are picked up this often
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_RETRY_BASE_MS = 500  # doubled per failed attempt
+
+# OFFLINE DELIVERY (chat_backend/inbox.py): notifications kept until a client acks them
+INBOX_MAX_PENDING = 500  # per user; older ones are dropped
+INBOX_MAX_AGE_DAYS = 7  # not replayed after this, purged by prune_messages
+INBOX_ACK_FLUSH_MS = 1000  # acks arriving within this window are deleted together
+
+# REACTIONS
+REACTION_COALESCE_MS = int(os.getenv("REACTION_COALESCE_MS", "250"))  # per-room broadcast window
+REACTION_MAX_KINDS = 20  # distinct emojis per message
+
+# CHAT COUNTERS (chat_backend/counters.py, manage.py reconcile_counters)
+RECONCILE_BATCH_SIZE = 1000  # chats recomputed per transaction
 
 # DEFAULT PRIMARY KEY FIELD
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"